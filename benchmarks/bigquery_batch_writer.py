@@ -0,0 +1,126 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Insert throughput of shared.insert_row_into_bigquery called from concurrent
+request threads, as a parser with `gunicorn --threads N` does, with an
+insertAll request per row vs. the BatchWriter, against a local BigQuery
+stand-in.
+
+    python benchmarks/bigquery_batch_writer.py --events 2000 --threads 8 32 \
+        --max-latency 0 0.02 --senders 1 4
+"""
+
+import argparse
+from concurrent import futures
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+sys.path.insert(0, HERE)
+
+from bigquery_standin import BigQueryStandIn  # noqa: E402
+
+import shared  # noqa: E402
+
+
+def event(run, number):
+    return {
+        "event_type": "push",
+        "id": f"{number:040x}",
+        "metadata": '{"ref": "refs/heads/main"}',
+        "time_created": "2021-06-15 11:12:14",
+        "signature": f"{run}-{number:040x}",
+        "msg_id": str(number),
+        "source": "github",
+        "team": "default",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[8, 32])
+    parser.add_argument(
+        "--latency", type=float, default=0.02,
+        help="Seconds the stand-in waits before answering each request",
+    )
+    parser.add_argument(
+        "--max-latency", type=float, nargs="+", default=[0, 0.02],
+        help="BIGQUERY_BATCH_MAX_LATENCY values to compare",
+    )
+    parser.add_argument(
+        "--senders", type=int, nargs="+", default=[1, 4],
+        help="BIGQUERY_BATCH_SENDERS values to compare",
+    )
+    args = parser.parse_args()
+
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import bigquery
+
+    standin = BigQueryStandIn(latency=args.latency)
+    shared._client = bigquery.Client(
+        project="benchmark",
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": standin.start()},
+    )
+    directory = tempfile.mkdtemp(prefix="batch-writer-")
+    shared._deduplicator = shared.Deduplicator(
+        shared.SQLiteStore(os.path.join(directory, "dedup.sqlite3"))
+    )
+    shared.get_table("events_raw")
+
+    print(f"{args.events} events, {args.latency * 1000:g} ms per BigQuery request")
+    configurations = [("row per request", None, None)] + [
+        (f"{senders} x batch, {max_latency * 1000:g} ms", max_latency, senders)
+        for senders in args.senders
+        for max_latency in args.max_latency
+    ]
+    run = 0
+    for threads in args.threads:
+        for name, max_latency, senders in configurations:
+            run += 1
+            shared.BATCHING = max_latency is not None
+            if shared.BATCHING:
+                shared.close_writer()
+                shared._writer = shared.BatchWriter(
+                    max_latency=max_latency, senders=senders
+                )
+            standin.reset()
+            with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+                start = time.perf_counter()
+                list(pool.map(
+                    shared.insert_row_into_bigquery,
+                    (event(run, n) for n in range(args.events)),
+                ))
+                elapsed = time.perf_counter() - start
+            requests = standin.requests["tables.insertAll"]
+            print(
+                f"{threads:3} threads, {name:>19}: "
+                f"{args.events / elapsed:8.0f} rows/s, "
+                f"{requests} insertAll requests "
+                f"({standin.rows / max(requests, 1):.1f} rows each)"
+            )
+
+    shared.close_writer()
+    standin.stop()
+
+
+if __name__ == "__main__":
+    main()
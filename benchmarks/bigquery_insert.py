@@ -0,0 +1,111 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-event cost of shared.insert_row_into_bigquery against a local BigQuery
+stand-in: a client and a tables.get call per event (the previous behaviour)
+vs. the process-wide client and the cached table schema.
+
+    python benchmarks/bigquery_insert.py --events 500 --latency 0.01
+
+The duplicate check query is left out of both, so that only the insert path
+is compared. Clients use anonymous credentials, so the token a new client
+with real credentials fetches is not counted either.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+sys.path.insert(0, HERE)
+
+from bigquery_standin import BigQueryStandIn  # noqa: E402
+
+import shared  # noqa: E402
+
+
+def event(number):
+    return {
+        "event_type": "push",
+        "id": f"{number:040x}",
+        "metadata": '{"ref": "refs/heads/main"}',
+        "time_created": "2021-06-15 11:12:14",
+        "signature": f"{number:040x}",
+        "msg_id": str(number),
+        "source": "github",
+        "team": "default",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument(
+        "--latency", type=float, default=0.01,
+        help="Seconds the stand-in waits before answering each request",
+    )
+    args = parser.parse_args()
+
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import bigquery
+
+    standin = BigQueryStandIn(latency=args.latency)
+    endpoint = standin.start()
+
+    def new_client():
+        return bigquery.Client(
+            project="benchmark",
+            credentials=AnonymousCredentials(),
+            client_options={"api_endpoint": endpoint},
+        )
+
+    def legacy_insert(event):
+        client = new_client()
+        table = client.get_table("four_keys.events_raw")
+        row = tuple(event[field.name] for field in table.schema)
+        return client.insert_rows(table, [row])
+
+    shared._client = new_client()
+    shared.is_unique = lambda client, signature: True
+    cached_insert = shared.insert_row_into_bigquery
+
+    print(f"{args.events} events, {args.latency * 1000:.0f} ms per BigQuery request")
+    results = {}
+    for name, insert in (("client per event", legacy_insert), ("shared client", cached_insert)):
+        standin.reset()
+        shared._tables.clear()
+        start = time.perf_counter()
+        for n in range(args.events):
+            insert(event(n))
+        elapsed = time.perf_counter() - start
+        results[name] = elapsed / args.events
+        requests = sum(standin.requests.values())
+        print(
+            f"{name:>17}: {results[name] * 1000:7.2f} ms/event, "
+            f"{requests / args.events:.2f} requests/event "
+            f"({dict(standin.requests)})"
+        )
+
+    saved = results["client per event"] - results["shared client"]
+    print(f"{'saved':>17}: {saved * 1000:7.2f} ms/event")
+    standin.stop()
+
+
+if __name__ == "__main__":
+    main()
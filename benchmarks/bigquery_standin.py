@@ -0,0 +1,191 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process stand-in for the BigQuery REST API.
+
+It serves `tables.get` with the schemas in setup/ and accepts every
+`tables.insertAll` request after a configurable delay, counting requests,
+rows and bytes. Queries run as jobs that are done at once: a query with
+DISTINCT returns the `signatures` of the stand-in, a query with a @signature
+parameter that signature if it is one of them, any other query no rows.
+Point a client at it with:
+
+    standin = BigQueryStandIn(latency=0.02)
+    client = bigquery.Client(
+        project="benchmark",
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": standin.start()},
+    )
+"""
+
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCHEMAS = os.path.join(HERE, "..", "setup")
+
+TABLE_PATH = re.compile(
+    r"/bigquery/v2/projects/([^/]+)/datasets/([^/]+)/tables/([^/?]+)(/insertAll)?"
+)
+JOBS_PATH = re.compile(r"/bigquery/v2/projects/([^/]+)/jobs(?:\?|$)")
+JOB_PATH = re.compile(r"/bigquery/v2/projects/([^/]+)/(jobs|queries)/([^/?]+)")
+
+
+class BigQueryStandIn(object):
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = collections.Counter()
+        self.rows = 0
+        self.bytes = 0
+        self._signatures = []
+        self._signature_set = set()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    def start(self) -> str:
+        """
+        Starts the server and returns its URL
+        """
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.rows = self.bytes = 0
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                match = JOB_PATH.match(self.path)
+                if match:
+                    return self._job(*match.group(1, 2, 3))
+                match = TABLE_PATH.match(self.path)
+                if not match or match.group(4):
+                    return self._reply(404, {"error": {"code": 404}})
+                project, dataset, table = match.group(1, 2, 3)
+                standin._count("tables.get")
+                with open(os.path.join(SCHEMAS, f"{table}_schema.json")) as f:
+                    fields = json.load(f)
+                self._reply(200, {
+                    "tableReference": {
+                        "projectId": project, "datasetId": dataset, "tableId": table
+                    },
+                    "schema": {"fields": fields},
+                })
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                match = JOBS_PATH.match(self.path)
+                if match:
+                    job = json.loads(body)
+                    reference = job["jobReference"]
+                    query = job["configuration"]["query"]
+                    parameters = {
+                        p["name"]: p["parameterValue"]["value"]
+                        for p in query.get("queryParameters", ())
+                    }
+                    if "DISTINCT" in query["query"]:
+                        rows = standin.signatures
+                    elif parameters.get("signature") in standin._signature_set:
+                        rows = [parameters["signature"]]
+                    else:
+                        rows = []
+                    with standin._lock:
+                        standin._jobs[reference["jobId"]] = rows
+                    standin._count("jobs.insert")
+                    job["status"] = {"state": "DONE"}
+                    return self._reply(200, job)
+                match = TABLE_PATH.match(self.path)
+                if not match or not match.group(4):
+                    return self._reply(404, {"error": {"code": 404}})
+                rows = len(json.loads(body).get("rows", ()))
+                standin._count("tables.insertAll", rows, len(body))
+                self._reply(200, {"kind": "bigquery#tableDataInsertAllResponse"})
+
+            def _job(self, project, kind, job_id):
+                rows = standin._jobs.get(job_id)
+                if rows is None:
+                    return self._reply(404, {"error": {"code": 404}})
+                reference = {"projectId": project, "jobId": job_id}
+                if kind == "jobs":
+                    standin._count("jobs.get")
+                    return self._reply(200, {
+                        "jobReference": reference,
+                        "status": {"state": "DONE"},
+                        "configuration": {"query": {}},
+                    })
+                standin._count("jobs.getQueryResults")
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+                start = int(query.get("pageToken", ["0"])[0])
+                size = int(query.get("maxResults", [len(rows)])[0])
+                page = {
+                    "jobReference": reference,
+                    "jobComplete": True,
+                    "totalRows": str(len(rows)),
+                    "schema": {"fields": [{"name": "signature", "type": "STRING"}]},
+                    "rows": [{"f": [{"v": s}]} for s in rows[start:start + size]],
+                }
+                if size and start + size < len(rows):
+                    page["pageToken"] = str(start + size)
+                self._reply(200, page)
+
+            def _reply(self, status, payload):
+                if standin.latency:
+                    time.sleep(standin.latency)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @property
+    def signatures(self):
+        return self._signatures
+
+    @signatures.setter
+    def signatures(self, signatures):
+        self._signatures = list(signatures)
+        self._signature_set = set(self._signatures)
+
+    def _count(self, method, rows=0, size=0):
+        with self._lock:
+            self.requests[method] += 1
+            self.rows += rows
+            self.bytes += size
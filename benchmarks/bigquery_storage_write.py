@@ -0,0 +1,122 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Throughput and bytes sent per row of each BIGQUERY_SINK: streaming inserts
+against a local BigQuery REST stand-in vs. Storage Write API appends to
+committed and pending streams against a local Storage Write stand-in. Rows
+go through the BatchWriter from concurrent request threads, as in a parser.
+
+    python benchmarks/bigquery_storage_write.py --events 4000 --threads 32
+"""
+
+import argparse
+from concurrent import futures
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+sys.path.insert(0, HERE)
+
+from bigquery_standin import BigQueryStandIn  # noqa: E402
+from bigquery_write_standin import BigQueryWriteStandIn  # noqa: E402
+
+import shared  # noqa: E402
+
+
+def row(number):
+    return (
+        "push",
+        f"{number:040x}",
+        '{"ref": "refs/heads/main", "head_commit": {"id": "%040x"}}' % number,
+        "2021-06-15 11:12:14",
+        f"{number:040x}",
+        str(number),
+        "github",
+        "default",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--events", type=int, default=4000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument(
+        "--latency", type=float, default=0.02,
+        help="Seconds the stand-ins wait before answering each request",
+    )
+    args = parser.parse_args()
+
+    import grpc
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import bigquery
+    from google.cloud.bigquery_storage_v1 import BigQueryWriteClient
+    from google.cloud.bigquery_storage_v1.services.big_query_write.transports import (
+        BigQueryWriteGrpcTransport,
+    )
+
+    rest = BigQueryStandIn(latency=args.latency)
+    shared._client = bigquery.Client(
+        project="benchmark",
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": rest.start()},
+    )
+    shared.get_table("events_raw")
+    write = BigQueryWriteStandIn(latency=args.latency)
+    write_client = BigQueryWriteClient(
+        transport=BigQueryWriteGrpcTransport(channel=grpc.insecure_channel(write.start()))
+    )
+
+    print(
+        f"{args.events} rows from {args.threads} threads, "
+        f"{args.latency * 1000:g} ms per request"
+    )
+    sinks = (
+        ("insert_all", shared.insert_rows, rest),
+        ("storage_write, committed",
+         shared.StorageWriter(write_client, "committed").insert, write),
+        ("storage_write, pending",
+         shared.StorageWriter(write_client, "pending").insert, write),
+    )
+    for name, sink, standin in sinks:
+        writer = shared.BatchWriter(sink)
+        rest.reset()
+        write.reset()
+        with futures.ThreadPoolExecutor(max_workers=args.threads) as pool:
+            start = time.perf_counter()
+            results = list(pool.map(
+                lambda n: writer.insert("events_raw", row(n)).result(),
+                range(args.events),
+            ))
+            elapsed = time.perf_counter() - start
+        writer.close()
+        assert not any(results), results[:3]
+        written = standin.rows if standin is rest else sum(standin.rows.values())
+        assert written == args.events, (name, written)
+        print(
+            f"{name:>25}: {args.events / elapsed:7.0f} rows/s, "
+            f"{standin.bytes / args.events:6.1f} bytes/row sent, "
+            f"{writer.stats()['batches']} requests"
+        )
+
+    rest.stop()
+    write.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process stand-in for the BigQuery Storage Write API.
+
+It serves the `google.cloud.bigquery.storage.v1.BigQueryWrite` methods the
+Storage Write sink of shared.py uses: CreateWriteStream, AppendRows,
+FinalizeWriteStream and BatchCommitWriteStreams. Appends are checked against
+the offset of their stream and answered after a configurable delay; rows of
+committed streams count as written at once, rows of pending streams once
+their stream is committed. Point a client at it with:
+
+    standin = BigQueryWriteStandIn(latency=0.02)
+    client = BigQueryWriteClient(
+        transport=BigQueryWriteGrpcTransport(
+            channel=grpc.insecure_channel(standin.start())
+        )
+    )
+"""
+
+from concurrent import futures
+import collections
+import itertools
+import threading
+import time
+
+import grpc
+from google.cloud.bigquery_storage_v1 import types
+
+SERVICE = "google.cloud.bigquery.storage.v1.BigQueryWrite"
+
+# google.rpc.Code
+ALREADY_EXISTS = 6
+OUT_OF_RANGE = 11
+
+
+class BigQueryWriteStandIn(object):
+    def __init__(self, latency: float = 0.0, max_workers: int = 32):
+        self.latency = latency
+        # Table path -> rows written
+        self.rows = collections.Counter()
+        self.appends = 0
+        self.bytes = 0
+        # Appends whose response is dropped after their rows were written
+        self.drop_responses = 0
+        self._streams = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+        methods = {
+            "CreateWriteStream": grpc.unary_unary_rpc_method_handler(
+                self._create_write_stream,
+                request_deserializer=types.CreateWriteStreamRequest.deserialize,
+                response_serializer=types.WriteStream.serialize,
+            ),
+            "AppendRows": grpc.stream_stream_rpc_method_handler(
+                self._append_rows,
+                request_deserializer=types.AppendRowsRequest.deserialize,
+                response_serializer=types.AppendRowsResponse.serialize,
+            ),
+            "FinalizeWriteStream": grpc.unary_unary_rpc_method_handler(
+                self._finalize_write_stream,
+                request_deserializer=types.FinalizeWriteStreamRequest.deserialize,
+                response_serializer=types.FinalizeWriteStreamResponse.serialize,
+            ),
+            "BatchCommitWriteStreams": grpc.unary_unary_rpc_method_handler(
+                self._batch_commit_write_streams,
+                request_deserializer=types.BatchCommitWriteStreamsRequest.deserialize,
+                response_serializer=types.BatchCommitWriteStreamsResponse.serialize,
+            ),
+        }
+        self._server.add_generic_rpc_handlers(
+            (grpc.method_handlers_generic_handler(SERVICE, methods),)
+        )
+
+    def start(self) -> str:
+        """
+        Starts the server and returns its host:port
+        """
+        port = self._server.add_insecure_port("127.0.0.1:0")
+        self._server.start()
+        return f"127.0.0.1:{port}"
+
+    def stop(self):
+        self._server.stop(None)
+
+    def reset(self):
+        with self._lock:
+            self.rows.clear()
+            self.appends = self.bytes = 0
+
+    def _create_write_stream(self, request, context):
+        name = f"{request.parent}/streams/{next(self._ids)}"
+        with self._lock:
+            self._streams[name] = {
+                "table": request.parent,
+                "type": request.write_stream.type_,
+                "rows": 0,
+                "finalized": False,
+            }
+        return types.WriteStream(name=name, type_=request.write_stream.type_)
+
+    def _append_rows(self, requests, context):
+        stream_name = None
+        for request in requests:
+            if self.latency:
+                time.sleep(self.latency)
+            stream_name = request.write_stream or stream_name
+            response, drop = self._append(stream_name, request)
+            if response is None or drop:
+                context.set_code(
+                    grpc.StatusCode.NOT_FOUND if response is None
+                    else grpc.StatusCode.UNAVAILABLE
+                )
+                return
+            yield response
+
+    def _append(self, stream_name, request):
+        rows = len(request.proto_rows.rows.serialized_rows)
+        size = len(types.AppendRowsRequest.serialize(request))
+        with self._lock:
+            self.appends += 1
+            self.bytes += size
+            stream = self._streams.get(stream_name)
+            if stream is None:
+                return None, False
+            offset = request.offset if "offset" in request else stream["rows"]
+            if offset < stream["rows"]:
+                return self._error(ALREADY_EXISTS, f"Offset {offset} already written"), False
+            if offset > stream["rows"]:
+                return self._error(OUT_OF_RANGE, f"Offset {offset} is past the end"), False
+            stream["rows"] += rows
+            if stream["type"] == types.WriteStream.Type.COMMITTED:
+                self.rows[stream["table"]] += rows
+            drop = self.drop_responses > 0
+            self.drop_responses -= drop
+        response = types.AppendRowsResponse(
+            append_result=types.AppendRowsResponse.AppendResult(offset=offset),
+            write_stream=stream_name,
+        )
+        return response, drop
+
+    def _finalize_write_stream(self, request, context):
+        with self._lock:
+            stream = self._streams[request.name]
+            stream["finalized"] = True
+        return types.FinalizeWriteStreamResponse(row_count=stream["rows"])
+
+    def _batch_commit_write_streams(self, request, context):
+        with self._lock:
+            for name in request.write_streams:
+                stream = self._streams.pop(name)
+                self.rows[stream["table"]] += stream["rows"]
+        return types.BatchCommitWriteStreamsResponse()
+
+    @staticmethod
+    def _error(code, message):
+        return types.AppendRowsResponse(error={"code": code, "message": message})
@@ -0,0 +1,131 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-event cost of the duplicate check in shared.py with each dedup store,
+after warming it up from the signatures already in events_raw, against local
+BigQuery and Redis stand-ins.
+
+    python benchmarks/dedup_store.py --existing 200000 --events 2000
+
+Every event is checked and, when new, recorded, as the parsers do; a
+`--duplicates` share of them was inserted before. The stand-ins only model
+the round trip: a real BigQuery query also takes a second or more to run.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+sys.path.insert(0, HERE)
+
+from bigquery_standin import BigQueryStandIn  # noqa: E402
+from redis_standin import RedisStandIn  # noqa: E402
+
+import shared  # noqa: E402
+
+
+def signature(number):
+    return f"{number:040x}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--existing", type=int, default=200000,
+                        help="Signatures already in events_raw")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--duplicates", type=float, default=0.1)
+    parser.add_argument("--bigquery-latency", type=float, default=0.01,
+                        help="Seconds the BigQuery stand-in waits per request")
+    parser.add_argument("--redis-latency", type=float, default=0.0005,
+                        help="Seconds the Redis stand-in waits per round trip")
+    args = parser.parse_args()
+
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import bigquery
+    import redis
+
+    bigquery_standin = BigQueryStandIn(latency=args.bigquery_latency)
+    shared._client = bigquery.Client(
+        project="benchmark",
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": bigquery_standin.start()},
+    )
+    bigquery_standin.signatures = [signature(n) for n in range(args.existing)]
+    redis_standin = RedisStandIn(latency=args.redis_latency)
+    redis_url = redis_standin.start()
+
+    duplicates = int(args.events * args.duplicates)
+    events = [signature(n) for n in range(duplicates)] + [
+        signature(args.existing + n) for n in range(args.events - duplicates)
+    ]
+    directory = tempfile.mkdtemp(prefix="dedup-store-")
+    print(
+        f"{args.existing} signatures in events_raw, {args.events} events "
+        f"({duplicates} duplicates), BigQuery {args.bigquery_latency * 1000:g} ms, "
+        f"Redis {args.redis_latency * 1000:g} ms per request"
+    )
+
+    def bloom():
+        return shared.BloomFilter(
+            shared.DEDUP_BLOOM_CAPACITY, shared.DEDUP_BLOOM_FALSE_POSITIVE_RATE
+        )
+
+    stores = (
+        ("bigquery", lambda: shared.Deduplicator(shared.BigQueryStore())),
+        ("sqlite", lambda: shared.Deduplicator(
+            shared.SQLiteStore(os.path.join(directory, "plain.sqlite3")))),
+        ("sqlite + bloom", lambda: shared.Deduplicator(
+            shared.SQLiteStore(os.path.join(directory, "bloom.sqlite3")), bloom())),
+        ("redis", lambda: shared.Deduplicator(shared.RedisStore(
+            redis_url, client=redis.Redis.from_url(redis_url)))),
+        ("redis + bloom", lambda: shared.Deduplicator(shared.RedisStore(
+            redis_url, prefix="bloom:", client=redis.Redis.from_url(redis_url)), bloom())),
+    )
+    for name, create in stores:
+        deduplicator = create()
+        bigquery_standin.reset()
+        start = time.perf_counter()
+        deduplicator.warm_up(shared.existing_signatures)
+        warm_up = time.perf_counter() - start
+
+        bigquery_standin.reset()
+        found = 0
+        start = time.perf_counter()
+        for event in events:
+            if deduplicator.contains(event):
+                found += 1
+            else:
+                deduplicator.add(event)
+        elapsed = time.perf_counter() - start
+        assert found == duplicates, (name, found)
+        queries = bigquery_standin.requests["jobs.insert"]
+        print(
+            f"{name:>15}: warm-up {warm_up:6.2f} s, "
+            f"{elapsed / args.events * 1000:8.3f} ms/event, "
+            f"{queries / args.events:.2f} BigQuery queries/event"
+        )
+
+    bigquery_standin.stop()
+    redis_standin.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load test comparing the Flask event handler (gunicorn, 1 worker, 8 threads,
+as in the Dockerfile) with the ASGI entry point (uvicorn, 1 worker).
+
+Each server runs in its own process pinned to the same single CPU, talks to
+a local Pub/Sub stand-in that answers every Publish RPC after --latency
+seconds, and is driven by the same number of concurrent webhook deliveries.
+
+    python benchmarks/event_handler_asgi.py --requests 3000 --concurrency 200
+"""
+
+import argparse
+import asyncio
+import hmac
+from hashlib import sha1
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EVENT_HANDLER = os.path.join(HERE, "..", "event-handler")
+sys.path.insert(0, HERE)
+
+SECRET = b"benchmark"
+
+
+def serve(mode, port, cpu, secret_latency):
+    """
+    Runs one event handler server with Secret Manager replaced by a stub
+    """
+    sys.path.insert(0, EVENT_HANDLER)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+
+    import sources
+
+    def get_secret(project, name, version):
+        time.sleep(secret_latency)
+        return SECRET
+
+    async def get_secret_async(project, name, version):
+        await asyncio.sleep(secret_latency)
+        return SECRET
+
+    sources.get_secret = get_secret
+    sources.get_secret_async = get_secret_async
+
+    if mode == "flask":
+        from gunicorn.app.base import BaseApplication
+
+        import event_handler
+
+        class Server(BaseApplication):
+            def load_config(self):
+                self.cfg.set("bind", f"127.0.0.1:{port}")
+                self.cfg.set("workers", 1)
+                self.cfg.set("threads", 8)
+                self.cfg.set("timeout", 0)
+                self.cfg.set("loglevel", "warning")
+
+            def load(self):
+                return event_handler.app
+
+        Server().run()
+    else:
+        import uvicorn
+
+        import asgi
+
+        uvicorn.run(
+            asgi.app, host="127.0.0.1", port=port,
+            log_level="warning", access_log=False,
+        )
+
+
+async def deliver(port, request):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(request)
+    await writer.drain()
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+async def load(port, requests, concurrency, request):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status = await deliver(port, request)
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status != 204:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return time.perf_counter() - start, latencies, errors
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--payload-bytes", type=int, default=10_000)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds the Pub/Sub stand-in takes per Publish RPC")
+    parser.add_argument("--secret-latency", type=float, default=0.05,
+                        help="Seconds a Secret Manager lookup takes on a cache miss")
+    parser.add_argument("--cpu", type=int, default=0,
+                        help="CPU both servers are pinned to")
+    parser.add_argument("--serve", choices=("flask", "asgi"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.cpu, args.secret_latency)
+        return
+
+    from pubsub_standin import PubSubStandIn
+
+    standin = PubSubStandIn(latency=args.latency)
+    env = dict(
+        os.environ,
+        PUBSUB_EMULATOR_HOST=standin.start(),
+        PROJECT_NAME="benchmark",
+    )
+
+    body = json.dumps({"padding": "x" * args.payload_bytes}).encode()
+    signature = "sha1=" + hmac.new(SECRET, body, sha1).hexdigest()
+    request = (
+        "POST / HTTP/1.1\r\n"
+        "Host: localhost\r\n"
+        "User-Agent: GitHub-Hookshot\r\n"
+        "X-Github-Event: push\r\n"
+        f"X-Hub-Signature: {signature}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode() + body
+
+    for mode in ("flask", "asgi"):
+        port = free_port()
+        server = subprocess.Popen(
+            [
+                sys.executable, __file__, "--serve", mode, "--port", str(port),
+                "--cpu", str(args.cpu), "--secret-latency", str(args.secret_latency),
+            ],
+            env=env, stdout=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_port(port)
+            standin.reset()
+            elapsed, latencies, errors = asyncio.run(
+                load(port, args.requests, args.concurrency, request)
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(
+            f"{mode:>5}: {args.requests / elapsed:8.1f} req/s, "
+            f"p50 {statistics.median(latencies) * 1000:7.1f} ms, "
+            f"p99 {p99 * 1000:7.1f} ms, {errors} errors, "
+            f"{standin.rpcs} Publish RPCs"
+        )
+
+    standin.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Backfill throughput of GitHub push events posted one webhook per request to
+event_handler.index vs. gzip NDJSON batches posted to /batch, against a local
+Pub/Sub stand-in.
+
+    python benchmarks/event_handler_batch.py --events 20000 --batch-size 5000
+"""
+
+import argparse
+from concurrent import futures
+import contextlib
+import gzip
+import hmac
+from hashlib import sha1, sha256
+import io
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "event-handler"))
+sys.path.insert(0, HERE)
+
+from pubsub_standin import PubSubStandIn  # noqa: E402
+
+SECRET = b"benchmark"
+
+
+def payload(number, size):
+    return {
+        "ref": "refs/heads/main",
+        "after": f"{number:040x}",
+        "head_commit": {"id": f"{number:040x}", "message": "x" * size},
+    }
+
+
+def one_per_request(client, events, threads):
+    def send(event):
+        body = json.dumps(event).encode()
+        headers = {
+            "User-Agent": "GitHub-Hookshot",
+            "X-Github-Event": "push",
+            "X-Hub-Signature": "sha1=" + hmac.new(SECRET, body, sha1).hexdigest(),
+        }
+        r = client.post("/", data=body, headers=headers)
+        assert r.status_code == 204, r.status_code
+
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(send, events))
+
+
+def batches(client, events, batch_size):
+    for start in range(0, len(events), batch_size):
+        lines = [
+            json.dumps({
+                "source": "github",
+                "headers": {"X-Github-Event": "push"},
+                "body": event,
+            }).encode()
+            for event in events[start:start + batch_size]
+        ]
+        body = gzip.compress(b"\n".join(lines))
+        headers = {
+            "Content-Encoding": "gzip",
+            "X-Batch-Signature": "sha256=" + hmac.new(SECRET, body, sha256).hexdigest(),
+        }
+        r = client.post("/batch", data=body, headers=headers)
+        assert r.status_code == 200, r.status_code
+        assert r.json["summary"]["published"] == len(lines), r.json["summary"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8,
+                        help="Concurrent requests when posting one event per request")
+    parser.add_argument("--payload-bytes", type=int, default=2000)
+    parser.add_argument(
+        "--latency", type=float, default=0.02,
+        help="Seconds the stand-in waits before answering each Publish RPC",
+    )
+    args = parser.parse_args()
+
+    standin = PubSubStandIn(latency=args.latency)
+    os.environ["PUBSUB_EMULATOR_HOST"] = standin.start()
+    os.environ.setdefault("PROJECT_NAME", "benchmark")
+
+    import event_handler
+    import sources
+
+    sources.get_secret = lambda project, name, version: SECRET
+    event_handler.app.testing = True
+    client = event_handler.app.test_client()
+
+    events = [payload(n, args.payload_bytes) for n in range(args.events)]
+    for name, run in (
+        ("one per request", lambda: one_per_request(client, events, args.threads)),
+        ("batches", lambda: batches(client, events, args.batch_size)),
+    ):
+        event_handler.DEDUPLICATOR = None
+        standin.reset()
+        # Silence the per-request log lines of the handler
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+        print(
+            f"{name:>16}: {args.events / elapsed * 60:10.0f} events/min, "
+            f"{standin.rpcs} Publish RPCs for {standin.messages} messages"
+        )
+
+    standin.stop()
+
+
+if __name__ == "__main__":
+    main()
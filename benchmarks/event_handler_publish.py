@@ -0,0 +1,115 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures webhook requests/sec through event_handler.index against a local
+Pub/Sub stand-in, comparing a new PublisherClient per request (the previous
+behaviour) with the shared batching publisher.
+
+    python benchmarks/event_handler_publish.py --requests 2000 --threads 8
+"""
+
+import argparse
+from concurrent import futures
+import contextlib
+import hmac
+from hashlib import sha1
+import io
+import json
+import os
+import sys
+import time
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "event-handler"))
+sys.path.insert(0, HERE)
+
+from pubsub_standin import PubSubStandIn  # noqa: E402
+
+SECRET = b"benchmark"
+
+
+def legacy_publish_to_pubsub(source, msg, headers):
+    from google.cloud import pubsub_v1
+
+    publisher = pubsub_v1.PublisherClient()
+    topic_path = publisher.topic_path(os.environ["PROJECT_NAME"], source)
+    future = publisher.publish(topic_path, data=msg, headers=json.dumps(headers))
+    future.result()
+
+
+def run(client, requests, threads, body):
+    headers = {
+        "User-Agent": "GitHub-Hookshot",
+        "X-Github-Event": "push",
+        "X-Hub-Signature": "sha1=" + hmac.new(SECRET, body, sha1).hexdigest(),
+    }
+
+    def send(_):
+        # Each request is a new delivery, so that the event handler does not
+        # drop it as a redelivery of the same body
+        delivery = {"X-GitHub-Delivery": str(uuid.uuid4())}
+        r = client.post("/", data=body, headers={**headers, **delivery})
+        assert r.status_code == 204, r.status_code
+
+    # Silence the per-request log lines of the handler
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(send, range(requests)))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--payload-bytes", type=int, default=10_000)
+    parser.add_argument(
+        "--latency", type=float, default=0.01,
+        help="Seconds the stand-in waits before answering each Publish RPC",
+    )
+    args = parser.parse_args()
+
+    standin = PubSubStandIn(latency=args.latency)
+    os.environ["PUBSUB_EMULATOR_HOST"] = standin.start()
+    os.environ.setdefault("PROJECT_NAME", "benchmark")
+
+    import event_handler
+    import sources
+
+    sources.get_secret = lambda project, name, version: SECRET
+    event_handler.app.testing = True
+    client = event_handler.app.test_client()
+    body = json.dumps({"padding": "x" * args.payload_bytes}).encode()
+
+    shared_publish = event_handler.publish_to_pubsub
+    for name, publish in (
+        ("client per request", legacy_publish_to_pubsub),
+        ("shared publisher", shared_publish),
+    ):
+        event_handler.publish_to_pubsub = publish
+        standin.reset()
+        elapsed = run(client, args.requests, args.threads, body)
+        print(
+            f"{name:>20}: {args.requests / elapsed:8.1f} req/s, "
+            f"{standin.rpcs} Publish RPCs for {standin.messages} messages"
+        )
+
+    standin.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Events/s of the GitHub parser for every supported event type: extracting the
+id and creation time with the compiled extractors of EVENTS vs. the chain of
+`if event_type == ...` blocks they replaced, on the same JsonView of the
+payload, and the whole of process_github_event.
+
+    python benchmarks/github_extractors.py --repeat 5000
+"""
+
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+sys.path.insert(0, HERE)
+
+from pubsub_compression import user  # noqa: E402
+
+import shared  # noqa: E402
+
+PARSER = os.path.join(HERE, "..", "bq-workers", "github-parser", "main.py")
+
+# Fields of each event type, next to the repository and sender every
+# GitHub payload has
+FIELDS = {
+    "push": {"ref": "refs/heads/main", "head_commit": {
+        "id": "f454a02b5d10fcccfd7d9dd7608a76d6493a98b4",
+        "timestamp": "2021-06-15T13:12:14+02:00", "message": "Fix", "author": user("alice"),
+    }},
+    "pull_request": {"action": "closed", "number": 477, "pull_request": {
+        "id": 1, "number": 477, "title": "Fix", "user": user("alice"),
+        "created_at": "2021-06-15T11:10:14Z", "updated_at": "2021-06-15T11:12:14Z",
+    }},
+    "pull_request_review": {"action": "submitted", "review": {
+        "id": 2, "user": user("bob"), "state": "approved", "submitted_at": "2021-06-15T11:12:14Z",
+    }},
+    "pull_request_review_comment": {"action": "created", "comment": {
+        "id": 3, "user": user("bob"), "body": "Nit", "updated_at": "2021-06-15T11:12:14Z",
+    }},
+    "issues": {"action": "opened", "issue": {
+        "id": 4, "number": 12, "title": "Incident", "labels": [{"name": "Incident"}],
+        "updated_at": "2021-06-15T11:12:14Z",
+    }},
+    "issue_comment": {"action": "created", "comment": {
+        "id": 5, "user": user("carol"), "body": "root cause: f454a02",
+        "updated_at": "2021-06-15T11:12:14Z",
+    }},
+    "check_run": {"action": "completed", "check_run": {
+        "id": 6, "name": "test", "status": "completed", "conclusion": "success",
+        "started_at": "2021-06-15T11:10:14Z", "completed_at": "2021-06-15T11:12:14Z",
+    }},
+    "check_suite": {"action": "completed", "check_suite": {
+        "id": 7, "status": "completed", "conclusion": "success",
+        "created_at": "2021-06-15T11:10:14Z", "updated_at": "2021-06-15T11:12:14Z",
+    }},
+    "status": {"id": 8, "sha": "f454a02", "state": "success", "updated_at": "2021-06-15T11:12:14Z"},
+    "deployment_status": {"action": "created", "deployment_status": {
+        "id": 9, "state": "success", "environment": "production",
+        "updated_at": "2021-06-15T11:12:14Z",
+    }, "deployment": {"id": 10, "sha": "f454a02", "environment": "production"}},
+    "release": {"action": "published", "release": {
+        "id": 11, "tag_name": "v1.0.0", "created_at": "2021-06-15T11:10:14Z",
+        "published_at": "2021-06-15T11:12:14Z",
+    }},
+}
+
+
+def if_chain(event_type, metadata):
+    """
+    The extraction the parser did before EVENTS
+    """
+    if event_type == "push":
+        time_created = metadata["head_commit"]["timestamp"]
+        e_id = metadata["head_commit"]["id"]
+    if event_type == "pull_request":
+        time_created = metadata["pull_request"]["updated_at"]
+        e_id = metadata["repository"]["name"] + "/" + str(metadata["number"])
+    if event_type == "pull_request_review":
+        time_created = metadata["review"]["submitted_at"]
+        e_id = metadata["review"]["id"]
+    if event_type == "pull_request_review_comment":
+        time_created = metadata["comment"]["updated_at"]
+        e_id = metadata["comment"]["id"]
+    if event_type == "issues":
+        time_created = metadata["issue"]["updated_at"]
+        e_id = metadata["repository"]["name"] + "/" + str(metadata["issue"]["number"])
+    if event_type == "issue_comment":
+        time_created = metadata["comment"]["updated_at"]
+        e_id = metadata["comment"]["id"]
+    if event_type == "check_run":
+        time_created = (metadata["check_run"]["completed_at"] or
+                        metadata["check_run"]["started_at"])
+        e_id = metadata["check_run"]["id"]
+    if event_type == "check_suite":
+        time_created = (metadata["check_suite"]["updated_at"] or
+                        metadata["check_suite"]["created_at"])
+        e_id = metadata["check_suite"]["id"]
+    if event_type == "deployment_status":
+        time_created = metadata["deployment_status"]["updated_at"]
+        e_id = metadata["deployment_status"]["id"]
+    if event_type == "status":
+        time_created = metadata["updated_at"]
+        e_id = metadata["id"]
+    if event_type == "release":
+        time_created = (metadata["release"]["published_at"] or
+                        metadata["release"]["created_at"])
+        e_id = metadata["release"]["id"]
+    return {"id": e_id, "time_created": time_created}
+
+
+def rate(function, repeat, rounds=5):
+    """
+    Returns the calls/s of the fastest of `rounds` rounds
+    """
+    function()
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return repeat / best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--repeat", type=int, default=5000)
+    args = parser.parse_args()
+
+    spec = importlib.util.spec_from_file_location("github_parser", PARSER)
+    github = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(github)
+    assert set(FIELDS) == set(github.EVENTS)
+
+    print(f"{'event type':>28} | {'if chain':>10} {'extractor':>10} | {'process_github_event':>20}")
+    for event_type, fields in FIELDS.items():
+        text = json.dumps({
+            **fields,
+            "repository": {"id": 1, "name": "fourkeys", "full_name": "example/fourkeys",
+                           "owner": user("example")},
+            "sender": {"login": "alice", "id": 2},
+        })
+        extract = github.EXTRACTORS[event_type]
+        assert extract(shared.JsonView(text)) == if_chain(event_type, shared.JsonView(text))
+        headers = {"X-Github-Event": event_type, "X-Hub-Signature": "sha1=0", "X-Team": "default"}
+        msg = {"data": base64.b64encode(text.encode()).decode(), "attributes": headers,
+               "message_id": "1"}
+
+        old = rate(lambda: if_chain(event_type, shared.JsonView(text)), args.repeat)
+        new = rate(lambda: extract(shared.JsonView(text)), args.repeat)
+        whole = rate(lambda: github.process_github_event(headers, msg), args.repeat)
+        print(f"{event_type:>28} | {old:8.0f}/s {new:8.0f}/s | {whole:18.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time per payload of the JSON work of the event handler and the parsers with
+each JSON_BACKEND: decoding the payload, encoding it again, encoding the log
+entry of a message that was not saved (which carries the whole Pub/Sub
+envelope), and the event signature, which must not change with the backend.
+
+Payloads are read per source from --payloads, a directory with a
+<source>.ndjson file of one payload per line for each source to measure,
+e.g. webhooks exported from BigQuery:
+
+    bq query --format=json --max_rows=1000 --use_legacy_sql=false \\
+        'SELECT metadata FROM four_keys.events_raw WHERE source = "github"' \\
+        | jq -c '.[].metadata | fromjson' > payloads/github.ndjson
+    python benchmarks/json_backend.py --payloads payloads
+
+Without --payloads, synthetic payloads of each source are used.
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+sys.path.insert(0, HERE)
+
+from pubsub_compression import synthetic_push, user  # noqa: E402
+from raw_payload import synthetic_pipeline  # noqa: E402
+
+import shared  # noqa: E402
+
+HEADERS = {
+    "github": {"X-Github-Event": "push", "X-Hub-Signature": "sha1=0"},
+    "gitlab": {"X-Gitlab-Event": "Pipeline Hook", "X-Gitlab-Token": "token"},
+    "jira": {"User-Agent": "Atlassian Webhook HTTP Client"},
+    "circleci": {"Circleci-Event-Type": "workflow-completed"},
+    "pagerduty": {"X-Pagerduty-Signature": "v1=0"},
+    "cloudbuild": {"buildId": "0"},
+    "tekton": {"Ce-Type": "dev.tekton.event.pipelinerun.successful.v1"},
+    "argocd": {"User-Agent": "argocd-notifications"},
+}
+
+
+def synthetic_payloads():
+    """
+    Returns source -> payloads with the shape of real ones
+    """
+    return {
+        "github": [synthetic_push(n) for n in (1, 5, 20, 100)],
+        "gitlab": [synthetic_pipeline(n) for n in (1, 5, 20, 100)],
+        "jira": [json.dumps({
+            "timestamp": 1623755534000,
+            "webhookEvent": "jira:issue_updated",
+            "user": user("alice"),
+            "issue": {
+                "id": "10002",
+                "self": "https://example.atlassian.net/rest/api/2/10002",
+                "key": "FK-2",
+                "fields": {
+                    "summary": "Deployments fail on Fridays",
+                    "description": "root cause: 4ba2d\n" + "Steps to reproduce. " * 40,
+                    "status": {"name": "Done", "statusCategory": {"key": "done"}},
+                    "labels": ["Incident"],
+                    "assignee": user("bob"),
+                    "reporter": user("alice"),
+                    "created": "2021-06-15T11:12:14.000+0200",
+                    "updated": "2021-06-15T13:12:14.000+0200",
+                },
+            },
+            "changelog": {"items": [{"field": "status", "fromString": "Open", "toString": "Done"}]},
+        }).encode()],
+        "circleci": [json.dumps({
+            "id": "3888f21b-eaa7-38e3-8f3d-75a63bba8895",
+            "type": "workflow-completed",
+            "happened_at": "2021-06-15T11:12:14.000Z",
+            "webhook": {"id": "cf8c4fdd-0587-4da1-b4ca-4846e9640af9", "name": "Four Keys"},
+            "project": {"id": "84996744", "name": "fourkeys", "slug": "gh/example/fourkeys"},
+            "organization": {"id": "f22b6566", "name": "example"},
+            "workflow": {
+                "id": "fda08377", "name": "deploy", "status": "success",
+                "created_at": "2021-06-15T11:10:02Z", "stopped_at": "2021-06-15T11:12:14Z",
+            },
+            "pipeline": {
+                "id": "1285fe1d", "number": 1205, "created_at": "2021-06-15T11:10:00Z",
+                "trigger": {"type": "webhook"},
+                "vcs": {
+                    "provider_name": "github", "origin_repository_url": "https://github.com/example/fourkeys",
+                    "revision": "f454a02b5d10fcccfd7d9dd7608a76d6493a98b4", "branch": "main",
+                    "commit": {"subject": "Fix flaky deployment check", "author": user("alice")},
+                },
+            },
+        }).encode()],
+        "pagerduty": [json.dumps({
+            "event": {
+                "id": "5ac64822-4adc-4fda-ade0-410becf0de4f",
+                "event_type": "incident.resolved",
+                "resource_type": "incident",
+                "occurred_at": "2021-06-15T11:12:14.000Z",
+                "agent": {"id": "PLH1HKV", "type": "user_reference"},
+                "data": {
+                    "id": "PGR0VU2", "type": "incident", "number": 2,
+                    "title": "Deployments fail on Fridays", "status": "resolved",
+                    "created_at": "2021-06-15T10:12:14Z", "urgency": "high",
+                    "service": {"id": "PF9KMXH", "summary": "API Service"},
+                    "html_url": "https://example.pagerduty.com/incidents/PGR0VU2",
+                },
+            },
+        }).encode()],
+        "cloudbuild": [json.dumps({
+            "id": "0bb6b9b0-44e3-4fc9-9a0a-0d8a0c1e7d4a",
+            "projectId": "fourkeys",
+            "status": "SUCCESS",
+            "source": {"repoSource": {"repoName": "fourkeys", "branchName": "main"}},
+            "steps": [
+                {"name": "gcr.io/cloud-builders/docker", "args": ["build", "-t", "gcr.io/fourkeys/app", "."],
+                 "timing": {"startTime": "2021-06-15T11:10:14Z", "endTime": "2021-06-15T11:12:00Z"},
+                 "status": "SUCCESS"}
+                for _ in range(5)
+            ],
+            "createTime": "2021-06-15T11:10:02Z",
+            "startTime": "2021-06-15T11:10:14Z",
+            "finishTime": "2021-06-15T11:12:14Z",
+            "substitutions": {"COMMIT_SHA": "f454a02b5d10fcccfd7d9dd7608a76d6493a98b4", "BRANCH_NAME": "main"},
+            "logUrl": "https://console.cloud.google.com/cloud-build/builds/0bb6b9b0",
+        }).encode()],
+        "tekton": [json.dumps({
+            "pipelineRun": {
+                "metadata": {"name": "deploy-run-x7k2p", "namespace": "default", "uid": "6a8b"},
+                "spec": {"params": [{"name": "gitrevision", "value": "f454a02b5d10fcccfd7d9dd7608a76d6493a98b4"}]},
+                "status": {
+                    "startTime": "2021-06-15T11:10:14Z",
+                    "completionTime": "2021-06-15T11:12:14Z",
+                    "conditions": [{"type": "Succeeded", "status": "True", "reason": "Succeeded"}],
+                    "taskRuns": {
+                        f"deploy-run-x7k2p-{step}": {
+                            "pipelineTaskName": step,
+                            "status": {"podName": f"deploy-run-x7k2p-{step}-pod", "steps": [{"name": step}]},
+                        }
+                        for step in ("clone", "build", "test", "deploy")
+                    },
+                },
+            },
+        }).encode()],
+        "argocd": [json.dumps({
+            "id": "f454a02b5d10fcccfd7d9dd7608a76d6493a98b4",
+            "time": "2021-06-15T11:12:14Z",
+            "app": "fourkeys",
+            "status": "Synced",
+            "health": "Healthy",
+        }).encode()],
+    }
+
+
+def load_payloads(directory):
+    payloads = {}
+    for name in sorted(os.listdir(directory)):
+        source, extension = os.path.splitext(name)
+        if extension != ".ndjson":
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            payloads[source] = [line.strip() for line in f if line.strip()]
+    return payloads
+
+
+def per_call(function, repeat):
+    function()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def measure(source, payloads, repeat):
+    """
+    Returns operation -> seconds per payload, and the signatures
+    """
+    totals = {"loads": 0.0, "dumps": 0.0, "log entry": 0.0, "signature": 0.0}
+    signatures = []
+    for data in payloads:
+        parsed = shared.json_loads(data)
+        msg = {
+            "data": base64.b64encode(data).decode(),
+            "attributes": {**HEADERS.get(source, {}), "X-Team": "default"},
+            "message_id": "1",
+            "publishTime": "2021-06-15T11:12:14Z",
+        }
+        entry = {
+            "severity": "WARNING",
+            "msg": "Data not saved to BigQuery",
+            "errors": "Unsupported event",
+            "json_payload": {"message": msg, "subscription": f"projects/p/subscriptions/{source}"},
+        }
+        totals["loads"] += per_call(lambda: shared.json_loads(data), repeat)
+        totals["dumps"] += per_call(lambda: shared.json_dumps(parsed), repeat)
+        totals["log entry"] += per_call(lambda: shared.json_dumps(entry), repeat)
+        totals["signature"] += per_call(lambda: shared.create_unique_id(msg), repeat)
+        signatures.append(shared.create_unique_id(msg))
+    return {k: v / len(payloads) for k, v in totals.items()}, signatures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--payloads", help="Directory of <source>.ndjson files")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    orjson = shared.load_orjson("orjson")
+    payloads = load_payloads(args.payloads) if args.payloads else synthetic_payloads()
+    operations = ("loads", "dumps", "log entry", "signature")
+    print(f"orjson {orjson.__version__}, microseconds per payload, json -> orjson")
+    print(f"{'source':>10} {'payloads':>8} {'avg size':>9} | " + " | ".join(
+        f"{operation:^19}" for operation in operations
+    ))
+    for source, data in payloads.items():
+        results = {}
+        for name, backend in (("json", None), ("orjson", orjson)):
+            shared._orjson = backend
+            results[name] = measure(source, data, args.repeat)
+        # Signatures are encoded by the json module with either backend
+        assert results["json"][1] == results["orjson"][1], source
+        size = sum(len(d) for d in data) / len(data)
+        print(f"{source:>10} {len(data):>8} {size / 1024:7.1f}KB | " + " | ".join(
+            f"{results['json'][0][op] * 1e6:7.1f} -> {results['orjson'][0][op] * 1e6:7.1f}"
+            for op in operations
+        ))
+    shared._orjson = orjson
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pub/Sub bytes saved vs. CPU spent by each PUBSUB_COMPRESSION setting.
+
+Payloads are read from --payloads, either a directory of JSON files or a
+file with one JSON payload per line, e.g. webhooks exported from BigQuery:
+
+    bq query --format=json --max_rows=1000 --use_legacy_sql=false \\
+        'SELECT metadata FROM four_keys.events_raw WHERE source = "github"' \\
+        | jq -c '.[].metadata | fromjson' > github.ndjson
+    python benchmarks/pubsub_compression.py --payloads github.ndjson
+
+Without --payloads, synthetic GitHub push payloads of 1 to 200 commits are
+used. Compression runs through event-handler/compression.py and
+decompression through shared/shared.py, as in production.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import secrets
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "event-handler"))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+
+import compression  # noqa: E402
+import shared  # noqa: E402
+
+SETTINGS = [
+    ("", None),
+    ("gzip", 1), ("gzip", 6), ("gzip", 9),
+    ("zstd", 1), ("zstd", 3), ("zstd", 9),
+]
+
+
+def load_payloads(path):
+    if os.path.isdir(path):
+        payloads = []
+        for name in sorted(os.listdir(path)):
+            with open(os.path.join(path, name), "rb") as f:
+                payloads.append(f.read().strip())
+        return payloads
+    with open(path, "rb") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def user(name):
+    return {
+        "name": name,
+        "email": f"{name}@example.com",
+        "username": name,
+    }
+
+
+def synthetic_push(num_commits):
+    """
+    Returns a GitHub push payload with the shape and field sizes of a real one
+    """
+    repository = {
+        "id": random.randrange(10 ** 8),
+        "name": "fourkeys",
+        "full_name": "example/fourkeys",
+        "private": False,
+        "owner": user("example"),
+        "html_url": "https://github.com/example/fourkeys",
+        "description": "Platform for monitoring the four key software delivery metrics",
+        **{
+            f"{field}_url": f"https://api.github.com/repos/example/fourkeys/{field}{{/number}}"
+            for field in (
+                "archive", "assignees", "blobs", "branches", "collaborators",
+                "comments", "commits", "compare", "contents", "contributors",
+                "deployments", "downloads", "events", "forks", "git_commits",
+                "git_refs", "git_tags", "hooks", "issue_comment", "issue_events",
+                "issues", "keys", "labels", "languages", "merges", "milestones",
+                "notifications", "pulls", "releases", "stargazers", "statuses",
+                "subscribers", "subscription", "tags", "teams", "trees",
+            )
+        },
+    }
+    commits = []
+    for _ in range(num_commits):
+        sha = secrets.token_hex(20)
+        author = user(random.choice(["alice", "bob", "carol", "dave"]))
+        commits.append({
+            "id": sha,
+            "tree_id": secrets.token_hex(20),
+            "distinct": True,
+            "message": "Fix flaky deployment check\n\n" + "Details. " * random.randrange(1, 30),
+            "timestamp": "2021-06-15T13:12:14+02:00",
+            "url": f"https://github.com/example/fourkeys/commit/{sha}",
+            "author": author,
+            "committer": author,
+            "added": [f"src/module_{random.randrange(100)}.py" for _ in range(random.randrange(3))],
+            "removed": [],
+            "modified": [f"src/module_{random.randrange(100)}.py" for _ in range(random.randrange(1, 8))],
+        })
+    return json.dumps({
+        "ref": "refs/heads/main",
+        "before": secrets.token_hex(20),
+        "after": commits[-1]["id"],
+        "repository": repository,
+        "pusher": user("alice"),
+        "sender": {"login": "alice", "id": random.randrange(10 ** 7)},
+        "commits": commits,
+        "head_commit": commits[-1],
+    }).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--payloads", help="Directory of JSON files or NDJSON file")
+    parser.add_argument("--count", type=int, default=300,
+                        help="Number of synthetic payloads")
+    parser.add_argument("--min-bytes", type=int, default=compression.MIN_BYTES,
+                        help="PUBSUB_COMPRESSION_MIN_BYTES")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.payloads:
+        payloads = load_payloads(args.payloads)
+    else:
+        random.seed(0)
+        payloads = [synthetic_push(random.randint(1, 200)) for _ in range(args.count)]
+
+    total = sum(len(p) for p in payloads)
+    print(
+        f"{len(payloads)} payloads, {total / 1024 / 1024:.1f} MB, "
+        f"{total // len(payloads) // 1024} KB on average, "
+        f"threshold {args.min_bytes} bytes"
+    )
+    print(
+        f"{'setting':>8} {'published':>11} {'saved':>7} {'skipped':>8} "
+        f"{'compress':>14} {'decompress':>16}"
+    )
+
+    for encoding, level in SETTINGS:
+        compress_seconds = decompress_seconds = 0.0
+        for _ in range(args.rounds):
+            published = skipped = 0
+            messages = []
+            start = time.process_time()
+            for payload in payloads:
+                data, used = compression.compress(payload, encoding, args.min_bytes, level)
+                published += len(data)
+                skipped += used is None
+                messages.append((data, used))
+            compress_seconds += time.process_time() - start
+
+            # Messages reach the parsers base64 encoded in the push request
+            messages = [
+                {
+                    "data": base64.b64encode(data),
+                    "attributes": {"content-encoding": used} if used else {},
+                }
+                for data, used in messages
+            ]
+            start = time.process_time()
+            for msg in messages:
+                shared.decode_data(msg)
+            decompress_seconds += time.process_time() - start
+
+        per_message = 1e6 / (len(payloads) * args.rounds)
+        setting = f"{encoding}-{level}" if encoding else "none"
+        print(
+            f"{setting:>8} "
+            f"{published / 1024 / 1024:8.2f} MB {100 - published * 100 / total:6.1f}% "
+            f"{skipped:8d} "
+            f"{compress_seconds * per_message:8.0f} us/msg "
+            f"{decompress_seconds * per_message:8.0f} us/msg"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process stand-in for the Pub/Sub API.
+
+It serves the `google.pubsub.v1.Publisher` CreateTopic and Publish gRPC
+methods, answering each publish after a configurable delay, and counts RPCs
+and messages. Messages published to a topic with subscriptions are delivered
+by the `google.pubsub.v1.Subscriber` CreateSubscription, StreamingPull,
+Acknowledge and ModifyAckDeadline methods: leased messages are delivered
+again once they are nacked or their ack deadline passes. Point the client
+libraries at it the same way as at the Pub/Sub emulator:
+
+    standin = PubSubStandIn(latency=0.02)
+    os.environ["PUBSUB_EMULATOR_HOST"] = standin.start()
+"""
+
+from concurrent import futures
+import collections
+import datetime
+import itertools
+import threading
+import time
+
+import grpc
+from google.protobuf import empty_pb2
+from google.pubsub_v1 import types
+
+
+class PubSubStandIn(object):
+    def __init__(self, latency: float = 0.0, max_workers: int = 32):
+        self.latency = latency
+        self.rpcs = 0
+        self.messages = 0
+        self.bytes = 0
+        self.acked = 0
+        self.nacked = 0
+        # Topic -> subscription names
+        self._topics = collections.defaultdict(list)
+        self._subscriptions = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Condition()
+        self._server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=max_workers)
+        )
+        publisher = grpc.method_handlers_generic_handler(
+            "google.pubsub.v1.Publisher",
+            {
+                "CreateTopic": grpc.unary_unary_rpc_method_handler(
+                    self._create_topic,
+                    request_deserializer=types.Topic.deserialize,
+                    response_serializer=types.Topic.serialize,
+                ),
+                "Publish": grpc.unary_unary_rpc_method_handler(
+                    self._publish,
+                    request_deserializer=types.PublishRequest.deserialize,
+                    response_serializer=types.PublishResponse.serialize,
+                ),
+            },
+        )
+        subscriber = grpc.method_handlers_generic_handler(
+            "google.pubsub.v1.Subscriber",
+            {
+                "CreateSubscription": grpc.unary_unary_rpc_method_handler(
+                    self._create_subscription,
+                    request_deserializer=types.Subscription.deserialize,
+                    response_serializer=types.Subscription.serialize,
+                ),
+                "StreamingPull": grpc.stream_stream_rpc_method_handler(
+                    self._streaming_pull,
+                    request_deserializer=types.StreamingPullRequest.deserialize,
+                    response_serializer=types.StreamingPullResponse.serialize,
+                ),
+                "Acknowledge": grpc.unary_unary_rpc_method_handler(
+                    self._acknowledge,
+                    request_deserializer=types.AcknowledgeRequest.deserialize,
+                    response_serializer=empty_pb2.Empty.SerializeToString,
+                ),
+                "ModifyAckDeadline": grpc.unary_unary_rpc_method_handler(
+                    self._modify_ack_deadline,
+                    request_deserializer=types.ModifyAckDeadlineRequest.deserialize,
+                    response_serializer=empty_pb2.Empty.SerializeToString,
+                ),
+            },
+        )
+        self._server.add_generic_rpc_handlers((publisher, subscriber))
+
+    def start(self) -> str:
+        """
+        Starts the server and returns its host:port
+        """
+        port = self._server.add_insecure_port("127.0.0.1:0")
+        self._server.start()
+        return f"127.0.0.1:{port}"
+
+    def stop(self):
+        self._server.stop(None)
+
+    def reset(self):
+        with self._lock:
+            self.rpcs = self.messages = self.bytes = 0
+            self.acked = self.nacked = 0
+
+    def _create_topic(self, request, context):
+        with self._lock:
+            self._topics.setdefault(request.name, [])
+        return types.Topic(name=request.name)
+
+    def _publish(self, request, context):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.rpcs += 1
+            self.messages += len(request.messages)
+            self.bytes += sum(len(m.data) for m in request.messages)
+            ids = [str(next(self._ids)) for _ in request.messages]
+            now = datetime.datetime.now(datetime.timezone.utc)
+            for name in self._topics.get(request.topic, ()):
+                subscription = self._subscriptions[name]
+                for message, message_id in zip(request.messages, ids):
+                    delivered = types.PubsubMessage(
+                        data=message.data,
+                        attributes=dict(message.attributes),
+                        message_id=message_id,
+                        publish_time=now,
+                    )
+                    subscription["available"].append(delivered)
+            self._lock.notify_all()
+        return types.PublishResponse(message_ids=ids)
+
+    def _create_subscription(self, request, context):
+        with self._lock:
+            self._topics[request.topic].append(request.name)
+            self._subscriptions[request.name] = {
+                "ack_deadline": request.ack_deadline_seconds or 10,
+                "available": collections.deque(),
+                # Ack ID -> (message, deadline)
+                "leased": {},
+            }
+        return types.Subscription(
+            name=request.name,
+            topic=request.topic,
+            ack_deadline_seconds=request.ack_deadline_seconds or 10,
+        )
+
+    def _streaming_pull(self, requests, context):
+        first = next(requests)
+        subscription = self._subscriptions[first.subscription]
+        max_outstanding = first.max_outstanding_messages or 1000
+        ack_deadline = first.stream_ack_deadline_seconds or subscription["ack_deadline"]
+
+        def read():
+            # Acks and deadline changes may also come on the stream
+            try:
+                for request in requests:
+                    self._settle(subscription, request.ack_ids, 0, ack=True)
+                    for ack_id, seconds in zip(
+                        request.modify_deadline_ack_ids, request.modify_deadline_seconds
+                    ):
+                        self._settle(subscription, [ack_id], seconds)
+            except grpc.RpcError:
+                # The client closed the stream
+                pass
+
+        threading.Thread(target=read, daemon=True).start()
+        while context.is_active():
+            received = []
+            with self._lock:
+                self._expire(subscription)
+                room = max_outstanding - len(subscription["leased"])
+                while room > 0 and subscription["available"]:
+                    message = subscription["available"].popleft()
+                    ack_id = f"{message.message_id}-{next(self._ids)}"
+                    subscription["leased"][ack_id] = (message, time.monotonic() + ack_deadline)
+                    received.append(types.ReceivedMessage(ack_id=ack_id, message=message))
+                    room -= 1
+                if not received:
+                    self._lock.wait(0.1)
+                    continue
+            yield types.StreamingPullResponse(received_messages=received)
+
+    def _acknowledge(self, request, context):
+        self._settle(self._subscriptions[request.subscription], request.ack_ids, 0, ack=True)
+        return empty_pb2.Empty()
+
+    def _modify_ack_deadline(self, request, context):
+        self._settle(
+            self._subscriptions[request.subscription],
+            request.ack_ids,
+            request.ack_deadline_seconds,
+        )
+        return empty_pb2.Empty()
+
+    def _settle(self, subscription, ack_ids, seconds, ack=False):
+        with self._lock:
+            for ack_id in ack_ids:
+                lease = subscription["leased"].get(ack_id)
+                if lease is None:
+                    continue
+                if ack:
+                    del subscription["leased"][ack_id]
+                    self.acked += 1
+                elif seconds == 0:
+                    # A nack: deliver the message again
+                    del subscription["leased"][ack_id]
+                    subscription["available"].append(lease[0])
+                    self.nacked += 1
+                else:
+                    subscription["leased"][ack_id] = (lease[0], time.monotonic() + seconds)
+            self._lock.notify_all()
+
+    @staticmethod
+    def _expire(subscription):
+        # Called with self._lock held
+        now = time.monotonic()
+        for ack_id, (message, deadline) in list(subscription["leased"].items()):
+            if deadline <= now:
+                del subscription["leased"][ack_id]
+                subscription["available"].append(message)
@@ -0,0 +1,186 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Messages/s the GitHub parser inserts into events_raw when Pub/Sub pushes
+each message in its own request, sent from concurrent threads as to a
+gunicorn worker, vs. the consumer mode pulling them in batches with
+streaming pull. Both insert into a local BigQuery stand-in and pull from a
+local Pub/Sub stand-in, or from the Pub/Sub emulator if PUBSUB_EMULATOR_HOST
+is set.
+
+    python benchmarks/pull_consumer.py --events 5000 --threads 8
+"""
+
+import argparse
+import base64
+from concurrent import futures
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+sys.path.insert(0, HERE)
+
+from bigquery_standin import BigQueryStandIn  # noqa: E402
+from pubsub_standin import PubSubStandIn  # noqa: E402
+
+import shared  # noqa: E402
+
+PARSER = os.path.join(HERE, "..", "bq-workers", "github-parser", "main.py")
+
+
+def load_parser():
+    spec = importlib.util.spec_from_file_location("github_parser", PARSER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def push_event(run, number):
+    """
+    Returns the data and attributes of a GitHub push event, as the event
+    handler publishes it
+    """
+    data = json.dumps({
+        "ref": "refs/heads/main",
+        "head_commit": {
+            "id": f"{number:040x}",
+            "timestamp": "2021-06-15T11:12:14Z",
+            "message": "Benchmark commit",
+        },
+        "repository": {"name": "fourkeys"},
+    }).encode()
+    attributes = {
+        "X-Github-Event": "push",
+        "X-Hub-Signature": f"{run}-{number:040x}",
+        "X-Team": "default",
+    }
+    return data, attributes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8,
+                        help="Push requests served at once, as gunicorn --threads")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Seconds the BigQuery stand-in waits per request")
+    parser.add_argument("--batch-size", type=int, default=shared.PULL_BATCH_SIZE)
+    args = parser.parse_args()
+
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import bigquery, pubsub_v1
+
+    bigquery_standin = BigQueryStandIn(latency=args.latency)
+    shared._client = bigquery.Client(
+        project="benchmark",
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": bigquery_standin.start()},
+    )
+    directory = tempfile.mkdtemp(prefix="pull-consumer-")
+    shared._deduplicator = shared.Deduplicator(
+        shared.SQLiteStore(os.path.join(directory, "dedup.sqlite3"))
+    )
+    shared.get_table("events_raw")
+    pubsub_standin = None
+    if not os.environ.get("PUBSUB_EMULATOR_HOST"):
+        pubsub_standin = PubSubStandIn()
+        os.environ["PUBSUB_EMULATOR_HOST"] = pubsub_standin.start()
+    github = load_parser()
+
+    print(
+        f"{args.events} GitHub push events, "
+        f"{args.latency * 1000:g} ms per BigQuery request, "
+        f"Pub/Sub at {os.environ['PUBSUB_EMULATOR_HOST']}"
+    )
+
+    # Push: a request per message
+    app = github.app.test_client()
+    envelopes = []
+    for number in range(args.events):
+        data, attributes = push_event("push", number)
+        envelopes.append({"message": {
+            "data": base64.b64encode(data).decode(),
+            "attributes": attributes,
+            "message_id": str(number),
+        }})
+    bigquery_standin.reset()
+    with futures.ThreadPoolExecutor(max_workers=args.threads) as pool:
+        start = time.perf_counter()
+        statuses = list(pool.map(lambda e: app.post("/", json=e).status_code, envelopes))
+        elapsed = time.perf_counter() - start
+    shared.flush_writer()
+    assert set(statuses) == {204}, set(statuses)
+    assert bigquery_standin.rows == args.events, bigquery_standin.rows
+    requests = bigquery_standin.requests["tables.insertAll"]
+    print(
+        f"{'push, ' + str(args.threads) + ' threads':>24}: "
+        f"{args.events / elapsed:7.0f} messages/s, {args.events} HTTP requests, "
+        f"{requests} insertAll requests"
+    )
+
+    # Pull: batches from a streaming pull
+    publisher = pubsub_v1.PublisherClient(
+        batch_settings=pubsub_v1.types.BatchSettings(max_messages=1000)
+    )
+    subscriber = pubsub_v1.SubscriberClient()
+    topic = publisher.topic_path("benchmark", f"github-{os.getpid()}")
+    subscription = subscriber.subscription_path("benchmark", f"github-{os.getpid()}")
+    publisher.create_topic(name=topic)
+    subscriber.create_subscription(name=subscription, topic=topic)
+    published = [
+        publisher.publish(topic, data, **attributes)
+        for data, attributes in (push_event("pull", n) for n in range(args.events))
+    ]
+    for future in published:
+        future.result()
+
+    bigquery_standin.reset()
+    consumer = shared.PullConsumer(
+        subscription, github.process_message, subscriber=subscriber,
+        batch_size=args.batch_size,
+    )
+    start = time.perf_counter()
+    thread = threading.Thread(target=consumer.run)
+    thread.start()
+    while consumer.acked + consumer.nacked < args.events:
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    consumer.stop()
+    thread.join()
+    assert bigquery_standin.rows == args.events, bigquery_standin.rows
+    requests = bigquery_standin.requests["tables.insertAll"]
+    print(
+        f"{'pull, batches of ' + str(args.batch_size):>24}: "
+        f"{args.events / elapsed:7.0f} messages/s, "
+        f"{consumer.acked} acked, {consumer.nacked} nacked, "
+        f"{requests} insertAll requests"
+    )
+
+    shared.close_writer()
+    bigquery_standin.stop()
+    if pubsub_standin is not None:
+        pubsub_standin.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+CPU time and peak memory per event of the GitHub and GitLab parsers, which
+store the payload as received and read their fields through shared.JsonView,
+vs. parsing the whole payload with json.loads and serializing it again with
+json.dumps for the metadata column, as they used to. Payloads are synthetic
+GitHub pushes and GitLab pipelines of growing size.
+
+    python benchmarks/raw_payload.py --repeat 200
+"""
+
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import random
+import secrets
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "shared"))
+sys.path.insert(0, HERE)
+
+from pubsub_compression import synthetic_push, user  # noqa: E402
+
+import shared  # noqa: E402
+
+PARSERS = os.path.join(HERE, "..", "bq-workers")
+
+
+def load_parser(directory):
+    spec = importlib.util.spec_from_file_location(
+        directory.replace("-", "_"), os.path.join(PARSERS, directory, "main.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_pipeline(num_builds):
+    """
+    Returns a GitLab pipeline payload with the shape and field sizes of a real
+    one
+    """
+    sha = secrets.token_hex(20)
+    project = {
+        "id": random.randrange(10 ** 7),
+        "name": "fourkeys",
+        "description": "Platform for monitoring the four key software delivery metrics",
+        "web_url": "https://gitlab.com/example/fourkeys",
+        "git_ssh_url": "git@gitlab.com:example/fourkeys.git",
+        "git_http_url": "https://gitlab.com/example/fourkeys.git",
+        "namespace": "example",
+        "visibility_level": 20,
+        "path_with_namespace": "example/fourkeys",
+        "default_branch": "main",
+    }
+    builds = []
+    for number in range(num_builds):
+        builds.append({
+            "id": random.randrange(10 ** 9),
+            "stage": random.choice(["build", "test", "deploy"]),
+            "name": f"job-{number}",
+            "status": "success",
+            "created_at": "2021-06-15 11:10:02 UTC",
+            "started_at": "2021-06-15 11:10:14 UTC",
+            "finished_at": "2021-06-15 11:12:14 UTC",
+            "duration": random.uniform(10, 600),
+            "queued_duration": random.uniform(0, 30),
+            "when": "on_success",
+            "manual": False,
+            "allow_failure": False,
+            "user": user(random.choice(["alice", "bob", "carol", "dave"])),
+            "runner": {
+                "id": random.randrange(10 ** 6),
+                "description": "shared-runners-manager-6.gitlab.com",
+                "runner_type": "instance_type",
+                "active": True,
+                "is_shared": True,
+                "tags": ["gce", "east-c", "linux", "docker"],
+            },
+            "artifacts_file": {"filename": None, "size": None},
+            "environment": None,
+        })
+    return json.dumps({
+        "object_kind": "pipeline",
+        "object_attributes": {
+            "id": random.randrange(10 ** 9),
+            "ref": "main",
+            "tag": False,
+            "sha": sha,
+            "before_sha": secrets.token_hex(20),
+            "source": "push",
+            "status": "success",
+            "stages": ["build", "test", "deploy"],
+            "created_at": "2021-06-15 11:10:02 UTC",
+            "finished_at": "2021-06-15 11:12:14 UTC",
+            "duration": 132,
+            "variables": [],
+        },
+        "merge_request": None,
+        "user": user("alice"),
+        "project": project,
+        "commit": {
+            "id": sha,
+            "message": "Fix flaky deployment check\n\n" + "Details. " * 20,
+            "timestamp": "2021-06-15T13:12:14+02:00",
+            "url": f"https://gitlab.com/example/fourkeys/-/commit/{sha}",
+            "author": user("alice"),
+        },
+        "builds": builds,
+    }).encode()
+
+
+def parse_and_serialize(text):
+    """
+    What the parsers used to do with a payload: parse all of it, and serialize
+    it again for the metadata column
+    """
+    metadata = json.loads(text)
+    json.dumps(metadata)
+    return metadata
+
+
+def measure(function, msg, repeat):
+    """
+    Returns the CPU seconds and peak bytes allocated per call
+    """
+    function(msg)
+    start = time.process_time()
+    for _ in range(repeat):
+        function(msg)
+    cpu = (time.process_time() - start) / repeat
+    tracemalloc.start()
+    function(msg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    JsonView = shared.JsonView
+    github = load_parser("github-parser")
+    gitlab = load_parser("gitlab-parser")
+    cases = [
+        (f"GitHub push, {n} commits", github.process_message, synthetic_push(n),
+         {"X-Github-Event": "push", "X-Hub-Signature": "sha1=0", "X-Team": "default"})
+        for n in (1, 20, 200, 2000)
+    ] + [
+        (f"GitLab pipeline, {n} jobs", gitlab.process_message, synthetic_pipeline(n),
+         {"X-Gitlab-Event": "Pipeline Hook", "X-Team": "default"})
+        for n in (1, 20, 200, 2000)
+    ]
+
+    print(f"{'payload':>28} {'size':>9} | {'json.loads + dumps':>22} | {'JsonView, raw text':>22}")
+    for name, process_message, data, attributes in cases:
+        msg = {
+            "data": base64.b64encode(data).decode(),
+            "attributes": attributes,
+            "message_id": "1",
+            "publishTime": "2021-06-15T11:12:14Z",
+        }
+        event = process_message(msg)
+        assert event["metadata"] == data.decode(), name
+
+        # The parsers as they used to be
+        shared.JsonView = parse_and_serialize
+        old_cpu, old_peak = measure(process_message, msg, args.repeat)
+        shared.JsonView = JsonView
+        new_cpu, new_peak = measure(process_message, msg, args.repeat)
+        print(
+            f"{name:>28} {len(data) / 1024:7.1f}KB | "
+            f"{old_cpu * 1e6:8.0f} us {old_peak / 1024:8.0f} KB | "
+            f"{new_cpu * 1e6:8.0f} us {new_peak / 1024:8.0f} KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process stand-in for a Redis server, speaking enough of the RESP protocol
+for the dedup store: PING, SELECT, EXISTS, GET, SET (with NX), DEL and SCAN.
+Replies are sent after a configurable delay per round trip. Point a client
+at it with:
+
+    standin = RedisStandIn(latency=0.0005)
+    client = redis.Redis.from_url(standin.start())
+"""
+
+import collections
+import fnmatch
+import socket
+import socketserver
+import threading
+import time
+
+
+class RedisStandIn(object):
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.data = {}
+        self.commands = collections.Counter()
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    def start(self) -> str:
+        """
+        Starts the server and returns its URL
+        """
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"redis://127.0.0.1:{self._server.server_address[1]}/0"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.commands.clear()
+
+    def execute(self, command, *args):
+        name = command.decode().upper()
+        with self._lock:
+            self.commands[name] += 1
+            if name == "PING":
+                return "PONG"
+            if name == "SELECT":
+                return "OK"
+            if name == "EXISTS":
+                return sum(key in self.data for key in args)
+            if name == "GET":
+                return self.data.get(args[0])
+            if name == "SET":
+                key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+                if b"NX" in options and key in self.data:
+                    return None
+                self.data[key] = value
+                return "OK"
+            if name == "DEL":
+                return sum(self.data.pop(key, None) is not None for key in args)
+            if name == "SCAN":
+                # SCAN cursor [MATCH pattern] [COUNT count]
+                options = {args[i].upper(): args[i + 1] for i in range(1, len(args) - 1, 2)}
+                pattern = options.get(b"MATCH", b"*").decode()
+                keys = [k for k in self.data if fnmatch.fnmatchcase(k.decode(), pattern)]
+                # Everything in one page
+                return [b"0", keys]
+        return Exception(f"ERR unknown command '{name}'")
+
+    def _handler(self):
+        standin = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                buffer = b""
+                while True:
+                    data = self.request.recv(65536)
+                    if not data:
+                        return
+                    buffer += data
+                    commands, buffer = parse(buffer)
+                    if not commands:
+                        continue
+                    replies = b"".join(encode(standin.execute(*c)) for c in commands)
+                    # One delay per round trip, so pipelined commands share it
+                    if standin.latency:
+                        time.sleep(standin.latency)
+                    self.request.sendall(replies)
+
+        return Handler
+
+
+def parse(buffer: bytes):
+    """
+    Splits the complete commands off the start of the buffer
+    """
+    commands = []
+    start = 0
+    while True:
+        command, end = parse_command(buffer, start)
+        if command is None:
+            return commands, buffer[start:]
+        commands.append(command)
+        start = end
+
+
+def parse_command(buffer: bytes, start: int):
+    line_end = buffer.find(b"\r\n", start)
+    if line_end < 0:
+        return None, start
+    if buffer[start:start + 1] != b"*":
+        # Inline command
+        return buffer[start:line_end].split(), line_end + 2
+    args = []
+    count = int(buffer[start + 1:line_end])
+    position = line_end + 2
+    for _ in range(count):
+        line_end = buffer.find(b"\r\n", position)
+        if line_end < 0:
+            return None, start
+        length = int(buffer[position + 1:line_end])
+        value, position = line_end + 2, line_end + 2 + length + 2
+        if position > len(buffer):
+            return None, start
+        args.append(buffer[value:value + length])
+    return args, position
+
+
+def encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, Exception):
+        return f"-{reply}\r\n".encode()
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(encode(item) for item in reply)
@@ -0,0 +1,249 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cold start of event_handler:app and each bq-workers/*/main:app.
+
+Every run starts a fresh interpreter with `python -X importtime`, imports the
+app, calls /healthz and, for the event handler, sends a signed GitHub push
+through the Pub/Sub stand-in. It reports the median of --runs runs of:
+
+    import   importing the app module
+    warm-up  the first /healthz request, which creates the clients
+    ready    interpreter start to /healthz answered
+    webhook  the first webhook, after /healthz or, with "cold", without it
+
+"eager" runs import the Google client libraries before the app, as the app
+modules did before the imports were deferred. The slowest top-level imports
+of the last lazy run are listed from the -X importtime output.
+
+Clients are created from a generated service account key, so no network is
+used. The default secret is served locally instead of by Secret Manager, and
+the parsers' dedup store is not loaded from BigQuery.
+"""
+
+import argparse
+import hmac
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from hashlib import sha1
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+SECRET = b"benchmark"
+MARKER = "startup-benchmark: importing app"
+
+# What the app modules imported at the top before the imports were deferred
+EAGER_IMPORTS = {
+    "event_handler": ("google.cloud.pubsub_v1", "google.cloud.secretmanager"),
+    "main": ("google.cloud.bigquery",),
+}
+
+
+def targets():
+    yield "event-handler", os.path.join(ROOT, "event-handler"), "event_handler"
+    workers = os.path.join(ROOT, "bq-workers")
+    for name in sorted(os.listdir(workers)):
+        if os.path.exists(os.path.join(workers, name, "main.py")):
+            yield name, os.path.join(workers, name), "main"
+
+
+def service_account_key(path):
+    """
+    Writes a service account key that the client libraries accept without
+    reaching Google
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    with open(path, "w") as f:
+        json.dump({
+            "type": "service_account",
+            "project_id": "benchmark",
+            "private_key_id": "benchmark",
+            "private_key": pem,
+            "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+            "client_id": "1",
+            "token_uri": "https://oauth2.googleapis.com/token",
+        }, f)
+
+
+def child(args):
+    """
+    Runs in the measured interpreter and prints its timings as JSON
+    """
+    import importlib
+
+    started = float(args.started)
+    sys.path.insert(0, os.getcwd())
+    print(MARKER, file=sys.stderr, flush=True)
+
+    t0 = time.time()
+    if args.eager:
+        for name in EAGER_IMPORTS[args.module]:
+            importlib.import_module(name)
+    module = importlib.import_module(args.module)
+    t1 = time.time()
+
+    if args.module == "event_handler":
+        import sources
+
+        sources.get_secret = lambda project, name, version: SECRET
+    client = module.app.test_client()
+
+    result = {"import": t1 - t0}
+    if not args.cold:
+        response = client.get("/healthz")
+        assert response.status_code == 200, response.status_code
+        t2 = time.time()
+        result.update(warm_up=t2 - t1, ready=t2 - started)
+
+    if args.module == "event_handler":
+        body = json.dumps({"ref": "refs/heads/main", "commits": []}).encode()
+        headers = {
+            "User-Agent": "GitHub-Hookshot",
+            "X-Github-Event": "push",
+            "X-Hub-Signature": "sha1=" + hmac.new(SECRET, body, sha1).hexdigest(),
+        }
+        t3 = time.time()
+        response = client.post("/", data=body, headers=headers)
+        assert response.status_code == 204, response.status_code
+        result["webhook"] = time.time() - t3
+
+    sys.stdout.flush()
+    # Keeps the result apart from the request log lines
+    print("\n" + json.dumps(result))
+
+
+def top_imports(stderr, count):
+    """
+    Returns the slowest top-level imports after MARKER in -X importtime output
+    """
+    lines = stderr.split(MARKER, 1)[-1].splitlines()
+    imports = []
+    for line in lines:
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented past the separating space
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def run(directory, module, env, eager=False, cold=False):
+    command = [
+        sys.executable, "-X", "importtime", os.path.abspath(__file__),
+        "--child", module, "--started", repr(time.time()),
+    ]
+    if eager:
+        command.append("--eager")
+    if cold:
+        command.append("--cold")
+    process = subprocess.run(
+        command, cwd=directory, env=env, capture_output=True, text=True
+    )
+    if process.returncode:
+        raise RuntimeError(f"{directory} failed:\n{process.stderr[-3000:]}")
+    return json.loads(process.stdout.strip().splitlines()[-1]), process.stderr
+
+
+def ms(results, key):
+    values = [r[key] for r in results if key in r]
+    return f"{statistics.median(values) * 1000:8.0f}" if values else f"{'-':>8}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5,
+                        help="Number of slowest imports to list per target")
+    parser.add_argument("--only", help="Comma separated targets, e.g. event-handler")
+    parser.add_argument("--child", metavar="MODULE", help=argparse.SUPPRESS)
+    parser.add_argument("--started", help=argparse.SUPPRESS)
+    parser.add_argument("--eager", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--cold", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.module = args.child
+        child(args)
+        return
+
+    from pubsub_standin import PubSubStandIn
+
+    standin = PubSubStandIn()
+    workdir = tempfile.mkdtemp()
+    key_file = os.path.join(workdir, "key.json")
+    service_account_key(key_file)
+    env = dict(
+        os.environ,
+        GOOGLE_APPLICATION_CREDENTIALS=key_file,
+        GOOGLE_CLOUD_PROJECT="benchmark",
+        PROJECT_NAME="benchmark",
+        PUBSUB_EMULATOR_HOST=os.environ.get("PUBSUB_EMULATOR_HOST") or standin.start(),
+        OUTBOX_DIR=os.path.join(workdir, "outbox"),
+        # The parsers' dedup store starts empty instead of loading the
+        # signatures in BigQuery, which cannot be reached
+        DEDUP_STORE="sqlite",
+        DEDUP_SQLITE_PATH=os.path.join(workdir, "dedup.sqlite3"),
+        DEDUP_WARM_UP="false",
+    )
+
+    only = set(args.only.split(",")) if args.only else None
+    print(f"median of {args.runs} runs, ms")
+    print(f"{'target':<20} {'mode':<6} {'import':>8} {'warm-up':>8} {'ready':>8} {'webhook':>8}")
+    slowest = {}
+    for name, directory, module in targets():
+        if only and name not in only:
+            continue
+        modes = [("eager", True, False), ("lazy", False, False)]
+        if module == "event_handler":
+            modes.append(("cold", False, True))
+        for mode, eager, cold in modes:
+            results = []
+            for _ in range(args.runs):
+                result, stderr = run(directory, module, env, eager, cold)
+                results.append(result)
+            if mode == "lazy":
+                slowest[name] = top_imports(stderr, args.top)
+            print(
+                f"{name:<20} {mode:<6} {ms(results, 'import')} {ms(results, 'warm_up')} "
+                f"{ms(results, 'ready')} {ms(results, 'webhook')}"
+            )
+
+    print("\nslowest imports of the lazy runs, cumulative ms")
+    for name, imports in slowest.items():
+        listed = ", ".join(f"{package} {us / 1000:.0f}" for us, package in imports)
+        print(f"{name:<20} {listed}")
+    standin.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,15 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
 import os
-import json
 
 import shared
 
 from flask import Flask, request
 
 app = Flask(__name__)
+# Send the rows buffered for BigQuery before Cloud Run stops the instance
+shared.flush_on_shutdown()
 
 
 @app.route("/", methods=["POST"])
@@ -52,6 +52,17 @@ def index():
         # [Do not edit below]
         shared.insert_row_into_bigquery(event)
 
+    except shared.RetryableInsertError as e:
+        entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery, message will be redelivered",
+                "errors": e.errors,
+                "json_payload": envelope
+            }
+        print(shared.json_dumps(entry))
+        # A non-2xx response nacks the message
+        return "", 503
+
     except Exception as e:
         entry = {
                 "severity": "WARNING",
@@ -59,13 +70,15 @@ def index():
                 "errors": str(e),
                 "json_payload": envelope
             }
-        print(json.dumps(entry))
+        print(shared.json_dumps(entry))
 
     return "", 204
 
 
 def process_argocd_event(msg):
-    metadata = json.loads(base64.b64decode(msg["data"]).decode("utf-8").strip())
+    # The payload is stored as received; only the fields read below are parsed
+    metadata_string = shared.decode_data(msg).decode("utf-8").strip()
+    metadata = shared.JsonView(metadata_string)
 
     # Unique hash for the event
     signature = shared.create_unique_id(msg)
@@ -73,7 +86,7 @@ def process_argocd_event(msg):
     argocd_event = {
         "event_type": "deployment",  # Event type, eg "push", "pull_reqest", etc
         "id": metadata["id"],  # Object ID, eg pull request ID
-        "metadata": json.dumps(metadata),  # The body of the msg
+        "metadata": metadata_string,  # The body of the msg
         "time_created": metadata["time"],  # The timestamp of with the event
         "signature": signature,  # The unique event signature
         "msg_id": msg["message_id"],  # The pubsub message id
@@ -84,9 +97,24 @@ def process_argocd_event(msg):
     return argocd_event
 
 
-if __name__ == "__main__":
-    PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness check. Creates the BigQuery client and loads the dedup store, so
+    that the first message does not wait for them.
+    """
+    shared.warm_up()
+    return "ok", 200
 
-    # This is used when running locally. Gunicorn is used to run the
-    # application on Cloud Run. See entrypoint in Dockerfile.
-    app.run(host="127.0.0.1", port=PORT, debug=True)
+
+if __name__ == "__main__":
+    if shared.PULL_SUBSCRIPTION:
+        # Consumer mode: pull messages from the subscription and insert them
+        # in batches, instead of receiving a push request per message
+        shared.consume(process_argocd_event)
+    else:
+        PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+
+        # This is used when running locally. Gunicorn is used to run the
+        # application on Cloud Run. See entrypoint in Dockerfile.
+        app.run(host="127.0.0.1", port=PORT, debug=True)
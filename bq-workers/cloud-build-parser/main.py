@@ -12,15 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
 import os
-import json
 
 import shared
 
 from flask import Flask, request
 
 app = Flask(__name__)
+# Send the rows buffered for BigQuery before Cloud Run stops the instance
+shared.flush_on_shutdown()
 
 
 @app.route("/", methods=["POST"])
@@ -44,13 +44,20 @@ def index():
         raise Exception("Missing pubsub attributes")
 
     try:
-        attr = msg["attributes"]
-        # Process Cloud Build event
-        if "buildId" in attr:
-            event = process_cloud_build_event(attr, msg)
-
+        event = process_message(msg)
         shared.insert_row_into_bigquery(event)
 
+    except shared.RetryableInsertError as e:
+        entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery, message will be redelivered",
+                "errors": e.errors,
+                "json_payload": envelope
+            }
+        print(shared.json_dumps(entry))
+        # A non-2xx response nacks the message
+        return "", 503
+
     except Exception as e:
         entry = {
                 "severity": "WARNING",
@@ -58,11 +65,23 @@ def index():
                 "errors": str(e),
                 "json_payload": envelope
             }
-        print(json.dumps(entry))
+        print(shared.json_dumps(entry))
 
     return "", 204
 
 
+def process_message(msg):
+    """
+    Parses a Pub/Sub message into an event, or returns None if it is not a
+    Cloud Build event
+    """
+    attr = msg["attributes"]
+    # Process Cloud Build event
+    if "buildId" in attr:
+        return process_cloud_build_event(attr, msg)
+    return None
+
+
 def process_cloud_build_event(attr, msg):
     event_type = "build"
     e_id = attr["buildId"]
@@ -71,7 +90,9 @@ def process_cloud_build_event(attr, msg):
     signature = shared.create_unique_id(msg)
 
     # Payload
-    metadata = json.loads(base64.b64decode(msg["data"]).decode("utf-8").strip())
+    # The payload is stored as received; only the fields read below are parsed
+    metadata_string = shared.decode_data(msg).decode("utf-8").strip()
+    metadata = shared.JsonView(metadata_string)
 
     # Most up to date timestamp for the event
     time_created = (metadata.get("finishTime") or metadata.get("startTime") or metadata.get("createTime"))
@@ -79,7 +100,7 @@ def process_cloud_build_event(attr, msg):
     build_event = {
         "event_type": event_type,
         "id": e_id,
-        "metadata": json.dumps(metadata),
+        "metadata": metadata_string,
         "time_created": time_created,
         "signature": signature,
         "msg_id": msg["message_id"],
@@ -89,9 +110,24 @@ def process_cloud_build_event(attr, msg):
     return build_event
 
 
-if __name__ == "__main__":
-    PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness check. Creates the BigQuery client and loads the dedup store, so
+    that the first message does not wait for them.
+    """
+    shared.warm_up()
+    return "ok", 200
+
 
-    # This is used when running locally. Gunicorn is used to run the
-    # application on Cloud Run. See entrypoint in Dockerfile.
-    app.run(host="127.0.0.1", port=PORT, debug=True)
+if __name__ == "__main__":
+    if shared.PULL_SUBSCRIPTION:
+        # Consumer mode: pull messages from the subscription and insert them
+        # in batches, instead of receiving a push request per message
+        shared.consume(process_message)
+    else:
+        PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+
+        # This is used when running locally. Gunicorn is used to run the
+        # application on Cloud Run. See entrypoint in Dockerfile.
+        app.run(host="127.0.0.1", port=PORT, debug=True)
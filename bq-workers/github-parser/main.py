@@ -12,15 +12,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
 import os
-import json
 
 import shared
 
 from flask import Flask, request
 
+# Where the id and the creation time of each supported event type are in its
+# payload, see shared.compile_extractor. A list of paths takes the first one
+# with a value, a tuple of paths joins their values with "/". An event without
+# an id is not saved, one without a creation time is saved with a null
+# time_created, e.g. a check_run that has not started yet.
+EVENTS = {
+    "push": {
+        "id": "head_commit.id",
+        "time_created": "head_commit.timestamp",
+    },
+    "pull_request": {
+        "id": ("repository.name", "number"),
+        "time_created": "pull_request.updated_at",
+    },
+    "pull_request_review": {
+        "id": "review.id",
+        "time_created": "review.submitted_at",
+    },
+    "pull_request_review_comment": {
+        "id": "comment.id",
+        "time_created": "comment.updated_at",
+    },
+    "issues": {
+        "id": ("repository.name", "issue.number"),
+        "time_created": "issue.updated_at",
+    },
+    "issue_comment": {
+        "id": "comment.id",
+        "time_created": "comment.updated_at",
+    },
+    "check_run": {
+        "id": "check_run.id",
+        "time_created": ["check_run.completed_at", "check_run.started_at"],
+    },
+    "check_suite": {
+        "id": "check_suite.id",
+        "time_created": ["check_suite.updated_at", "check_suite.created_at"],
+    },
+    "status": {
+        "id": "id",
+        "time_created": "updated_at",
+    },
+    "deployment_status": {
+        "id": "deployment_status.id",
+        "time_created": "deployment_status.updated_at",
+    },
+    "release": {
+        "id": "release.id",
+        "time_created": ["release.published_at", "release.created_at"],
+    },
+}
+EXTRACTORS = {
+    event_type: shared.compile_extractor(
+        fields, f"GitHub {event_type} event", optional=("time_created",)
+    )
+    for event_type, fields in EVENTS.items()
+}
+
 app = Flask(__name__)
+# Send the rows buffered for BigQuery before Cloud Run stops the instance
+shared.flush_on_shutdown()
 
 
 @app.route("/", methods=["POST"])
@@ -44,18 +102,20 @@ def index():
         raise Exception("Missing pubsub attributes")
 
     try:
-        attr = msg["attributes"]
-
-        # Header Event info
-        if "headers" in attr:
-            headers = json.loads(attr["headers"])
-
-            # Process Github Events
-            if "X-Github-Event" in headers:
-                event = process_github_event(headers, msg)
-
+        event = process_message(msg)
         shared.insert_row_into_bigquery(event)
 
+    except shared.RetryableInsertError as e:
+        entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery, message will be redelivered",
+                "errors": e.errors,
+                "json_payload": envelope
+            }
+        print(shared.json_dumps(entry))
+        # A non-2xx response nacks the message
+        return "", 503
+
     except Exception as e:
         entry = {
                 "severity": "WARNING",
@@ -63,11 +123,27 @@ def index():
                 "errors": str(e),
                 "json_payload": envelope
             }
-        print(json.dumps(entry))
+        print(shared.json_dumps(entry))
 
     return "", 204
 
 
+def process_message(msg):
+    """
+    Parses a Pub/Sub message into an event, or returns None if it is not a
+    GitHub event
+    """
+    attr = msg["attributes"]
+
+    # Header Event info
+    headers = shared.get_headers(attr)
+
+    # Process Github Events
+    if "X-Github-Event" in headers:
+        return process_github_event(headers, msg)
+    return None
+
+
 def process_github_event(headers, msg):
     event_type = headers["X-Github-Event"]
     signature = headers["X-Hub-Signature"]
@@ -77,68 +153,18 @@ def process_github_event(headers, msg):
     if "Mock" in headers:
         source += "mock"
 
-    types = {"push", "pull_request", "pull_request_review",
-             "pull_request_review_comment", "issues",
-             "issue_comment", "check_run", "check_suite", "status",
-             "deployment_status", "release"}
-
-    if event_type not in types:
+    if event_type not in EXTRACTORS:
         raise Exception("Unsupported GitHub event: '%s'" % event_type)
 
-    metadata = json.loads(base64.b64decode(msg["data"]).decode("utf-8").strip())
-
-    if event_type == "push":
-        time_created = metadata["head_commit"]["timestamp"]
-        e_id = metadata["head_commit"]["id"]
-
-    if event_type == "pull_request":
-        time_created = metadata["pull_request"]["updated_at"]
-        e_id = metadata["repository"]["name"] + "/" + str(metadata["number"])
-
-    if event_type == "pull_request_review":
-        time_created = metadata["review"]["submitted_at"]
-        e_id = metadata["review"]["id"]
-
-    if event_type == "pull_request_review_comment":
-        time_created = metadata["comment"]["updated_at"]
-        e_id = metadata["comment"]["id"]
-
-    if event_type == "issues":
-        time_created = metadata["issue"]["updated_at"]
-        e_id = metadata["repository"]["name"] + "/" + str(metadata["issue"]["number"])
-
-    if event_type == "issue_comment":
-        time_created = metadata["comment"]["updated_at"]
-        e_id = metadata["comment"]["id"]
-
-    if event_type == "check_run":
-        time_created = (metadata["check_run"]["completed_at"] or
-                        metadata["check_run"]["started_at"])
-        e_id = metadata["check_run"]["id"]
-
-    if event_type == "check_suite":
-        time_created = (metadata["check_suite"]["updated_at"] or
-                        metadata["check_suite"]["created_at"])
-        e_id = metadata["check_suite"]["id"]
-
-    if event_type == "deployment_status":
-        time_created = metadata["deployment_status"]["updated_at"]
-        e_id = metadata["deployment_status"]["id"]
-
-    if event_type == "status":
-        time_created = metadata["updated_at"]
-        e_id = metadata["id"]
-
-    if event_type == "release":
-        time_created = (metadata["release"]["published_at"] or
-                        metadata["release"]["created_at"])
-        e_id = metadata["release"]["id"]
+    # The payload is stored as received; only the fields in EVENTS are parsed
+    metadata_string = shared.decode_data(msg).decode("utf-8").strip()
+    fields = EXTRACTORS[event_type](shared.JsonView(metadata_string))
 
     github_event = {
         "event_type": event_type,
-        "id": e_id,
-        "metadata": json.dumps(metadata),
-        "time_created": time_created,
+        "id": fields["id"],
+        "metadata": metadata_string,
+        "time_created": fields["time_created"],
         "signature": signature,
         "msg_id": msg["message_id"],
         "source": source,
@@ -148,9 +174,24 @@ def process_github_event(headers, msg):
     return github_event
 
 
-if __name__ == "__main__":
-    PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness check. Creates the BigQuery client and loads the dedup store, so
+    that the first message does not wait for them.
+    """
+    shared.warm_up()
+    return "ok", 200
 
-    # This is used when running locally. Gunicorn is used to run the
-    # application on Cloud Run. See entrypoint in Dockerfile.
-    app.run(host="127.0.0.1", port=PORT, debug=True)
+
+if __name__ == "__main__":
+    if shared.PULL_SUBSCRIPTION:
+        # Consumer mode: pull messages from the subscription and insert them
+        # in batches, instead of receiving a push request per message
+        shared.consume(process_message)
+    else:
+        PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+
+        # This is used when running locally. Gunicorn is used to run the
+        # application on Cloud Run. See entrypoint in Dockerfile.
+        app.run(host="127.0.0.1", port=PORT, debug=True)
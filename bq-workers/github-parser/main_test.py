@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import base64
+import datetime
+import gzip
 import json
 
 import main
@@ -93,6 +95,85 @@ def test_github_event_processed(client):
     assert r.status_code == 204
 
 
+def test_retryable_insert_error_nacks_message(client):
+    headers = {"X-Github-Event": "push", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    commit = json.dumps({"head_commit": {"timestamp": 0, "id": "bar"}}).encode(
+        "utf-8"
+    )
+    pubsub_msg = {
+        "message": {
+            "data": base64.b64encode(commit).decode("utf-8"),
+            "attributes": headers,
+            "message_id": "foobar",
+        },
+    }
+
+    errors = [{"index": 0, "errors": [{"reason": "backendError"}]}]
+    shared.insert_row_into_bigquery = mock.MagicMock(
+        side_effect=shared.RetryableInsertError(errors)
+    )
+
+    r = client.post(
+        "/",
+        data=json.dumps(pubsub_msg),
+        headers={"Content-Type": "application/json"},
+    )
+
+    assert r.status_code == 503
+
+
+def test_github_event_with_header_attributes_processed(client):
+    headers = {"X-Github-Event": "push", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    commit = json.dumps({"head_commit": {"timestamp": 0, "id": "bar"}}).encode(
+        "utf-8"
+    )
+    pubsub_msg = {
+        "message": {
+            "data": base64.b64encode(commit).decode("utf-8"),
+            "attributes": headers,
+            "message_id": "foobar",
+        },
+    }
+
+    shared.insert_row_into_bigquery = mock.MagicMock()
+
+    r = client.post(
+        "/",
+        data=json.dumps(pubsub_msg),
+        headers={"Content-Type": "application/json"},
+    )
+
+    github_event = shared.insert_row_into_bigquery.call_args.args[0]
+    assert (github_event["event_type"], github_event["team"]) == ("push", "team1")
+    assert r.status_code == 204
+
+
+def test_compressed_github_event_processed(client):
+    headers = {"X-Github-Event": "push", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    commit = json.dumps({"head_commit": {"timestamp": 0, "id": "bar"}}).encode(
+        "utf-8"
+    )
+    pubsub_msg = {
+        "message": {
+            "data": base64.b64encode(gzip.compress(commit)).decode("utf-8"),
+            "attributes": {**headers, "content-encoding": "gzip"},
+            "message_id": "foobar",
+        },
+    }
+
+    shared.insert_row_into_bigquery = mock.MagicMock()
+
+    r = client.post(
+        "/",
+        data=json.dumps(pubsub_msg),
+        headers={"Content-Type": "application/json"},
+    )
+
+    github_event = shared.insert_row_into_bigquery.call_args.args[0]
+    assert github_event["metadata"] == commit.decode("utf-8")
+    assert r.status_code == 204
+
+
 def test_github_event_avoid_id_conflicts_pull_requests(client):
 
     headers = {"X-Github-Event": "pull_request", "X-Hub-Signature": "foo", "X-Team": "team1"}
@@ -145,3 +226,104 @@ def test_github_event_avoid_id_conflicts_issues(client):
     }
 
     assert github_event_calculated["id"] == github_event_expected["id"]
+
+
+def test_healthz_creates_client(client):
+    with mock.patch("shared.get_bigquery_client") as get_bigquery_client, \
+            mock.patch("shared.get_deduplicator") as get_deduplicator:
+        r = client.get("/healthz")
+
+    assert r.status_code == 200
+    get_bigquery_client.assert_called_once()
+    get_deduplicator.assert_called_once()
+
+
+def test_pulled_github_event_processed():
+    headers = {"X-Github-Event": "push", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    commit = json.dumps({"head_commit": {"timestamp": 0, "id": "bar"}}).encode(
+        "utf-8"
+    )
+    message = mock.MagicMock(
+        data=commit,
+        attributes=headers,
+        message_id="foobar",
+        publish_time=datetime.datetime(2021, 6, 15, 11, 12, 14, tzinfo=datetime.timezone.utc),
+    )
+
+    github_event = main.process_message(shared.pulled_message(message))
+
+    assert (github_event["id"], github_event["msg_id"]) == ("bar", "foobar")
+
+
+def test_non_github_message_is_not_processed():
+    assert main.process_message({"attributes": {"User-Agent": "curl"}}) is None
+
+
+def test_github_event_metadata_is_stored_as_received():
+    headers = {"X-Github-Event": "push", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    payload = (
+        '{\n  "ref": "refs/heads/main",\n  "commits": [{"message": "Café \\"fix\\" {["}],'
+        '\n  "head_commit": {"id": "bar", "timestamp": "2021-06-15T13:12:14Z"}\n}\n'
+    )
+    msg = {
+        "data": base64.b64encode(payload.encode("utf-8")).decode("utf-8"),
+        "attributes": headers,
+        "message_id": "foobar",
+    }
+
+    github_event = main.process_github_event(headers=headers, msg=msg)
+
+    assert github_event["metadata"] == payload.strip()
+    assert (github_event["id"], github_event["time_created"]) == (
+        "bar", "2021-06-15T13:12:14Z"
+    )
+
+
+def github_message(payload):
+    return {
+        "data": base64.b64encode(json.dumps(payload).encode("utf-8")).decode("utf-8"),
+        "attributes": {},
+        "message_id": "foobar",
+    }
+
+
+@pytest.mark.parametrize("event_type, payload, expected", [
+    ("push", {"head_commit": {"id": "a", "timestamp": "t"}}, ("a", "t")),
+    ("pull_request", {"pull_request": {"updated_at": "t"}, "repository": {"name": "r"}, "number": 7},
+     ("r/7", "t")),
+    ("pull_request_review", {"review": {"id": 1, "submitted_at": "t"}}, (1, "t")),
+    ("pull_request_review_comment", {"comment": {"id": 1, "updated_at": "t"}}, (1, "t")),
+    ("issues", {"issue": {"number": 7, "updated_at": "t"}, "repository": {"name": "r"}}, ("r/7", "t")),
+    ("issue_comment", {"comment": {"id": 1, "updated_at": "t"}}, (1, "t")),
+    ("check_run", {"check_run": {"id": 1, "completed_at": None, "started_at": "t"}}, (1, "t")),
+    ("check_suite", {"check_suite": {"id": 1, "updated_at": "t", "created_at": "c"}}, (1, "t")),
+    ("status", {"id": 1, "updated_at": "t"}, (1, "t")),
+    ("deployment_status", {"deployment_status": {"id": 1, "updated_at": "t"}}, (1, "t")),
+    ("release", {"release": {"id": 1, "published_at": None, "created_at": "t"}}, (1, "t")),
+])
+def test_github_event_types_extracted(event_type, payload, expected):
+    headers = {"X-Github-Event": event_type, "X-Hub-Signature": "foo", "X-Team": "team1"}
+
+    github_event = main.process_github_event(headers, github_message(payload))
+
+    assert (github_event["id"], github_event["time_created"]) == expected
+
+
+def test_github_event_null_time_created():
+    headers = {"X-Github-Event": "check_run", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    payload = {"check_run": {"id": 1, "completed_at": None, "started_at": None}}
+
+    github_event = main.process_github_event(headers, github_message(payload))
+
+    assert github_event["id"] == 1
+    assert github_event["time_created"] is None
+
+
+def test_github_event_missing_id_raises():
+    headers = {"X-Github-Event": "release", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    payload = {"release": {"id": None, "published_at": "t"}}
+
+    with pytest.raises(shared.MissingFieldError) as e:
+        main.process_github_event(headers, github_message(payload))
+
+    assert str(e.value) == "GitHub release event has no id: missing release.id"
@@ -12,16 +12,63 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
 from datetime import datetime
 import os
-import json
 
 import shared
 
 from flask import Flask, request
 
+
+def checkout_commit_timestamp(metadata):
+    """
+    Returns the timestamp of the pushed commit that was checked out, or None
+    """
+    checkout_sha = metadata.get("checkout_sha")
+    time_created = None
+    for commit in metadata.get("commits") or ():
+        if commit["id"] == checkout_sha:
+            time_created = commit["timestamp"]
+    return time_created
+
+
+OBJECT_ATTRIBUTES = {
+    "id": "object_attributes.id",
+    "time_created": [
+        "object_attributes.updated_at",
+        "object_attributes.finished_at",
+        "object_attributes.created_at",
+    ],
+}
+JOB = {
+    "id": "build_id",
+    "time_created": ["build_finished_at", "build_started_at", "build_created_at"],
+}
+
+# Where the id and the creation time of each supported object_kind are in
+# its payload, see shared.compile_extractor. A list of paths takes the first
+# one with a value. Events without a creation time get their publish time.
+EVENTS = {
+    "push": {"id": "checkout_sha", "time_created": checkout_commit_timestamp},
+    "tag_push": {"id": "checkout_sha", "time_created": checkout_commit_timestamp},
+    "merge_request": OBJECT_ATTRIBUTES,
+    "note": OBJECT_ATTRIBUTES,
+    "issue": OBJECT_ATTRIBUTES,
+    "pipeline": OBJECT_ATTRIBUTES,
+    "job": JOB,
+    "build": JOB,
+    "deployment": {"id": "deployment_id", "time_created": "status_changed_at"},
+}
+EXTRACTORS = {
+    object_kind: shared.compile_extractor(
+        fields, f"GitLab {object_kind} event", optional=("time_created",)
+    )
+    for object_kind, fields in EVENTS.items()
+}
+
 app = Flask(__name__)
+# Send the rows buffered for BigQuery before Cloud Run stops the instance
+shared.flush_on_shutdown()
 
 
 @app.route("/", methods=["POST"])
@@ -45,18 +92,20 @@ def index():
         raise Exception("Missing pubsub attributes")
 
     try:
-        attr = msg["attributes"]
-
-        # Header Event info
-        if "headers" in attr:
-            headers = json.loads(attr["headers"])
-
-            # Process Gitlab Events
-            if "X-Gitlab-Event" in headers:
-                event = process_gitlab_event(headers, msg)
-
+        event = process_message(msg)
         shared.insert_row_into_bigquery(event)
 
+    except shared.RetryableInsertError as e:
+        entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery, message will be redelivered",
+                "errors": e.errors,
+                "json_payload": envelope
+            }
+        print(shared.json_dumps(entry))
+        # A non-2xx response nacks the message
+        return "", 503
+
     except Exception as e:
         entry = {
                 "severity": "WARNING",
@@ -64,11 +113,27 @@ def index():
                 "errors": str(e),
                 "json_payload": envelope
             }
-        print(json.dumps(entry))
+        print(shared.json_dumps(entry))
 
     return "", 204
 
 
+def process_message(msg):
+    """
+    Parses a Pub/Sub message into an event, or returns None if it is not a
+    GitLab event
+    """
+    attr = msg["attributes"]
+
+    # Header Event info
+    headers = shared.get_headers(attr)
+
+    # Process Gitlab Events
+    if "X-Gitlab-Event" in headers:
+        return process_gitlab_event(headers, msg)
+    return None
+
+
 def process_gitlab_event(headers, msg):
     # Unique hash for the event
     signature = shared.create_unique_id(msg)
@@ -78,48 +143,18 @@ def process_gitlab_event(headers, msg):
     if "Mock" in headers:
         source += "mock"
 
-    types = {"push", "merge_request",
-             "note", "tag_push", "issue",
-             "pipeline", "job", "deployment",
-             "build"}
-
-    metadata = json.loads(base64.b64decode(msg["data"]).decode("utf-8").strip())
+    # The payload is stored as received; only the fields in EVENTS are parsed
+    metadata_string = shared.decode_data(msg).decode("utf-8").strip()
+    metadata = shared.JsonView(metadata_string)
 
     event_type = metadata["object_kind"]
 
-    if event_type not in types:
+    if event_type not in EXTRACTORS:
         raise Exception("Unsupported Gitlab event: '%s'" % event_type)
 
-    if event_type in ("push", "tag_push"):
-        e_id = metadata["checkout_sha"]
-        for commit in metadata["commits"]:
-            if commit["id"] == e_id:
-                time_created = commit["timestamp"]
-
-    if event_type in ("merge_request", "note", "issue", "pipeline"):
-        event_object = metadata["object_attributes"]
-        e_id = event_object["id"]
-        time_created = (
-            event_object.get("updated_at") or
-            event_object.get("finished_at") or
-            event_object.get("created_at"))
-
-    if event_type in ("job"):
-        e_id = metadata["build_id"]
-        time_created = (
-            event_object.get("finished_at") or
-            event_object.get("started_at"))
-
-    if event_type in ("deployment"):
-        e_id = metadata["deployment_id"]
-        time_created = metadata["status_changed_at"]
-
-    if event_type in ("build"):
-        e_id = metadata["build_id"]
-        time_created = (
-            metadata.get("build_finished_at") or
-            metadata.get("build_started_at") or
-            metadata.get("build_created_at"))
+    fields = EXTRACTORS[event_type](metadata)
+    e_id = fields["id"]
+    time_created = fields["time_created"]
 
     # Some timestamps come in a format like "2021-04-28 21:50:00 +0200"
     # BigQuery does not accept this as a valid format
@@ -136,7 +171,7 @@ def process_gitlab_event(headers, msg):
     gitlab_event = {
         "event_type": event_type,
         "id": e_id,
-        "metadata": json.dumps(metadata),
+        "metadata": metadata_string,
         # If time_created not supplied by event, default to pub/sub publishTime
         "time_created": time_created or msg["publishTime"],
         "signature": signature,
@@ -148,9 +183,24 @@ def process_gitlab_event(headers, msg):
     return gitlab_event
 
 
-if __name__ == "__main__":
-    PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness check. Creates the BigQuery client and loads the dedup store, so
+    that the first message does not wait for them.
+    """
+    shared.warm_up()
+    return "ok", 200
+
 
-    # This is used when running locally. Gunicorn is used to run the
-    # application on Cloud Run. See entrypoint in Dockerfile.
-    app.run(host="127.0.0.1", port=PORT, debug=True)
+if __name__ == "__main__":
+    if shared.PULL_SUBSCRIPTION:
+        # Consumer mode: pull messages from the subscription and insert them
+        # in batches, instead of receiving a push request per message
+        shared.consume(process_message)
+    else:
+        PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+
+        # This is used when running locally. Gunicorn is used to run the
+        # application on Cloud Run. See entrypoint in Dockerfile.
+        app.run(host="127.0.0.1", port=PORT, debug=True)
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import base64
+import datetime
 import json
 
 import main
@@ -134,3 +135,80 @@ def test_timestamp_timezone_event_processed(client):
 
     shared.insert_row_into_bigquery.assert_called_with(event)
     assert r.status_code == 204
+
+
+def gitlab_message(payload):
+    return {
+        "data": base64.b64encode(json.dumps(payload).encode("utf-8")).decode("utf-8"),
+        "attributes": {"X-Gitlab-Event": "Job Hook", "X-Team": "team1"},
+        "message_id": "foobar",
+        "publishTime": "2021-06-15T11:12:14Z",
+    }
+
+
+def test_job_event_processed():
+    msg = gitlab_message({
+        "object_kind": "job",
+        "build_id": 42,
+        "build_started_at": "2021-06-15 11:10:14 UTC",
+        "build_finished_at": None,
+    })
+
+    event = main.process_gitlab_event({"X-Team": "team1"}, msg)
+
+    assert (event["id"], event["time_created"]) == (42, "2021-06-15 11:10:14 UTC")
+
+
+def test_push_without_checkout_commit_gets_publish_time():
+    msg = gitlab_message({"object_kind": "push", "checkout_sha": "foo", "commits": []})
+
+    event = main.process_gitlab_event({"X-Team": "team1"}, msg)
+
+    assert (event["id"], event["time_created"]) == ("foo", "2021-06-15T11:12:14Z")
+
+
+def test_missing_id_raises():
+    msg = gitlab_message({"object_kind": "pipeline", "object_attributes": {}})
+
+    with pytest.raises(shared.MissingFieldError, match="object_attributes.id"):
+        main.process_gitlab_event({"X-Team": "team1"}, msg)
+
+
+def pulled_gitlab_message(payload):
+    return mock.MagicMock(
+        data=json.dumps(payload).encode("utf-8"),
+        attributes={"X-Gitlab-Event": "Pipeline Hook", "X-Team": "team1"},
+        message_id="foobar",
+        publish_time=datetime.datetime(2021, 6, 15, 11, 12, 14, tzinfo=datetime.timezone.utc),
+    )
+
+
+def test_pulled_gitlab_event_processed():
+    message = pulled_gitlab_message({
+        "object_kind": "pipeline",
+        "object_attributes": {"id": 7, "finished_at": "2021-06-15 11:12:14 UTC"},
+    })
+
+    event = main.process_message(shared.pulled_message(message))
+
+    assert (event["id"], event["msg_id"]) == (7, "foobar")
+    assert event["signature"] == shared.create_unique_id(shared.pulled_message(message))
+
+
+def test_pulled_gitlab_events_are_inserted_and_acked():
+    messages = [
+        pulled_gitlab_message({"object_kind": "pipeline", "object_attributes": {"id": 7}}),
+        pulled_gitlab_message({"object_kind": "unknown"}),
+    ]
+    sink = mock.MagicMock(return_value=[])
+
+    with mock.patch("shared.get_sink", return_value=sink), \
+            mock.patch("shared.get_deduplicator") as get_deduplicator:
+        get_deduplicator.return_value.contains.return_value = False
+        shared.PullConsumer("subscription", main.process_message).process_batch(messages)
+
+    assert [row[4] for row in sink.call_args.args[1]] == [
+        shared.create_unique_id(shared.pulled_message(messages[0]))
+    ]
+    assert messages[0].ack.called and not messages[0].nack.called
+    assert messages[1].ack.called and not messages[1].nack.called
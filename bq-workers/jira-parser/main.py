@@ -12,15 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
 import os
-import json
 
 import shared
 
 from flask import Flask, request
 
 app = Flask(__name__)
+# Send the rows buffered for BigQuery before Cloud Run stops the instance
+shared.flush_on_shutdown()
 
 
 @app.route("/", methods=["POST"])
@@ -44,18 +44,20 @@ def index():
         raise Exception("Missing pubsub attributes")
 
     try:
-        attr = msg["attributes"]
-
-        # Header Event info
-        if "headers" in attr:
-            headers = json.loads(attr["headers"])
-
-            # Process Github Events
-            if "Atlassian Webhook HTTP Client" == headers["User-Agent"]:
-                event = process_jira_event(headers, msg)
-
+        event = process_message(msg)
         shared.insert_row_into_bigquery(event)
 
+    except shared.RetryableInsertError as e:
+        entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery, message will be redelivered",
+                "errors": e.errors,
+                "json_payload": envelope
+            }
+        print(shared.json_dumps(entry))
+        # A non-2xx response nacks the message
+        return "", 503
+
     except Exception as e:
         entry = {
                 "severity": "WARNING",
@@ -63,11 +65,27 @@ def index():
                 "errors": str(e),
                 "json_payload": envelope
             }
-        print(json.dumps(entry))
+        print(shared.json_dumps(entry))
 
     return "", 204
 
 
+def process_message(msg):
+    """
+    Parses a Pub/Sub message into an event, or returns None if it is not a
+    Jira event
+    """
+    attr = msg["attributes"]
+
+    # Header Event info
+    headers = shared.get_headers(attr)
+
+    # Process Jira Events
+    if "Atlassian Webhook HTTP Client" == headers.get("User-Agent"):
+        return process_jira_event(headers, msg)
+    return None
+
+
 def process_jira_event(headers, msg):
     # event_type = headers["X-Github-Event"]
     # signature = headers["X-Hub-Signature"]
@@ -77,8 +95,8 @@ def process_jira_event(headers, msg):
     if "Mock" in headers:
         source += "mock"
 
-    metadata_string = base64.b64decode(msg["data"]).decode("utf-8").strip()
-    metadata = json.loads(metadata_string)
+    metadata_string = shared.decode_data(msg).decode("utf-8").strip()
+    metadata = shared.JsonView(metadata_string)
     time_created = int(metadata["timestamp"] / 1000)
     event_type = metadata["webhookEvent"]
     signature = shared.create_unique_id(msg)
@@ -103,9 +121,24 @@ def process_jira_event(headers, msg):
     return jira_event
 
 
-if __name__ == "__main__":
-    PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness check. Creates the BigQuery client and loads the dedup store, so
+    that the first message does not wait for them.
+    """
+    shared.warm_up()
+    return "ok", 200
 
-    # This is used when running locally. Gunicorn is used to run the
-    # application on Cloud Run. See entrypoint in Dockerfile.
-    app.run(host="127.0.0.1", port=PORT, debug=True)
+
+if __name__ == "__main__":
+    if shared.PULL_SUBSCRIPTION:
+        # Consumer mode: pull messages from the subscription and insert them
+        # in batches, instead of receiving a push request per message
+        shared.consume(process_message)
+    else:
+        PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+
+        # This is used when running locally. Gunicorn is used to run the
+        # application on Cloud Run. See entrypoint in Dockerfile.
+        app.run(host="127.0.0.1", port=PORT, debug=True)
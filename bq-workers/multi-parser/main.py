@@ -0,0 +1,201 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import importlib.util
+import os
+import json
+
+import shared
+
+from flask import Flask, request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Directory with the parser directories, next to this one in the repository
+# and in the container image
+PARSERS_DIR = os.environ.get("PARSERS_DIR", os.path.dirname(HERE))
+
+# Parser name -> (directory, function of its main.py that parses a message)
+PARSERS = {
+    "github": ("github-parser", "process_message"),
+    "gitlab": ("gitlab-parser", "process_message"),
+    "jira": ("jira-parser", "process_message"),
+    "tekton": ("tekton-parser", "process_message"),
+    "circleci": ("circleci-parser", "process_message"),
+    "pagerduty": ("pagerduty-parser", "process_pagerduty_event"),
+    "argocd": ("argocd-parser", "process_argocd_event"),
+    "cloudbuild": ("cloud-build-parser", "process_message"),
+}
+
+# Parsers to load, comma-separated. All of them by default.
+ENABLED_PARSERS = [
+    name.strip() for name in os.environ.get("PARSERS", ",".join(PARSERS)).split(",")
+    if name.strip()
+]
+
+# Subscriptions are named after their parser, or after their parser and a
+# shard ("github-shard-0"). Others can be mapped in PARSER_SUBSCRIPTIONS, a
+# JSON object of subscription name -> parser name.
+SUBSCRIPTIONS = json.loads(os.environ.get("PARSER_SUBSCRIPTIONS") or "{}")
+
+# Messages of other subscriptions go to the first parser whose webhook
+# headers they carry
+HEADER_MATCHERS = (
+    ("github", lambda headers: "X-Github-Event" in headers),
+    ("gitlab", lambda headers: "X-Gitlab-Event" in headers),
+    ("circleci", lambda headers: "Circleci-Event-Type" in headers),
+    ("jira", lambda headers: headers.get("User-Agent") == "Atlassian Webhook HTTP Client"),
+    ("tekton", lambda headers: "tekton" in headers.get("Ce-Type", "")),
+    ("cloudbuild", lambda headers: "buildId" in headers),
+)
+
+
+def load_parsers(names):
+    """
+    Imports the main.py of each parser and returns its name -> the function
+    that parses a message. The parsers share this process' shared module,
+    and so its BigQuery client, batching writer and dedup store.
+    """
+    parsers = {}
+    for name in names:
+        if name not in PARSERS:
+            raise Exception("Unsupported parser: '%s'" % name)
+        directory, function = PARSERS[name]
+        path = os.path.join(PARSERS_DIR, directory, "main.py")
+        spec = importlib.util.spec_from_file_location(f"{name}_parser", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        parsers[name] = getattr(module, function)
+    return parsers
+
+
+parsers = load_parsers(ENABLED_PARSERS)
+
+app = Flask(__name__)
+# Send the rows buffered for BigQuery before Cloud Run stops the instance
+shared.flush_on_shutdown()
+
+
+@app.route("/", methods=["POST"])
+def index():
+    """
+    Receives messages from the push subscriptions of every parser from
+    Pub/Sub. Parses the message with the parser of its subscription, and
+    inserts it into BigQuery.
+    """
+    event = None
+    # Check request for JSON
+    if not request.is_json:
+        raise Exception("Expecting JSON payload")
+    envelope = request.get_json()
+
+    # Check that message is a valid pub/sub message
+    if "message" not in envelope:
+        raise Exception("Not a valid Pub/Sub Message")
+    msg = envelope["message"]
+
+    if "attributes" not in msg:
+        raise Exception("Missing pubsub attributes")
+
+    try:
+        event = process_message(envelope.get("subscription"), msg)
+        shared.insert_row_into_bigquery(event)
+
+    except shared.RetryableInsertError as e:
+        entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery, message will be redelivered",
+                "errors": e.errors,
+                "json_payload": envelope
+            }
+        print(shared.json_dumps(entry))
+        # A non-2xx response nacks the message
+        return "", 503
+
+    except Exception as e:
+        entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery",
+                "errors": str(e),
+                "json_payload": envelope
+            }
+        print(shared.json_dumps(entry))
+
+    return "", 204
+
+
+def process_message(subscription, msg):
+    """
+    Parses a Pub/Sub message with the parser of its subscription
+    """
+    name = parser_name(subscription, msg["attributes"])
+    if name not in parsers:
+        raise Exception(
+            "No parser for messages of subscription '%s'" % subscription
+        )
+    return parsers[name](msg)
+
+
+@functools.lru_cache(maxsize=None)
+def subscription_parser(subscription):
+    """
+    Returns the name of the parser of a subscription, given by its full
+    name or its name, or None
+    """
+    name = subscription.rsplit("/", 1)[-1]
+    if name in SUBSCRIPTIONS:
+        return SUBSCRIPTIONS[name]
+    for parser in PARSERS:
+        if name == parser or name.startswith(parser + "-"):
+            return parser
+    return None
+
+
+def parser_name(subscription, attributes):
+    """
+    Returns the name of the parser of a message: the parser of its
+    subscription if it has one, else the parser of its webhook headers
+    """
+    if subscription:
+        name = subscription_parser(subscription)
+        if name is not None:
+            return name
+    headers = shared.get_headers(attributes)
+    for name, matches in HEADER_MATCHERS:
+        if matches(headers):
+            return name
+    return None
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness check. Creates the BigQuery client and loads the dedup store, so
+    that the first message does not wait for them.
+    """
+    shared.warm_up()
+    return "ok", 200
+
+
+if __name__ == "__main__":
+    if shared.PULL_SUBSCRIPTION:
+        # Consumer mode: pull messages from the subscription and insert them
+        # in batches, instead of receiving a push request per message
+        shared.consume(functools.partial(process_message, shared.PULL_SUBSCRIPTION))
+    else:
+        PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+
+        # This is used when running locally. Gunicorn is used to run the
+        # application on Cloud Run. See entrypoint in Dockerfile.
+        app.run(host="127.0.0.1", port=PORT, debug=True)
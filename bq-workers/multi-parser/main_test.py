@@ -0,0 +1,111 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+
+import main
+import shared
+
+import mock
+import pytest
+
+
+@pytest.fixture
+def client():
+    main.app.testing = True
+    return main.app.test_client()
+
+
+@pytest.fixture
+def insert():
+    with mock.patch("shared.insert_row_into_bigquery") as insert:
+        yield insert
+
+
+def push(subscription, data, attributes):
+    return {
+        "message": {
+            "data": base64.b64encode(json.dumps(data).encode("utf-8")).decode("utf-8"),
+            "attributes": attributes,
+            "message_id": "foobar",
+            "publishTime": "2021-06-15T11:12:14Z",
+        },
+        "subscription": subscription,
+    }
+
+
+def test_every_parser_is_loaded():
+    assert sorted(main.parsers) == sorted(main.PARSERS)
+
+
+def test_parsers_share_the_shared_module():
+    assert main.parsers["github"].__globals__["shared"] is shared
+    assert main.parsers["pagerduty"].__globals__["shared"] is shared
+
+
+def test_message_is_dispatched_by_subscription(client, insert):
+    headers = {"X-Gitlab-Event": "Push Hook", "X-Gitlab-Token": "foo", "X-Team": "team1"}
+    data = {
+        "object_kind": "push",
+        "checkout_sha": "bar",
+        "commits": [{"id": "bar", "timestamp": "2021-06-15T11:12:14Z"}],
+    }
+
+    r = client.post("/", json=push("projects/p/subscriptions/gitlab", data, headers))
+
+    assert r.status_code == 204
+    event = insert.call_args.args[0]
+    assert (event["source"], event["id"]) == ("gitlab", "bar")
+
+
+def test_message_of_shard_subscription_is_dispatched(client, insert):
+    headers = {"X-Github-Event": "push", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    data = {"head_commit": {"timestamp": 0, "id": "bar"}}
+
+    client.post("/", json=push("projects/p/subscriptions/github-shard-0", data, headers))
+
+    assert insert.call_args.args[0]["source"] == "github"
+
+
+def test_unknown_subscription_is_dispatched_by_headers(client, insert):
+    headers = {"X-Github-Event": "push", "X-Hub-Signature": "foo", "X-Team": "team1"}
+    data = {"head_commit": {"timestamp": 0, "id": "bar"}}
+
+    client.post("/", json=push("projects/p/subscriptions/webhooks", data, headers))
+
+    assert insert.call_args.args[0]["source"] == "github"
+
+
+def test_message_without_parser_is_not_inserted(client, insert):
+    r = client.post("/", json=push("projects/p/subscriptions/webhooks", {}, {"foo": "bar"}))
+
+    assert r.status_code == 204
+    insert.assert_not_called()
+
+
+def test_subscriptions_can_be_mapped():
+    with mock.patch("main.SUBSCRIPTIONS", {"cloud-build-events": "cloudbuild"}):
+        main.subscription_parser.cache_clear()
+        try:
+            assert main.parser_name("cloud-build-events", {}) == "cloudbuild"
+        finally:
+            main.subscription_parser.cache_clear()
+
+
+def test_unsupported_parser_is_rejected():
+    with pytest.raises(Exception) as e:
+        main.load_parsers(["bitbucket"])
+
+    assert "Unsupported parser" in str(e.value)
@@ -12,15 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
 import os
-import json
 
 import shared
 
 from flask import Flask, request
 
 app = Flask(__name__)
+# Send the rows buffered for BigQuery before Cloud Run stops the instance
+shared.flush_on_shutdown()
 
 
 @app.route("/", methods=["POST"])
@@ -50,6 +50,17 @@ def index():
             # [Do not edit below]
             shared.insert_row_into_bigquery(event)
 
+    except shared.RetryableInsertError as e:
+        entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery, message will be redelivered",
+                "errors": e.errors,
+                "json_payload": envelope
+            }
+        print(shared.json_dumps(entry))
+        # A non-2xx response nacks the message
+        return "", 503
+
     except Exception as e:
         entry = {
                 "severity": "WARNING",
@@ -57,14 +68,16 @@ def index():
                 "errors": str(e),
                 "json_payload": envelope
             }
-        print(f"EXCEPTION raised  {json.dumps(entry)}")
+        print(f"EXCEPTION raised  {shared.json_dumps(entry)}")
     return "", 204
 
 
 def process_pagerduty_event(msg):
-    metadata = json.loads(base64.b64decode(msg["data"]).decode("utf-8").strip())
+    # The payload is stored as received; only the fields read below are parsed
+    metadata_string = shared.decode_data(msg).decode("utf-8").strip()
+    metadata = shared.JsonView(metadata_string)
 
-    print(f"Metadata after decoding {metadata}")
+    print(f"Metadata after decoding {metadata_string}")
 
     # Unique hash for the event
     signature = shared.create_unique_id(msg)
@@ -77,7 +90,7 @@ def process_pagerduty_event(msg):
     pagerduty_event = {
         "event_type": event_type,  # Event type, eg "incident.trigger", "incident.resolved", etc
         "id": event['id'],  # Event ID,
-        "metadata": json.dumps(metadata),  # The body of the msg
+        "metadata": metadata_string,  # The body of the msg
         "signature": signature,  # The unique event signature
         "msg_id": msg["message_id"],  # The pubsub message id
         "time_created" : event['occurred_at'],  # The timestamp of with the event resolved
@@ -88,9 +101,24 @@ def process_pagerduty_event(msg):
     return pagerduty_event
 
 
-if __name__ == "__main__":
-    PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness check. Creates the BigQuery client and loads the dedup store, so
+    that the first message does not wait for them.
+    """
+    shared.warm_up()
+    return "ok", 200
 
-    # This is used when running locally. Gunicorn is used to run the
-    # application on Cloud Run. See entrypoint in Dockerfile.
-    app.run(host="127.0.0.1", port=PORT, debug=True)
+
+if __name__ == "__main__":
+    if shared.PULL_SUBSCRIPTION:
+        # Consumer mode: pull messages from the subscription and insert them
+        # in batches, instead of receiving a push request per message
+        shared.consume(process_pagerduty_event)
+    else:
+        PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+
+        # This is used when running locally. Gunicorn is used to run the
+        # application on Cloud Run. See entrypoint in Dockerfile.
+        app.run(host="127.0.0.1", port=PORT, debug=True)
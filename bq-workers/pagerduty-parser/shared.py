@@ -0,0 +1,1767 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import atexit
+import base64
+import collections
+from concurrent import futures
+import datetime
+import gzip
+import hashlib
+import json
+import math
+import os
+import queue
+import re
+import signal
+import sqlite3
+import threading
+import time
+
+# Seconds a table schema is used before it is fetched again. Inserts that do
+# not match the schema fetch it right away.
+SCHEMA_CACHE_TTL = float(os.environ.get("BIGQUERY_SCHEMA_CACHE_TTL", 3600))
+
+DATASET_ID = "four_keys"
+
+# Rows inserted by concurrent requests are streamed into BigQuery together,
+# one insertAll request per table, until one of these limits is reached.
+BATCHING = os.environ.get("BIGQUERY_BATCHING", "true").lower() == "true"
+BATCH_MAX_ROWS = int(os.environ.get("BIGQUERY_BATCH_MAX_ROWS", 500))
+BATCH_MAX_BYTES = int(os.environ.get("BIGQUERY_BATCH_MAX_BYTES", 5 * 1024 * 1024))
+BATCH_MAX_LATENCY = float(os.environ.get("BIGQUERY_BATCH_MAX_LATENCY", 0))
+# insertAll requests in flight at once. Rows wait for a free sender, so
+# batches grow with the load even when BIGQUERY_BATCH_MAX_LATENCY is 0.
+BATCH_SENDERS = int(os.environ.get("BIGQUERY_BATCH_SENDERS", 4))
+# Seconds buffered rows are given to reach BigQuery on shutdown. Cloud Run
+# stops an instance 10 seconds after SIGTERM.
+SHUTDOWN_FLUSH_TIMEOUT = float(os.environ.get("BIGQUERY_SHUTDOWN_FLUSH_TIMEOUT", 8))
+
+# How rows reach BigQuery: "insert_all" (legacy streaming inserts) or
+# "storage_write" (the Storage Write API, appending each batch exactly once)
+SINK = os.environ.get("BIGQUERY_SINK", "insert_all").lower()
+# "committed" streams make rows visible as soon as they are appended;
+# "pending" streams commit each batch atomically once it was appended
+WRITE_STREAM_TYPE = os.environ.get("BIGQUERY_WRITE_STREAM_TYPE", "committed").lower()
+APPEND_ATTEMPTS = 3
+# google.rpc.Code of an append at an offset that was already written
+ALREADY_EXISTS = 6
+
+# Row error reasons that may go away when the row is inserted again
+RETRYABLE_REASONS = {
+    "backendError", "internalError", "rateLimitExceeded", "stopped", "timeout"
+}
+
+# Where the signatures of inserted events are kept for duplicate checks:
+# "bigquery" (a query of events_raw per event, or per batch of pulled
+# messages), "redis" (shared by every
+# instance) or "sqlite" (a file per instance, which only catches duplicates
+# delivered to the same instance)
+DEDUP_STORE = os.environ.get("DEDUP_STORE", "bigquery").lower()
+DEDUP_SQLITE_PATH = os.environ.get("DEDUP_SQLITE_PATH", "/tmp/fourkeys-dedup.sqlite3")
+DEDUP_REDIS_URL = os.environ.get("DEDUP_REDIS_URL", "redis://localhost:6379/0")
+DEDUP_REDIS_PREFIX = os.environ.get("DEDUP_REDIS_PREFIX", "fourkeys:signature:")
+# A signature missing from the Bloom filter is new without asking the store.
+# Only safe while this process is the only writer to the store.
+DEDUP_BLOOM = os.environ.get("DEDUP_BLOOM", "false").lower() == "true"
+DEDUP_BLOOM_CAPACITY = int(os.environ.get("DEDUP_BLOOM_CAPACITY", 1000000))
+DEDUP_BLOOM_FALSE_POSITIVE_RATE = float(
+    os.environ.get("DEDUP_BLOOM_FALSE_POSITIVE_RATE", 0.001)
+)
+# Load the signatures already in events_raw into an empty store on start:
+# at most DEDUP_WARM_UP_LIMIT of those created in the last
+# DEDUP_WARM_UP_DAYS, by default as long as a subscription keeps a message
+DEDUP_WARM_UP = os.environ.get("DEDUP_WARM_UP", "true").lower() == "true"
+DEDUP_WARM_UP_DAYS = int(os.environ.get("DEDUP_WARM_UP_DAYS", 7))
+DEDUP_WARM_UP_LIMIT = int(os.environ.get("DEDUP_WARM_UP_LIMIT", 1000000))
+WARM_UP_PAGE_SIZE = 50000
+WARMED_UP = ":warmed-up"
+# Signatures looked up in one SQLite statement, below its parameter limit
+SQLITE_MAX_PARAMETERS = 500
+
+# Consumer mode: messages pulled from PULL_SUBSCRIPTION with streaming pull
+# are parsed and inserted in batches of up to PULL_BATCH_SIZE, sent once
+# PULL_BATCH_LATENCY seconds passed since the first message of the batch.
+PULL_SUBSCRIPTION = os.environ.get("PULL_SUBSCRIPTION")
+PULL_BATCH_SIZE = int(os.environ.get("PULL_BATCH_SIZE", 500))
+PULL_BATCH_LATENCY = float(os.environ.get("PULL_BATCH_LATENCY", 0.1))
+# Flow control: messages and bytes leased from Pub/Sub and not yet acked
+PULL_MAX_MESSAGES = int(os.environ.get("PULL_MAX_MESSAGES", 1000))
+PULL_MAX_BYTES = int(os.environ.get("PULL_MAX_BYTES", 100 * 1024 * 1024))
+
+# "orjson", "json", or "auto" for orjson if it is installed
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "auto").lower()
+# Values of a JSON document that JsonView skips without decoding them
+JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+JSON_SCALAR = re.compile(r'[^,\]}\s]*')
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_client = None
+_client_lock = threading.Lock()
+# Table ID -> (table, fetched at)
+_tables = {}
+_tables_lock = threading.Lock()
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+_writer = None
+_writer_lock = threading.Lock()
+_flush_on_shutdown = False
+_storage_writer = None
+_storage_writer_lock = threading.Lock()
+_json_decoder = json.JSONDecoder()
+
+
+class RetryableInsertError(Exception):
+    """
+    Raised for a row that was not inserted for a reason that may go away, so
+    that its Pub/Sub message is delivered again
+    """
+
+    def __init__(self, errors):
+        super().__init__(json_dumps(errors))
+        self.errors = errors
+
+
+def get_bigquery_client():
+    """
+    Returns the BigQuery client shared by every request in the process
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # Imported on first use to keep it out of the cold start
+                from google.cloud import bigquery
+
+                _client = bigquery.Client()
+    return _client
+
+
+def get_table(table_id, refresh=False):
+    """
+    Returns a table of the dataset with its schema, fetched at most once
+    every SCHEMA_CACHE_TTL seconds unless `refresh` is set
+    """
+    entry = _tables.get(table_id)
+    if not refresh and entry is not None:
+        table, fetched_at = entry
+        if time.monotonic() - fetched_at < SCHEMA_CACHE_TTL:
+            return table
+
+    table = get_bigquery_client().get_table(f"{DATASET_ID}.{table_id}")
+    with _tables_lock:
+        _tables[table_id] = (table, time.monotonic())
+    return table
+
+
+def insert_rows(table_id, rows):
+    """
+    Streams rows into a table and returns the insert errors. If the rows do
+    not match the cached schema, the schema is fetched again first. Invalid
+    rows do not keep the other rows from being inserted.
+    """
+    client = get_bigquery_client()
+    table = get_table(table_id)
+    # Rows are tuples with a value per column, so a column added since the
+    # schema was cached shows in their length
+    if any(len(row) != len(table.schema) for row in rows):
+        table = get_table(table_id, refresh=True)
+
+    errors = client.insert_rows(table, rows, skip_invalid_rows=True)
+    if is_schema_mismatch(errors):
+        # Insert the rows that hit the old schema again, mapping their errors
+        # back to their index in `rows`
+        failed = sorted({error["index"] for error in errors})
+        retried = client.insert_rows(
+            get_table(table_id, refresh=True),
+            [rows[index] for index in failed],
+            skip_invalid_rows=True,
+        )
+        errors = [dict(error, index=failed[error["index"]]) for error in retried]
+    return errors
+
+
+def is_schema_mismatch(errors):
+    """
+    Returns True if BigQuery rejected rows for fields missing from the table
+    """
+    for row in errors or ():
+        for error in row.get("errors", ()):
+            if "no such field" in error.get("message", "").lower():
+                return True
+    return False
+
+
+class BatchWriter(object):
+    """
+    Buffers the rows inserted by concurrent requests and streams them into
+    BigQuery from `senders` background threads, one insertAll request per
+    table, once max_rows or max_bytes are buffered or the oldest row waited
+    max_latency seconds. Each row gets a future with its own insert errors.
+    """
+
+    def __init__(
+        self,
+        insert=None,
+        max_rows=BATCH_MAX_ROWS,
+        max_bytes=BATCH_MAX_BYTES,
+        max_latency=BATCH_MAX_LATENCY,
+        senders=BATCH_SENDERS,
+        clock=time.monotonic,
+    ):
+        # Looked up when called, so that it can be replaced in tests
+        self._insert = insert or (lambda table_id, rows: get_sink()(table_id, rows))
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self._clock = clock
+
+        self._lock = threading.Condition()
+        # Table ID -> [(row, size, future)], oldest first
+        self._buffers = {}
+        self._bytes = collections.Counter()
+        self._buffered_at = {}
+        self._in_flight = 0
+        self._flushing = False
+        self._closed = False
+
+        self.batches = 0
+        self.rows = 0
+
+        self._senders = [
+            threading.Thread(target=self._run, name=f"bigquery-writer-{i}", daemon=True)
+            for i in range(senders)
+        ]
+        for sender in self._senders:
+            sender.start()
+
+    def insert(self, table_id, row):
+        """
+        Buffers a row. Returns a future with the list of errors BigQuery
+        reported for it, empty if it was inserted.
+        """
+        future = futures.Future()
+        size = len(json.dumps(row, default=str))
+        with self._lock:
+            if not self._closed:
+                buffer = self._buffers.setdefault(table_id, [])
+                if not buffer:
+                    self._buffered_at[table_id] = self._clock()
+                buffer.append((row, size, future))
+                self._bytes[table_id] += size
+                self._lock.notify_all()
+                return future
+        # Rows inserted during shutdown are not buffered
+        self._send(table_id, [(row, size, future)])
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Sends every buffered row and waits for BigQuery to answer. Returns
+        False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._flushing = True
+            self._lock.notify_all()
+            try:
+                while self._buffers or self._in_flight:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._lock.wait(remaining)
+            finally:
+                self._flushing = False
+        return True
+
+    def close(self, timeout=None):
+        """
+        Flushes the buffered rows. Rows inserted after this are sent at once.
+        """
+        with self._lock:
+            self._closed = True
+        return self.flush(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffered": sum(len(buffer) for buffer in self._buffers.values()),
+                "batches": self.batches,
+                "rows": self.rows,
+            }
+
+    def _run(self):
+        while True:
+            with self._lock:
+                table_id, wait = self._next()
+                while table_id is None:
+                    self._lock.wait(wait)
+                    table_id, wait = self._next()
+                buffer = self._buffers.pop(table_id)
+                batch, rest = buffer[:self.max_rows], buffer[self.max_rows:]
+                if rest:
+                    self._buffers[table_id] = rest
+                self._bytes[table_id] -= sum(size for _, size, _ in batch)
+                self._in_flight += 1
+            try:
+                self._send(table_id, batch)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._lock.notify_all()
+
+    def _next(self):
+        # Called with self._lock held. Returns the table to send now, or the
+        # seconds until the oldest buffered row is due.
+        now = self._clock()
+        wait = None
+        for table_id, buffer in self._buffers.items():
+            due = self._buffered_at[table_id] + self.max_latency
+            if (
+                self._flushing
+                or len(buffer) >= self.max_rows
+                or self._bytes[table_id] >= self.max_bytes
+                or now >= due
+            ):
+                return table_id, None
+            wait = due - now if wait is None else min(wait, due - now)
+        return None, wait
+
+    def _send(self, table_id, batch):
+        try:
+            errors = self._insert(table_id, [row for row, _, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self.batches += 1
+            self.rows += len(batch)
+        # Errors are reported by row index; hand each row its own, as if it
+        # had been inserted alone
+        by_row = collections.defaultdict(list)
+        for error in errors or ():
+            by_row[error["index"]].extend(error.get("errors", ()))
+        for index, (_, _, future) in enumerate(batch):
+            row_errors = by_row.get(index)
+            future.set_result([{"index": 0, "errors": row_errors}] if row_errors else [])
+
+
+def get_writer():
+    """
+    Returns the BatchWriter shared by every request in the process
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BatchWriter()
+    return _writer
+
+
+def write_row(table_id, row):
+    """
+    Inserts a row, batched with the rows of concurrent requests unless
+    BIGQUERY_BATCHING is false, and returns its insert errors. Raises
+    RetryableInsertError if it was not inserted for a reason that may go away.
+    """
+    try:
+        if BATCHING:
+            errors = get_writer().insert(table_id, row).result()
+        else:
+            errors = get_sink()(table_id, [row])
+    except Exception as e:
+        if is_transient_error(e):
+            raise RetryableInsertError([{"index": 0, "errors": [{"message": str(e)}]}])
+        raise
+    if any(
+        error.get("reason") in RETRYABLE_REASONS
+        for row_errors in errors or ()
+        for error in row_errors.get("errors", ())
+    ):
+        raise RetryableInsertError(errors)
+    return errors
+
+
+def is_transient_error(error):
+    """
+    Returns True for errors the BigQuery client would retry: 429s, 5xx
+    responses and connection errors
+    """
+    from google.api_core.retry import if_transient_error
+
+    return isinstance(error, (ConnectionError, TimeoutError)) or if_transient_error(error)
+
+
+def flush_on_shutdown(timeout=SHUTDOWN_FLUSH_TIMEOUT):
+    """
+    Flushes the rows buffered by the BatchWriter when the process gets
+    SIGTERM, which Cloud Run sends before it stops an instance, and again when
+    it exits. Call it from the main thread, once the server set its own signal
+    handlers, which are called afterwards.
+    """
+    def flush(signum, frame):
+        flush_writer(timeout)
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    global _flush_on_shutdown
+    # Services that load several parsers call it once per parser
+    if _flush_on_shutdown:
+        return
+    _flush_on_shutdown = True
+    if threading.current_thread() is threading.main_thread():
+        previous = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, flush)
+    atexit.register(close_writer, timeout)
+
+
+def flush_writer(timeout=None):
+    if _writer is not None:
+        _writer.flush(timeout)
+
+
+def close_writer(timeout=None):
+    if _writer is not None:
+        _writer.close(timeout)
+
+
+def get_sink():
+    """
+    Returns the function BIGQUERY_SINK streams rows with, which takes a table
+    ID and a list of rows and returns their errors
+    """
+    if SINK == "insert_all":
+        return insert_rows
+    if SINK == "storage_write":
+        return get_storage_writer().insert
+    raise Exception("Unsupported BigQuery sink: '%s'" % SINK)
+
+
+class AppendError(Exception):
+    """
+    Raised when the Storage Write API rejected rows of an append
+    """
+
+    def __init__(self, message, row_errors=()):
+        super().__init__(message)
+        self.row_errors = row_errors
+
+
+class StorageWriter(object):
+    """
+    Appends rows with the BigQuery Storage Write API, serialized as protocol
+    buffers built from the table schema.
+
+    With "committed" streams, each table has one stream and every append
+    names the offset its rows start at, so an append that is retried after
+    it reached BigQuery is refused as ALREADY_EXISTS instead of writing the
+    rows twice. An append that still fails leaves its stream for a new one.
+    With "pending" streams, each batch is appended to a stream of its own
+    that is committed once every row is in.
+    """
+
+    def __init__(self, client=None, stream_type=WRITE_STREAM_TYPE):
+        if stream_type not in ("committed", "pending"):
+            raise Exception("Unsupported write stream type: '%s'" % stream_type)
+        self._client = client
+        self.stream_type = stream_type
+        self._lock = threading.Lock()
+        # Table ID -> TableStream
+        self._tables = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    # Only needed, and only imported, when BIGQUERY_SINK is
+                    # "storage_write"
+                    from google.cloud import bigquery_storage_v1
+
+                    self._client = bigquery_storage_v1.BigQueryWriteClient()
+        return self._client
+
+    def insert(self, table_id, rows):
+        """
+        Appends rows to a table and returns the errors of the rows that were
+        not, in the format of insert_rows
+        """
+        table = self._table(table_id, rows)
+        errors = {}
+        serialized = {}
+        for index, row in enumerate(rows):
+            try:
+                serialized[index] = table.serialize(row)
+            except (TypeError, ValueError) as e:
+                errors[index] = str(e)
+
+        # Rows the API rejects keep the whole append from being written, so
+        # it is made again without them
+        while serialized:
+            indexes = list(serialized)
+            try:
+                self._append(table, [serialized[index] for index in indexes])
+                break
+            except AppendError as e:
+                if not e.row_errors:
+                    raise
+                for position, message in e.row_errors:
+                    errors[indexes[position]] = message
+                    serialized.pop(indexes[position], None)
+
+        return [
+            {"index": index, "errors": [{"reason": "invalid", "message": message}]}
+            for index, message in sorted(errors.items())
+        ]
+
+    def _table(self, table_id, rows):
+        bigquery_table = get_table(table_id)
+        if any(len(row) != len(bigquery_table.schema) for row in rows):
+            bigquery_table = get_table(table_id, refresh=True)
+        with self._lock:
+            table = self._tables.get(table_id)
+            if table is None or table.schema != bigquery_table.schema:
+                table = TableStream(bigquery_table, previous=table)
+                self._tables[table_id] = table
+        return table
+
+    def _append(self, table, serialized_rows):
+        if self.stream_type == "committed":
+            from google.api_core.exceptions import NotFound
+
+            # Appends to a stream are made one at a time, in offset order, so
+            # concurrent appends take a stream each
+            stream = table.acquire()
+            try:
+                for attempt in range(2):
+                    if stream is None:
+                        stream = CommittedStream(self._create_stream(table, "COMMITTED"))
+                    try:
+                        self._append_at(table, stream.name, stream.offset, serialized_rows)
+                    except AppendError:
+                        raise
+                    except Exception as e:
+                        # Whether the rows were written is not known, so the
+                        # next append must not reuse their offset
+                        stream = None
+                        # A stream BigQuery dropped did not take the rows either
+                        if isinstance(e, NotFound) and not attempt:
+                            continue
+                        raise
+                    stream.offset += len(serialized_rows)
+                    return
+            finally:
+                if stream is not None:
+                    table.release(stream)
+
+        stream = self._create_stream(table, "PENDING")
+        self._append_at(table, stream, 0, serialized_rows)
+        self.client.finalize_write_stream(name=stream)
+        response = self.client.batch_commit_write_streams(
+            request={"parent": table.path, "write_streams": [stream]}
+        )
+        if response.stream_errors:
+            raise AppendError(response.stream_errors[0].error_message)
+
+    def _create_stream(self, table, stream_type):
+        from google.cloud.bigquery_storage_v1 import types
+
+        write_stream = types.WriteStream(type_=getattr(types.WriteStream.Type, stream_type))
+        return self.client.create_write_stream(
+            parent=table.path, write_stream=write_stream
+        ).name
+
+    def _append_at(self, table, stream, offset, serialized_rows):
+        from google.cloud.bigquery_storage_v1 import types
+
+        request = types.AppendRowsRequest(
+            write_stream=stream,
+            offset=offset,
+            proto_rows=types.AppendRowsRequest.ProtoData(
+                writer_schema=types.ProtoSchema(proto_descriptor=table.descriptor),
+                rows=types.ProtoRows(serialized_rows=serialized_rows),
+            ),
+        )
+        metadata = (("x-goog-request-params", f"write_stream={stream}"),)
+        for attempt in range(APPEND_ATTEMPTS):
+            try:
+                responses = self.client.append_rows(iter([request]), metadata=metadata)
+                response = next(iter(responses), None)
+                if response is None:
+                    raise ConnectionError("Append stream closed without a response")
+            except Exception as e:
+                if attempt + 1 < APPEND_ATTEMPTS and is_transient_error(e):
+                    time.sleep(0.1 * 2 ** attempt)
+                    continue
+                raise
+            if response.row_errors:
+                raise AppendError(
+                    response.error.message,
+                    [(error.index, error.message) for error in response.row_errors],
+                )
+            if response.error.code == ALREADY_EXISTS and attempt:
+                # An earlier attempt of this append reached BigQuery
+                return
+            if response.error.code:
+                raise AppendError(response.error.message)
+            return
+
+
+class CommittedStream(object):
+    def __init__(self, name):
+        self.name = name
+        # Rows appended so far, where the next append starts
+        self.offset = 0
+
+
+class TableStream(object):
+    """
+    Protocol buffer schema and idle committed streams of a table
+    """
+
+    def __init__(self, table, previous=None):
+        self.schema = table.schema
+        self.path = (
+            f"projects/{table.project}/datasets/{table.dataset_id}/tables/{table.table_id}"
+        )
+        self.descriptor, self.message_class = message_class(table.table_id, table.schema)
+        # A new schema does not need new streams
+        self._lock = previous._lock if previous is not None else threading.Lock()
+        self._idle = previous._idle if previous is not None else []
+
+    def acquire(self):
+        """
+        Returns an idle committed stream, or None if a new one is needed
+        """
+        with self._lock:
+            return self._idle.pop() if self._idle else None
+
+    def release(self, stream):
+        with self._lock:
+            self._idle.append(stream)
+
+    def serialize(self, row):
+        message = self.message_class()
+        for field, value in zip(self.schema, row):
+            if value is None:
+                continue
+            if field.field_type == "TIMESTAMP":
+                value = timestamp_micros(value)
+            elif field.field_type in ("INTEGER", "INT64"):
+                value = int(value)
+            elif field.field_type in ("FLOAT", "FLOAT64"):
+                value = float(value)
+            elif field.field_type in ("BOOLEAN", "BOOL"):
+                value = bool(value)
+            else:
+                value = value if isinstance(value, str) else json_dumps(value)
+            setattr(message, field.name, value)
+        return message.SerializeToString()
+
+
+# BigQuery column type -> protocol buffer field type. TIMESTAMP is sent as
+# microseconds since the epoch, other types as strings.
+PROTO_TYPES = {
+    "TIMESTAMP": "TYPE_INT64",
+    "INTEGER": "TYPE_INT64",
+    "INT64": "TYPE_INT64",
+    "FLOAT": "TYPE_DOUBLE",
+    "FLOAT64": "TYPE_DOUBLE",
+    "BOOLEAN": "TYPE_BOOL",
+    "BOOL": "TYPE_BOOL",
+}
+
+
+def message_class(name, schema):
+    """
+    Returns a protocol buffer descriptor with a field per column, and the
+    message class it describes
+    """
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+    descriptor = descriptor_pb2.DescriptorProto(name=f"{name}_row")
+    for number, field in enumerate(schema, start=1):
+        descriptor.field.add(
+            name=field.name,
+            number=number,
+            type=getattr(
+                descriptor_pb2.FieldDescriptorProto,
+                PROTO_TYPES.get(field.field_type, "TYPE_STRING"),
+            ),
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+        )
+    file = descriptor_pb2.FileDescriptorProto(name=f"{name}_row.proto", syntax="proto2")
+    file.message_type.add().CopyFrom(descriptor)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file)
+    message = pool.FindMessageTypeByName(descriptor.name)
+    if hasattr(message_factory, "GetMessageClass"):
+        return descriptor, message_factory.GetMessageClass(message)
+    return descriptor, message_factory.MessageFactory(pool).GetPrototype(message)
+
+
+def timestamp_micros(value):
+    """
+    Converts a TIMESTAMP value, as the parsers produce them, to microseconds
+    since the epoch. Numbers are seconds since the epoch, as for insert_rows.
+    """
+    if isinstance(value, (int, float)):
+        return int(round(value * 1000000))
+    if not isinstance(value, datetime.datetime):
+        text = str(value).strip()
+        if text.endswith(" UTC"):
+            text = text[:-4]
+        if text.endswith("Z"):
+            text = text[:-1] + "+00:00"
+        value = datetime.datetime.fromisoformat(text)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return (value - epoch) // datetime.timedelta(microseconds=1)
+
+
+def get_storage_writer():
+    """
+    Returns the StorageWriter shared by every request in the process
+    """
+    global _storage_writer
+    if _storage_writer is None:
+        with _storage_writer_lock:
+            if _storage_writer is None:
+                _storage_writer = StorageWriter()
+    return _storage_writer
+
+
+def warm_up():
+    """
+    Imports the BigQuery library, creates the client and loads the duplicate
+    check store before the first message needs them
+    """
+    get_bigquery_client()
+    get_deduplicator()
+
+
+def insert_row_into_bigquery(event):
+    if not event:
+        raise Exception("No data to insert")
+
+    # Set up bigquery instance
+    client = get_bigquery_client()
+
+    if is_unique(client, event["signature"]):
+        # Insert row
+        row_to_insert = [events_raw_row(event)]
+        bq_errors = write_row("events_raw", row_to_insert[0])
+
+        # If errors, log to Stackdriver
+        if bq_errors:
+            entry = {
+                "severity": "WARNING",
+                "msg": "Row not inserted.",
+                "errors": bq_errors,
+                "row": row_to_insert,
+            }
+            print(json_dumps(entry))
+        else:
+            get_deduplicator().add(event["signature"])
+
+
+def events_raw_row(event):
+    """
+    Returns the events_raw row of a parsed event
+    """
+    return (
+        event["event_type"],
+        event["id"],
+        event["metadata"],
+        event["time_created"],
+        event["signature"],
+        event["msg_id"],
+        event["source"],
+        event.get("team"),
+    )
+
+
+def insert_row_into_events_enriched(event):
+    if not event:
+        raise Exception("No data to insert")
+
+    # Set up bigquery instance
+    client = get_bigquery_client()
+
+    if is_unique(client, event["events_raw_signature"]):
+        # Insert row
+        row_to_insert = [
+            (
+                event["events_raw_signature"],
+                event["enriched_metadata"]
+            )
+        ]
+        bq_errors = write_row("events_enriched", row_to_insert[0])
+
+        # If errors, log to Stackdriver
+        if bq_errors:
+            entry = {
+                "severity": "WARNING",
+                "msg": "Row not inserted.",
+                "errors": bq_errors,
+                "row": row_to_insert,
+            }
+            print(json_dumps(entry))
+
+
+def is_unique(client, signature):
+    """
+    Returns True if no event with the signature was inserted into events_raw.
+    Answered by the dedup store, not by a BigQuery query per event.
+    """
+    return not get_deduplicator().contains(signature)
+
+
+class BloomFilter(object):
+    """
+    Fixed-size Bloom filter sized for `capacity` keys at the given false
+    positive rate
+    """
+
+    def __init__(self, capacity, false_positive_rate):
+        bits = -capacity * math.log(false_positive_rate) / (math.log(2) ** 2)
+        self.size = max(8, int(math.ceil(bits)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class SQLiteStore(object):
+    """
+    Signatures in an indexed SQLite table, with a connection per thread
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS signatures "
+                "(signature TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+            connection.execute("CREATE TABLE IF NOT EXISTS warm_up (done INTEGER)")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def contains(self, signature):
+        row = self._connection().execute(
+            "SELECT 1 FROM signatures WHERE signature = ?", (signature,)
+        ).fetchone()
+        return row is not None
+
+    def contains_many(self, signatures):
+        signatures = list(signatures)
+        found = set()
+        # SQLite limits the parameters of a statement
+        for start in range(0, len(signatures), SQLITE_MAX_PARAMETERS):
+            chunk = signatures[start:start + SQLITE_MAX_PARAMETERS]
+            cursor = self._connection().execute(
+                "SELECT signature FROM signatures WHERE signature IN (%s)"
+                % ", ".join("?" * len(chunk)),
+                chunk,
+            )
+            found.update(signature for signature, in cursor)
+        return found
+
+    def add_many(self, signatures):
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO signatures VALUES (?)",
+                ((signature,) for signature in signatures),
+            )
+
+    def needs_warm_up(self):
+        row = self._connection().execute("SELECT 1 FROM warm_up").fetchone()
+        return row is None
+
+    def mark_warmed_up(self):
+        with self._connection() as connection:
+            connection.execute("INSERT INTO warm_up VALUES (1)")
+
+    def __iter__(self):
+        cursor = self._connection().execute("SELECT signature FROM signatures")
+        return (signature for signature, in cursor)
+
+
+class RedisStore(object):
+    """
+    Signatures as Redis keys, shared by every instance of the parser
+    """
+
+    def __init__(self, url, prefix=DEDUP_REDIS_PREFIX, client=None):
+        if client is None:
+            # Only needed, and only installed, when DEDUP_STORE is "redis"
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._redis = client
+
+    def contains(self, signature):
+        return bool(self._redis.exists(self.prefix + signature))
+
+    def contains_many(self, signatures):
+        signatures = list(signatures)
+        if not signatures:
+            return set()
+        values = self._redis.mget([self.prefix + signature for signature in signatures])
+        return {
+            signature for signature, value in zip(signatures, values) if value is not None
+        }
+
+    def add_many(self, signatures):
+        pipeline = self._redis.pipeline(transaction=False)
+        for signature in signatures:
+            pipeline.set(self.prefix + signature, 1)
+        pipeline.execute()
+
+    def needs_warm_up(self):
+        # Instances that start before the first warm-up finished load the
+        # signatures too, which is harmless
+        return not self._redis.exists(self.prefix + WARMED_UP)
+
+    def mark_warmed_up(self):
+        self._redis.set(self.prefix + WARMED_UP, 1)
+
+    def __iter__(self):
+        for key in self._redis.scan_iter(match=self.prefix + "*", count=1000):
+            key = key.decode("utf-8")[len(self.prefix):]
+            if key != WARMED_UP:
+                yield key
+
+
+class BigQueryStore(object):
+    """
+    Looks signatures up in events_raw itself, with one query per event or per
+    batch of pulled messages
+    """
+
+    def contains(self, signature):
+        from google.cloud import bigquery
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("signature", "STRING", signature)
+            ]
+        )
+        sql = f"SELECT signature FROM {DATASET_ID}.events_raw WHERE signature = @signature"
+        results = get_bigquery_client().query(sql, job_config=job_config).result()
+        return bool(results.total_rows)
+
+    def contains_many(self, signatures):
+        from google.cloud import bigquery
+
+        signatures = list(signatures)
+        if not signatures:
+            return set()
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter("signatures", "STRING", signatures)
+            ]
+        )
+        sql = (
+            f"SELECT DISTINCT signature FROM {DATASET_ID}.events_raw "
+            "WHERE signature IN UNNEST(@signatures)"
+        )
+        results = get_bigquery_client().query(sql, job_config=job_config).result()
+        return {row["signature"] for row in results}
+
+    def add_many(self, signatures):
+        # The inserted row is the record
+        pass
+
+    def needs_warm_up(self):
+        return False
+
+    def mark_warmed_up(self):
+        pass
+
+    def __iter__(self):
+        return iter(())
+
+
+class Deduplicator(object):
+    """
+    Remembers the signatures of inserted events in a store, with a Bloom
+    filter in front of it that answers for new signatures
+    """
+
+    def __init__(self, store, bloom=None):
+        self.store = store
+        self.bloom = bloom
+        self._lock = threading.Lock()
+
+    def warm_up(self, signatures=None):
+        """
+        Loads the signatures `signatures()` yields into the store, unless it
+        was loaded before, then fills the Bloom filter from the store
+        """
+        if signatures is not None and self.store.needs_warm_up():
+            chunk = []
+            for signature in signatures():
+                chunk.append(signature)
+                if len(chunk) >= WARM_UP_PAGE_SIZE:
+                    self.store.add_many(chunk)
+                    chunk = []
+            self.store.add_many(chunk)
+            self.store.mark_warmed_up()
+        if self.bloom is not None:
+            with self._lock:
+                for signature in self.store:
+                    self.bloom.add(signature)
+
+    def contains(self, signature):
+        if self.bloom is not None and signature not in self.bloom:
+            return False
+        return self.store.contains(signature)
+
+    def contains_many(self, signatures):
+        """
+        Returns the signatures that are in the store, looked up together
+        """
+        if self.bloom is not None:
+            signatures = [s for s in signatures if s in self.bloom]
+        return self.store.contains_many(signatures)
+
+    def add(self, signature):
+        self.add_many([signature])
+
+    def add_many(self, signatures):
+        self.store.add_many(signatures)
+        if self.bloom is not None:
+            # Bits are set by read-modify-write, so adds must not interleave
+            with self._lock:
+                for signature in signatures:
+                    self.bloom.add(signature)
+
+
+def existing_signatures():
+    """
+    Yields the signatures of the events created in events_raw in the last
+    DEDUP_WARM_UP_DAYS, at most DEDUP_WARM_UP_LIMIT of them, from one query
+    """
+    sql = (
+        f"SELECT DISTINCT signature FROM {DATASET_ID}.events_raw "
+        "WHERE signature IS NOT NULL AND time_created >= "
+        f"TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {DEDUP_WARM_UP_DAYS} DAY) "
+        f"LIMIT {DEDUP_WARM_UP_LIMIT}"
+    )
+    rows = get_bigquery_client().query(sql).result(page_size=WARM_UP_PAGE_SIZE)
+    for row in rows:
+        yield row["signature"]
+
+
+def create_store():
+    if DEDUP_STORE == "sqlite":
+        return SQLiteStore(DEDUP_SQLITE_PATH)
+    if DEDUP_STORE == "redis":
+        return RedisStore(DEDUP_REDIS_URL)
+    if DEDUP_STORE == "bigquery":
+        return BigQueryStore()
+    raise Exception("Unsupported dedup store: '%s'" % DEDUP_STORE)
+
+
+def get_deduplicator():
+    """
+    Returns the process-wide Deduplicator, warmed up from events_raw the
+    first time
+    """
+    global _deduplicator
+    if _deduplicator is None:
+        with _deduplicator_lock:
+            if _deduplicator is None:
+                bloom = None
+                # The BigQuery store records nothing the filter could be filled from
+                if DEDUP_BLOOM and DEDUP_STORE != "bigquery":
+                    bloom = BloomFilter(
+                        DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_FALSE_POSITIVE_RATE
+                    )
+                deduplicator = Deduplicator(create_store(), bloom)
+                start = time.monotonic()
+                deduplicator.warm_up(existing_signatures if DEDUP_WARM_UP else None)
+                entry = {
+                    "severity": "INFO",
+                    "msg": "Dedup store ready.",
+                    "store": DEDUP_STORE,
+                    "seconds": round(time.monotonic() - start, 3),
+                }
+                print(json_dumps(entry))
+                _deduplicator = deduplicator
+    return _deduplicator
+
+
+def create_unique_id(msg):
+    # Always encoded by the json module: a different encoding of the same
+    # message would give it a new signature, and let duplicates through
+    hashed = hashlib.sha1(bytes(json.dumps(msg, default=base64_data), "utf-8"))
+    return hashed.hexdigest()
+
+
+def base64_data(value):
+    """
+    Encodes the bytes data of a pulled message to JSON as the base64 str a
+    push request carries
+    """
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def get_headers(attributes):
+    """
+    Returns the webhook headers of a Pub/Sub message. The event handler
+    publishes them as individual attributes; older versions published all of
+    them as a JSON object in the "headers" attribute.
+    """
+    if "headers" in attributes:
+        return json_loads(attributes["headers"])
+    return attributes
+
+
+def decode_data(msg):
+    """
+    Returns the data of a Pub/Sub message, decompressed according to its
+    "content-encoding" attribute. Push requests carry the data base64-encoded,
+    pulled messages as bytes.
+    """
+    data = msg["data"]
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    encoding = msg.get("attributes", {}).get("content-encoding")
+    if not encoding:
+        return data
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise Exception("Unsupported content encoding: '%s'" % encoding)
+
+
+def load_orjson(backend=JSON_BACKEND):
+    """
+    Returns the orjson module, or None if the json module is to be used
+    """
+    if backend not in ("auto", "orjson", "json"):
+        raise ValueError(f"Unsupported JSON_BACKEND: {backend}")
+    if backend == "json":
+        return None
+    try:
+        import orjson
+    except ImportError:
+        if backend == "orjson":
+            raise
+        return None
+    return orjson
+
+
+_orjson = load_orjson()
+
+
+def json_loads(data):
+    """
+    Decodes JSON from a str or bytes, with orjson when it is installed
+    """
+    if _orjson is not None:
+        try:
+            return _orjson.loads(data)
+        except _orjson.JSONDecodeError:
+            # orjson rejects some documents the json module accepts, e.g.
+            # NaN or integers of more than 64 bits. Invalid documents raise
+            # ValueError from the json module below.
+            pass
+    return json.loads(data)
+
+
+def json_dumps(obj, default=None):
+    """
+    Encodes an object to a compact JSON str, with orjson when it is
+    installed. The output is not byte-identical to json.dumps, so it must not
+    be used for anything hashed into a signature, see create_unique_id.
+    """
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(
+                obj, default=default, option=_orjson.OPT_NON_STR_KEYS
+            ).decode("utf-8")
+        except TypeError:
+            # Types orjson does not encode, e.g. integers of more than 64
+            # bits, fall back to the json module
+            pass
+    return json.dumps(obj, default=default, separators=(",", ":"), ensure_ascii=False)
+
+
+class JsonView(object):
+    """
+    Read-only view of a JSON object or array that parses only what is read
+    from it. Looking up a key scans the object up to that key and remembers
+    where the keys it passed are; the values before it are skipped, strings
+    and numbers without decoding them, objects and arrays by decoding them
+    with the C scanner of the json module and dropping them at once. Objects
+    and arrays read are returned as views of their own, other values decoded.
+
+    Parsers read the few fields they need from a payload this way, and store
+    the payload as they received it.
+    """
+
+    def __init__(self, text, start=0):
+        self._text = text
+        start = JSON_WHITESPACE.match(text, start).end()
+        opening = text[start:start + 1]
+        if opening not in ("{", "["):
+            raise json.JSONDecodeError("Expecting object or array", text, start)
+        self._array = opening == "["
+        self._closing = "]" if self._array else "}"
+        # Key, or index, -> position of the value, for the values scanned
+        self._positions = [] if self._array else {}
+        # Position of the next value to scan, None once the end is reached
+        self._next = start + 1
+
+    def __getitem__(self, key):
+        position = self._find(key)
+        if position is None:
+            raise (IndexError if self._array else KeyError)(key)
+        return self._value(position)
+
+    def get(self, key, default=None):
+        position = self._find(key)
+        return default if position is None else self._value(position)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __iter__(self):
+        """
+        Iterates over the values of an array, or the keys of an object
+        """
+        if not self._array:
+            len(self)
+            yield from list(self._positions)
+            return
+        index = 0
+        while index < len(self._positions) or self._scan() is not None:
+            yield self._value(self._positions[index])
+            index += 1
+
+    def __len__(self):
+        while self._scan() is not None:
+            pass
+        return len(self._positions)
+
+    def _find(self, key):
+        if self._array:
+            if not isinstance(key, int) or key < 0:
+                raise TypeError("JSON arrays take non-negative integer indexes")
+            while len(self._positions) <= key:
+                if self._scan() is None:
+                    return None
+            return self._positions[key]
+        position = self._positions.get(key)
+        while position is None:
+            scanned = self._scan()
+            if scanned is None:
+                return None
+            if scanned == key:
+                position = self._positions[key]
+        return position
+
+    def _scan(self):
+        """
+        Scans the next value, and returns its key or index, or None at the end
+        """
+        if self._next is None:
+            return None
+        text = self._text
+        position = JSON_WHITESPACE.match(text, self._next).end()
+        if text[position:position + 1] == self._closing:
+            self._next = None
+            return None
+        if self._array:
+            key = len(self._positions)
+        else:
+            if text[position:position + 1] != '"':
+                raise json.JSONDecodeError(
+                    "Expecting property name enclosed in double quotes", text, position
+                )
+            key, position = json.decoder.scanstring(text, position + 1)
+            position = JSON_WHITESPACE.match(text, position).end()
+            if text[position:position + 1] != ":":
+                raise json.JSONDecodeError("Expecting ':' delimiter", text, position)
+            position = JSON_WHITESPACE.match(text, position + 1).end()
+        end = JSON_WHITESPACE.match(text, skip_json_value(text, position)).end()
+        separator = text[end:end + 1]
+        if separator == ",":
+            self._next = end + 1
+        elif separator == self._closing:
+            self._next = None
+        else:
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, end)
+        if self._array:
+            self._positions.append(position)
+        else:
+            # The first of duplicate keys wins
+            self._positions.setdefault(key, position)
+        return key
+
+    def _value(self, position):
+        if self._text[position] in "{[":
+            return JsonView(self._text, position)
+        return _json_decoder.raw_decode(self._text, position)[0]
+
+
+def skip_json_value(text, position):
+    """
+    Returns the position right after the JSON value at `position` of a text.
+    Only objects and arrays are decoded, as the json module finds their end
+    faster than a scan in Python.
+    """
+    opening = text[position:position + 1]
+    if opening == '"':
+        match = JSON_STRING.match(text, position)
+        if match is None:
+            raise json.JSONDecodeError("Unterminated string", text, position)
+        return match.end()
+    if opening and opening in "{[":
+        return _json_decoder.raw_decode(text, position)[1]
+    end = JSON_SCALAR.match(text, position).end()
+    if end == position:
+        raise json.JSONDecodeError("Expecting value", text, position)
+    return end
+
+
+class MissingFieldError(Exception):
+    """
+    Raised when an event payload lacks a field its extractor requires
+    """
+
+
+def describe_field(field):
+    """
+    Returns the paths of a field of an extractor spec, for error messages
+    """
+    if callable(field):
+        return field.__name__
+    if isinstance(field, list):
+        return " or ".join(field)
+    if isinstance(field, tuple):
+        return " and ".join(field)
+    return field
+
+
+def compile_extractor(fields, name, optional=()):
+    """
+    Compiles a spec of the fields of an event into a function of its payload,
+    a dict or a JsonView, that returns the values of the fields as a dict.
+    Each field of the spec is one of:
+
+    - a dotted path, e.g. "head_commit.id": the value at that path
+    - a list of paths: the value of the first of them that is not missing,
+      null or empty
+    - a tuple of paths: their values joined with "/", e.g.
+      ("repository.name", "number") gives "fourkeys/477"
+    - a function of the payload
+
+    A field that is missing or null raises MissingFieldError, naming `name`
+    and the paths, unless it is in `optional`, which gives None.
+    """
+    # Each path, and each prefix of a path, is looked up once per payload,
+    # from the value of its parent: "head_commit.id" and
+    # "head_commit.timestamp" share the lookup of "head_commit"
+    slots = {"": 0}
+    # (slot of the parent, key, slot of the value), parents first
+    steps = []
+
+    def slot(path):
+        if path not in slots:
+            parent, _, key = path.rpartition(".")
+            parent_slot = slot(parent)
+            slots[path] = len(slots)
+            steps.append((parent_slot, key, slots[path]))
+        return slots[path]
+
+    getters = []
+    for field, spec in fields.items():
+        if callable(spec):
+            kind, source = "call", spec
+        elif isinstance(spec, str):
+            kind, source = "path", slot(spec)
+        elif isinstance(spec, list):
+            kind, source = "first", [slot(path) for path in spec]
+        elif isinstance(spec, tuple):
+            kind, source = "join", [slot(path) for path in spec]
+        else:
+            raise TypeError(f"Unsupported extractor field {field}: {spec!r}")
+        getters.append((field, kind, source, describe_field(spec), field in optional))
+
+    def extract(payload):
+        values = [None] * len(slots)
+        values[0] = payload
+        for parent_slot, key, value_slot in steps:
+            parent = values[parent_slot]
+            if parent is not None:
+                try:
+                    values[value_slot] = parent[key]
+                except (KeyError, IndexError, TypeError):
+                    pass
+
+        extracted = {}
+        for field, kind, source, description, is_optional in getters:
+            if kind == "path":
+                value = values[source]
+            elif kind == "first":
+                value = next(
+                    (values[i] for i in source if values[i] is not None and values[i] != ""),
+                    None,
+                )
+            elif kind == "join":
+                parts = [values[i] for i in source]
+                value = None if None in parts else "/".join(str(part) for part in parts)
+            else:
+                value = source(payload)
+            if value is None and not is_optional:
+                raise MissingFieldError(f"{name} has no {field}: missing {description}")
+            extracted[field] = value
+        return extracted
+
+    return extract
+
+
+def pulled_message(message):
+    """
+    Returns a pulled Pub/Sub message in the form the "message" of a push
+    request has, which the parsers take: the same keys in the same order and
+    the publish time encoded the same way, so that create_unique_id gives it
+    the signature it would have had if it was pushed. The data is kept as
+    bytes rather than base64-encoded; create_unique_id and the log entries
+    encode it.
+    """
+    publish_time = publish_time_json(message)
+    return {
+        # A protobuf map has no set order; the JSON encoding of a push
+        # request writes its entries sorted by key
+        "attributes": dict(sorted(message.attributes.items())),
+        "data": message.data,
+        "messageId": message.message_id,
+        "message_id": message.message_id,
+        "publishTime": publish_time,
+        "publish_time": publish_time,
+    }
+
+
+def publish_time_json(message):
+    """
+    Returns the publish time of a pulled message as a push request has it,
+    the JSON encoding of a protobuf Timestamp: RFC 3339 in UTC with 0, 3, 6
+    or 9 fractional digits
+    """
+    from google.protobuf import timestamp_pb2
+
+    # The received protobuf keeps the nanoseconds, which publish_time rounds
+    # through a float
+    timestamp = getattr(getattr(message, "_message", None), "publish_time", None)
+    if not isinstance(timestamp, timestamp_pb2.Timestamp):
+        timestamp = timestamp_pb2.Timestamp()
+        timestamp.FromDatetime(message.publish_time)
+    return timestamp.ToJsonString()
+
+
+class PullConsumer(object):
+    """
+    Pulls messages from a subscription with streaming pull and inserts the
+    events `process_message` parses from them into events_raw, a batch of
+    messages at a time in one request. Each message is acked once its row is
+    inserted or it can never be inserted, and nacked, so that it is delivered
+    again, when parsing or inserting it failed for a reason that may go away.
+    """
+
+    def __init__(
+        self,
+        subscription,
+        process_message,
+        subscriber=None,
+        batch_size=PULL_BATCH_SIZE,
+        batch_latency=PULL_BATCH_LATENCY,
+        max_messages=PULL_MAX_MESSAGES,
+        max_bytes=PULL_MAX_BYTES,
+    ):
+        self.subscription = subscription
+        self.process_message = process_message
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._subscriber = subscriber
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="pull-consumer", daemon=True
+        )
+
+        self.batches = 0
+        self.acked = 0
+        self.nacked = 0
+
+    @property
+    def subscriber(self):
+        if self._subscriber is None:
+            # Imported on first use, as only consumers need it
+            from google.cloud import pubsub_v1
+
+            self._subscriber = pubsub_v1.SubscriberClient()
+        return self._subscriber
+
+    def run(self, timeout=None):
+        """
+        Pulls messages until stop() is called, SIGTERM or SIGINT is received
+        when called from the main thread, `timeout` seconds passed or the
+        stream fails, then inserts the messages already received
+        """
+        from google.cloud import pubsub_v1
+
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda signum, frame: self._stopping.set())
+        warm_up()
+        self._thread.start()
+        streaming_pull = self.subscriber.subscribe(
+            self.subscription,
+            self._receive,
+            flow_control=pubsub_v1.types.FlowControl(
+                max_messages=self.max_messages, max_bytes=self.max_bytes
+            ),
+        )
+        entry = {
+            "severity": "INFO",
+            "msg": "Pulling messages.",
+            "subscription": self.subscription,
+        }
+        print(json_dumps(entry))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not streaming_pull.done():
+                remaining = 0.5 if deadline is None else min(deadline - time.monotonic(), 0.5)
+                if remaining <= 0 or self._stopping.wait(remaining):
+                    break
+        finally:
+            self.stop()
+            streaming_pull.cancel()
+            # Raises the error the stream failed with
+            streaming_pull.result()
+
+    def stop(self, timeout=SHUTDOWN_FLUSH_TIMEOUT):
+        """
+        Nacks the messages received from now on and inserts the ones already
+        received
+        """
+        with self._lock:
+            self._stopping.set()
+            self._queue.put(None)
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {"batches": self.batches, "acked": self.acked, "nacked": self.nacked}
+
+    def _receive(self, message):
+        # Called by the subscriber's threads for every message
+        with self._lock:
+            if not self._stopping.is_set():
+                self._queue.put(message)
+                return
+        message.nack()
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                break
+            batch = [message]
+            deadline = time.monotonic() + self.batch_latency
+            while len(batch) < self.batch_size:
+                try:
+                    message = self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if message is None:
+                    self.process_batch(batch)
+                    return
+                batch.append(message)
+            self.process_batch(batch)
+
+    def process_batch(self, messages):
+        """
+        Parses a batch of pulled messages, inserts their events that are not
+        duplicates with one request and acks or nacks each message
+        """
+        deduplicator = get_deduplicator()
+        # Parsed messages and their events, looked up in the store together
+        parsed = []
+        for message in messages:
+            event = self._parse(message)
+            if event is not None:
+                parsed.append((message, event))
+        if not parsed:
+            return
+
+        try:
+            existing = deduplicator.contains_many({event["signature"] for _, event in parsed})
+        except Exception as e:
+            entry = {
+                "severity": "WARNING",
+                "msg": "Duplicate check failed, messages will be redelivered",
+                "errors": str(e),
+                "messages": len(parsed),
+            }
+            print(json_dumps(entry))
+            for message, _ in parsed:
+                self._nack(message)
+            return
+        rows = []
+        # Messages whose row is in `rows`, at the same index
+        inserting = []
+        signatures = set()
+        for message, event in parsed:
+            signature = event["signature"]
+            # A message delivered twice may be in the same batch
+            if signature in signatures or signature in existing:
+                self._ack(message)
+                continue
+            signatures.add(signature)
+            rows.append(events_raw_row(event))
+            inserting.append(message)
+        if not rows:
+            return
+
+        try:
+            errors = get_sink()("events_raw", rows)
+        except Exception as e:
+            entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery",
+                "errors": str(e),
+                "messages": len(rows),
+            }
+            print(json_dumps(entry))
+            # Messages are only delivered again if the failure may go away
+            for message in inserting:
+                if is_transient_error(e):
+                    self._nack(message)
+                else:
+                    self._ack(message)
+            return
+        self.batches += 1
+
+        by_row = collections.defaultdict(list)
+        for error in errors or ():
+            by_row[error["index"]].extend(error.get("errors", ()))
+        deduplicator.add_many(
+            [row[4] for index, row in enumerate(rows) if not by_row.get(index)]
+        )
+        for index, message in enumerate(inserting):
+            row_errors = by_row.get(index)
+            if not row_errors:
+                self._ack(message)
+                continue
+            entry = {
+                "severity": "WARNING",
+                "msg": "Row not inserted.",
+                "errors": [{"index": 0, "errors": row_errors}],
+                "row": [rows[index]],
+            }
+            print(json_dumps(entry))
+            if any(error.get("reason") in RETRYABLE_REASONS for error in row_errors):
+                self._nack(message)
+            else:
+                self._ack(message)
+
+    def _parse(self, message):
+        """
+        Returns the event of a pulled message, or None once the message that
+        could not be parsed was acked or nacked
+        """
+        msg = pulled_message(message)
+        try:
+            event = self.process_message(msg)
+            if not event:
+                raise Exception("No data to insert")
+            return event
+        except Exception as e:
+            # An unsupported event type or a malformed payload fails on
+            # every delivery, so only transient failures are redelivered
+            retry = isinstance(e, RetryableInsertError) or is_transient_error(e)
+            entry = {
+                "severity": "WARNING",
+                "msg": "Data not saved to BigQuery"
+                + (", message will be redelivered" if retry else ""),
+                "errors": str(e),
+                "json_payload": {"message": msg},
+            }
+            print(json_dumps(entry, default=base64_data))
+            if retry:
+                self._nack(message)
+            else:
+                self._ack(message)
+            return None
+
+    def _ack(self, message):
+        message.ack()
+        self.acked += 1
+
+    def _nack(self, message):
+        message.nack()
+        self.nacked += 1
+
+
+def consume(process_message, subscription=None):
+    """
+    Runs a PullConsumer on `subscription`, by default PULL_SUBSCRIPTION, until
+    the process gets SIGTERM
+    """
+    PullConsumer(subscription or PULL_SUBSCRIPTION, process_message).run()
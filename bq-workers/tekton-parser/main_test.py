@@ -18,7 +18,7 @@ import json
 import main
 import shared
 
-from cloudevents.http import CloudEvent, to_structured
+from cloudevents.http import CloudEvent, to_binary, to_structured
 
 import mock
 import pytest
@@ -100,3 +100,38 @@ def test_tekton_source_event_processed(client):
 
     shared.insert_row_into_bigquery.assert_called_with(event)
     assert r.status_code == 204
+
+
+def test_tekton_event_with_header_attributes_processed(client):
+    attributes = {
+        "type": "tekton.foo",
+        "source": "https://example.com/event-producer",
+        "time": "0",
+        "id": "bar"
+    }
+    data = {"pipelineRun": {"metadata": {"uid": "foo"}}}
+
+    # The event handler publishes binary mode CloudEvent headers as attributes
+    headers, body = to_binary(CloudEvent(attributes, data))
+
+    pubsub_msg = {
+        "message": {
+            "data": base64.b64encode(body).decode("utf-8"),
+            "attributes": headers,
+            "message_id": "foobar",
+        },
+    }
+
+    shared.insert_row_into_bigquery = mock.MagicMock()
+
+    r = client.post(
+        "/",
+        data=json.dumps(pubsub_msg),
+        headers={"Content-Type": "application/json"},
+    )
+
+    event = shared.insert_row_into_bigquery.call_args.args[0]
+    assert (event["event_type"], event["id"], event["signature"]) == (
+        "tekton.foo", "foo", "bar"
+    )
+    assert r.status_code == 204
@@ -0,0 +1,315 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ASGI entry point for the event handler.
+
+It accepts the same webhooks as `event_handler:app`, but waits for Secret
+Manager and Pub/Sub without holding a thread, so one instance can keep
+hundreds of deliveries in flight:
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+"""
+
+import asyncio
+import sys
+import time
+from urllib.parse import parse_qsl
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import abort, HTTPException
+
+import batch
+import event_handler
+import ingress
+import metrics
+import sources
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/healthz" and scope["method"] == "GET":
+        await asyncio.get_running_loop().run_in_executor(None, event_handler.warm_up)
+        await _respond(send, "ok", 200)
+        return
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        await _respond(
+            send, generate_latest(metrics.REGISTRY), 200,
+            {"Content-Type": CONTENT_TYPE_LATEST},
+        )
+        return
+    if scope["path"] == "/batch":
+        handler, methods = batch_index, ("POST",)
+    elif scope["path"] == "/":
+        handler, methods = index, ("GET", "POST")
+    else:
+        await _respond(send, "Not Found", 404)
+        return
+    if scope["method"] not in methods:
+        await _respond(send, "Method Not Allowed", 405)
+        return
+
+    try:
+        response = await handler(scope, receive)
+        await _respond(send, *response)
+    except HTTPException as e:
+        await _respond(send, e.description, e.code)
+
+
+async def index(scope, receive):
+    """
+    Receives event data from a webhook, checks if the source is authorized,
+    checks if the signature is verified, and then sends the data to Pub/Sub.
+    """
+    headers, args = _request(scope)
+
+    started = time.perf_counter()
+
+    # Check if the source is authorized
+    source, team, signature = event_handler.get_signature(headers, args)
+    team_metrics = metrics.for_team(source, team)
+    try:
+        return await _handle(receive, headers, source, team, signature, team_metrics)
+    finally:
+        team_metrics.request.observe(time.perf_counter() - started)
+
+
+async def _handle(receive, headers, source, team, signature, team_metrics):
+    auth_source = sources.AUTHORIZED_SOURCES[source]
+
+    content_length = headers.get("Content-Length", type=int)
+    if content_length is not None and content_length > event_handler.MAX_BODY_BYTES:
+        abort(413)
+
+    # Load the team secret without blocking, so that the HMAC and the
+    # verification function below are served from the secret cache.
+    started = time.perf_counter()
+    try:
+        await sources.read_secret_async(team)
+    except Exception as e:
+        event_handler.secret_unavailable(source, e)
+    team_metrics.secret.observe(time.perf_counter() - started)
+
+    # Read the body, hashing it as it arrives for sources that sign it
+    started = time.perf_counter()
+    mac = await _in_thread(event_handler.new_body_hmac, auth_source, team, source)
+    body = await _read_body(receive, mac)
+
+    # Verify the signature. The secret is normally served from the cache
+    # loaded above, but would be read from Secret Manager on a miss, so the
+    # calls that read it run in a thread.
+    verify_signature = auth_source.verification
+    if mac is None:
+        verified = await _in_thread(verify_signature, signature, team, body)
+    else:
+        verified = verify_signature(signature, team, body, mac=mac)
+    if not verified:
+        event_handler.reject(source, metrics.SIGNATURE_MISMATCH)
+    team_metrics.verify.observe(time.perf_counter() - started)
+
+    # Drop or divert event types the parsers do not store
+    action, event_type, topic = event_handler.INGRESS_FILTER.decide(
+        source, headers, body
+    )
+    if action == ingress.DROP:
+        return f"Event ignored: {event_type}", 200
+
+    # Drop redeliveries of webhooks that were already accepted
+    delivery = None
+    if event_handler.DEDUPLICATOR is not None:
+        delivery = sources.delivery_key(source, headers, signature, body)
+        if event_handler.DEDUPLICATOR.is_duplicate(delivery):
+            return "Duplicate delivery", 200
+
+    # Throttle teams and sources over their rate limit
+    if event_handler.RATE_LIMITER is not None:
+        wait, scope = event_handler.RATE_LIMITER.acquire(source, team)
+        if scope is not None:
+            return event_handler.throttled(team_metrics, wait, scope)
+
+    # Queue for Pub/Sub in fast-ack mode
+    pubsub_headers = event_handler.pubsub_headers(headers, team, auth_source)
+    if event_handler.PUBLISH_QUEUE is not None:
+        if not event_handler.PUBLISH_QUEUE.put(topic, body, pubsub_headers):
+            return event_handler.queue_full()
+        event_handler.accepted(delivery)
+        return "", 202
+
+    # Publish to Pub/Sub
+    if await publish_to_pubsub(topic, body, pubsub_headers):
+        event_handler.accepted(delivery)
+
+    # Flush the stdout to avoid log buffering.
+    sys.stdout.flush()
+    return "", 204
+
+
+async def batch_index(scope, receive):
+    """
+    Receives a signed NDJSON batch of events and publishes every event, like
+    event_handler.batch_endpoint
+    """
+    headers, args = _request(scope)
+
+    started = time.perf_counter()
+
+    team = args.get("team", default=None)
+    team_metrics = metrics.for_team(batch.SOURCE, team)
+    try:
+        return await _handle_batch(receive, headers, team, team_metrics)
+    finally:
+        team_metrics.request.observe(time.perf_counter() - started)
+
+
+async def _handle_batch(receive, headers, team, team_metrics):
+    signature = headers.get(batch.SIGNATURE_HEADER)
+    if not signature:
+        event_handler.reject(batch.SOURCE, metrics.SIGNATURE_MISSING)
+
+    content_length = headers.get("Content-Length", type=int)
+    if content_length is not None and content_length > event_handler.MAX_BODY_BYTES:
+        abort(413)
+
+    started = time.perf_counter()
+    try:
+        await sources.read_secret_async(team)
+    except Exception as e:
+        event_handler.secret_unavailable(batch.SOURCE, e)
+    team_metrics.secret.observe(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    mac = await _in_thread(
+        event_handler.new_body_hmac, batch.EVENT_SOURCE, team, batch.SOURCE
+    )
+    body = await _read_body(receive, mac)
+    if not batch.batch_verification(signature, team, body, mac=mac):
+        event_handler.reject(batch.SOURCE, metrics.SIGNATURE_MISMATCH)
+    team_metrics.verify.observe(time.perf_counter() - started)
+
+    if event_handler.RATE_LIMITER is not None:
+        wait, scope = event_handler.RATE_LIMITER.acquire(batch.SOURCE, team)
+        if scope is not None:
+            return event_handler.throttled(team_metrics, wait, scope)
+
+    # Publishing blocks on the publisher flow control, so it runs in a thread
+    def publish():
+        data = batch.decode(body, headers.get("Content-Encoding"))
+        return event_handler.publish_batch(data, team)
+
+    try:
+        results = await _in_thread(publish)
+    except batch.BatchError as e:
+        abort(400, str(e))
+    return event_handler.batch_response(results)
+
+
+async def publish_to_pubsub(source, msg, headers):
+    """
+    Publishes the message to Cloud Pub/Sub, falling back to the outbox.
+    Returns False if the message was lost.
+    """
+    data, attributes = event_handler.pubsub_message(msg, headers)
+    try:
+        started = time.perf_counter()
+        with event_handler.PUBLISH_BREAKER.guard():
+            # Publishing blocks while the publisher flow control is full, and
+            # the first call creates the client, so it runs in a thread
+            future = await _in_thread(
+                event_handler.publish_with_fallback, source, data, attributes
+            )
+            message_id = await _wait_for_message(future)
+        metrics.for_team(source, headers.get("X-Team")).publish.observe(
+            time.perf_counter() - started
+        )
+
+        print(f"Published message: {message_id}")
+        return True
+
+    except Exception as e:
+        # Appending to the outbox writes to disk
+        return await _in_thread(event_handler.publish_failed, source, data, attributes, e)
+
+
+def _request(scope):
+    headers = Headers(
+        # Match the header names Flask gives to event_handler.index
+        (name.decode("latin-1").title(), value.decode("latin-1"))
+        for name, value in scope["headers"]
+    )
+    args = MultiDict(
+        parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+    )
+    return headers, args
+
+
+async def _in_thread(function, *args):
+    """
+    Runs a blocking call in the default executor, off the event loop
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+async def _wait_for_message(future):
+    return await asyncio.wait_for(
+        asyncio.wrap_future(future), event_handler.PUBLISH_TIMEOUT
+    )
+
+
+async def _read_body(receive, mac=None) -> bytes:
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > event_handler.MAX_BODY_BYTES:
+            abort(413)
+        if mac is not None:
+            mac.update(chunk)
+        chunks.append(chunk)
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+async def _respond(send, text, status: int, headers: dict = None):
+    body = text if isinstance(text, bytes) else text.encode("utf-8")
+    headers = {"Content-Type": "text/plain; charset=utf-8", **(headers or {})}
+    raw_headers = [(b"content-length", str(len(body)).encode())]
+    for name, value in headers.items():
+        raw_headers.append((name.lower().encode(), value.encode()))
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": raw_headers,
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
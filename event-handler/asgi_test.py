@@ -0,0 +1,267 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import concurrent.futures
+import hmac
+from hashlib import sha1, sha256
+
+import asgi
+import circuit_breaker
+import dedup
+import sources
+
+import mock
+import pytest
+
+
+async def get_secrets_fake(project_name, secret_name, version_num) -> bytes:
+    return {"event-handler": b"foo", "event-handler-team1": b"foo-team1"}[secret_name]
+
+
+@pytest.fixture(autouse=True)
+def clear_secret_cache():
+    sources.SECRET_CACHE.invalidate()
+
+
+@pytest.fixture(autouse=True)
+def deduplicator():
+    with mock.patch("event_handler.DEDUPLICATOR", dedup.DeliveryDeduplicator()) as d:
+        yield d
+
+
+def post(path="/", body=b"", headers=None, method="POST"):
+    """
+    Sends one request through the ASGI app and returns the status and body
+    """
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in (headers or {}).items()
+        ],
+    }
+    chunks = [body[:2], body[2:]]
+    sent = []
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    return sent[0]["status"], sent[1]["body"]
+
+
+def test_unauthorized_source():
+    status, _ = post(body=b"Hello")
+    assert status == 403
+
+
+def test_unknown_path():
+    status, _ = post(path="/foo")
+    assert status == 404
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+def test_unverified_signature():
+    status, _ = post(
+        body=b"Hello",
+        headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": "foobar"},
+    )
+    assert status == 403
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+def test_unknown_team():
+    status, _ = post(
+        path="/?team=unknown",
+        body=b"Hello",
+        headers={"X-Gitlab-Event": "test", "X-Gitlab-Token": "foo"},
+    )
+    assert status == 403
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("asgi.publish_to_pubsub")
+def test_data_sent_to_pubsub_with_team(publish_to_pubsub):
+    signature = "sha1=" + hmac.new(b"foo-team1", b"Hello", sha1).hexdigest()
+    status, _ = post(
+        path="/?team=team1",
+        body=b"Hello",
+        headers={
+            "User-Agent": "GitHub-Hookshot",
+            "X-Hub-Signature": signature,
+            "Authorization": "secret",
+        },
+    )
+
+    assert status == 204
+    publish_to_pubsub.assert_called_with(
+        "github", b"Hello", {
+            "X-Hub-Signature": signature,
+            "X-Team": "team1",
+        }
+    )
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("asgi.publish_to_pubsub")
+def test_verified_jira_signature(publish_to_pubsub):
+    status, _ = post(
+        path="/?token=foo",
+        body=b"Hello",
+        headers={"User-Agent": "Atlassian Webhook HTTP Client"},
+    )
+    assert status == 204
+
+
+def blocking_call(result):
+    """
+    Returns a fake blocking function that fails when it is called on the
+    event loop
+    """
+    def call(*args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return result
+        raise AssertionError("Blocking call on the event loop")
+    return call
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("sources.read_secret", blocking_call(b"foo-team1"))
+@mock.patch("asgi.publish_to_pubsub")
+def test_hmac_secret_is_read_off_the_event_loop(publish_to_pubsub):
+    signature = "sha1=" + hmac.new(b"foo-team1", b"Hello", sha1).hexdigest()
+    status, _ = post(
+        path="/?team=team1",
+        body=b"Hello",
+        headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature},
+    )
+    assert status == 204
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("sources.read_secret", blocking_call(b"foo"))
+@mock.patch("asgi.publish_to_pubsub")
+def test_token_secret_is_read_off_the_event_loop(publish_to_pubsub):
+    status, _ = post(
+        path="/?token=foo",
+        body=b"Hello",
+        headers={"User-Agent": "Atlassian Webhook HTTP Client"},
+    )
+    assert status == 204
+
+
+@mock.patch("publisher.publish")
+def test_publish_awaits_future(publish):
+    future = concurrent.futures.Future()
+    future.set_result("1")
+    publish.return_value = future
+
+    asyncio.run(asgi.publish_to_pubsub("github", b"Hello", {"X-Team": "default"}))
+    publish.assert_called_once_with("github", b"Hello", **{"X-Team": "default"})
+
+
+@mock.patch("event_handler.publish_failed")
+@mock.patch("publisher.publish")
+def test_publish_runs_off_the_event_loop(publish, publish_failed):
+    future = concurrent.futures.Future()
+    future.set_result("1")
+    publish.side_effect = blocking_call(future)
+
+    assert asyncio.run(asgi.publish_to_pubsub("github", b"Hello", {}))
+    publish.assert_called_once()
+    publish_failed.assert_not_called()
+
+
+@mock.patch("event_handler.publish_failed")
+@mock.patch("publisher.publish")
+def test_publish_failure_is_handled(publish, publish_failed):
+    publish.side_effect = Exception("unavailable")
+
+    asyncio.run(asgi.publish_to_pubsub("github", b"Hello", {}))
+    publish_failed.assert_called_once()
+
+
+@mock.patch("publisher.publish")
+def test_outbox_append_runs_off_the_event_loop(publish):
+    publish.side_effect = Exception("unavailable")
+    outbox = mock.MagicMock()
+    outbox.append.side_effect = blocking_call(None)
+    outbox.depth.return_value = 1
+
+    with mock.patch("event_handler.OUTBOX", outbox):
+        assert asyncio.run(asgi.publish_to_pubsub("github", b"Hello", {}))
+    outbox.append.assert_called_once()
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("asgi.publish_to_pubsub")
+def test_oversized_body_is_rejected(publish_to_pubsub):
+    with mock.patch("event_handler.MAX_BODY_BYTES", 4):
+        status, _ = post(
+            body=b"Hello",
+            headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": "foo"},
+        )
+    assert status == 413
+    publish_to_pubsub.assert_not_called()
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+def test_metrics():
+    post(headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": "foobar"})
+    status, body = post(path="/metrics", method="GET")
+
+    assert status == 200
+    assert b"event_handler_rejected_requests_total" in body
+
+
+@mock.patch("sources.get_secret_async", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_batch")
+def test_batch(publish_batch):
+    publish_batch.return_value = [{"line": 1, "status": "published", "message_id": "1"}]
+    body = b'{"source": "github", "body": {}}\n'
+    signature = "sha256=" + hmac.new(b"foo-team1", body, sha256).hexdigest()
+
+    status, _ = post(path="/batch?team=team1", body=body)
+    assert status == 403
+
+    status, response = post(
+        path="/batch?team=team1", body=body, headers={"X-Batch-Signature": signature}
+    )
+    assert status == 200
+    assert b'"published": 1' in response
+    publish_batch.assert_called_once_with(body, "team1")
+
+
+@mock.patch("publisher.publish")
+@mock.patch("event_handler.publish_failed")
+def test_open_publish_breaker_fails_fast(publish_failed, publish):
+    breaker = circuit_breaker.CircuitBreaker("pubsub")
+    breaker.state, breaker._opened_at = circuit_breaker.OPEN, breaker._clock()
+
+    with mock.patch("event_handler.PUBLISH_BREAKER", breaker):
+        asyncio.run(asgi.publish_to_pubsub("github", b"Hello", {"X-Team": "default"}))
+
+    publish.assert_not_called()
+    assert isinstance(publish_failed.call_args.args[3], circuit_breaker.CircuitOpenError)
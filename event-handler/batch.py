@@ -0,0 +1,195 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batches of events posted to /batch, e.g. to backfill the history of a team.
+
+A batch is NDJSON, optionally gzip compressed with `Content-Encoding: gzip`,
+with one event per line:
+
+    {"source": "github", "headers": {"X-Github-Event": "push"}, "body": {...}}
+
+"body" is the webhook payload, as a JSON value or as a string, and "headers"
+the webhook headers the parser reads. Without "source", the source is found
+from the headers like for a webhook. The whole request body, as sent, is
+signed with the team secret in the X-Batch-Signature header:
+
+    X-Batch-Signature: sha256=<hex HMAC-SHA256 of the body>
+"""
+
+import hmac
+import json
+import os
+import zlib
+from hashlib import sha256
+from typing import Iterator, Tuple, Union
+
+from werkzeug.datastructures import Headers
+
+import fast_json
+import sources
+
+# Larger batches, once decompressed, are rejected with 400
+MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", 256 * 1024 * 1024))
+# Batches with more events are rejected with 400
+MAX_EVENTS = int(os.environ.get("BATCH_MAX_EVENTS", 100000))
+
+# Source label of batch requests in the metrics and rate limits
+SOURCE = "batch"
+SIGNATURE_HEADER = "X-Batch-Signature"
+
+# Results of the events of a batch
+PUBLISHED = "published"
+IGNORED = "ignored"
+DUPLICATE = "duplicate"
+INVALID = "invalid"
+OUTBOX = "outbox"
+FAILED = "failed"
+STATUSES = (PUBLISHED, IGNORED, DUPLICATE, INVALID, OUTBOX, FAILED)
+
+DECOMPRESS_CHUNK_BYTES = 1024 * 1024
+
+
+class BatchError(ValueError):
+    """
+    A batch that cannot be read at all
+    """
+
+
+class BatchEvent(object):
+    """
+    One event of a batch
+    """
+
+    def __init__(self, source: str, headers: Headers, body: bytes):
+        self.source = source
+        self.headers = headers
+        self.body = body
+
+
+def batch_verification(signature: str, team: Union[str, None], body: bytes,
+                       mac: hmac.HMAC = None) -> bool:
+    """
+    Verifies the signature of a batch. `mac` is an HMAC from new_hmac that
+    was already fed the body.
+    """
+    expected_signature = "sha256="
+    try:
+        hashed = mac or hmac.new(sources.read_secret(team), body, sha256)
+        expected_signature += hashed.hexdigest()
+    except Exception as e:
+        print(e)
+        return False
+
+    return hmac.compare_digest(signature, expected_signature)
+
+
+EVENT_SOURCE = sources.EventSource(SIGNATURE_HEADER, batch_verification, sha256)
+
+
+def decode(body: bytes, content_encoding: Union[str, None]) -> bytes:
+    """
+    Returns the NDJSON of a batch, decompressing it if it is gzip encoded.
+    Raises BatchError if it cannot be decompressed or is over MAX_BYTES.
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        data = body
+    elif encoding in ("gzip", "x-gzip"):
+        data = _gunzip(body)
+    else:
+        raise BatchError(f"Unsupported Content-Encoding: {content_encoding}")
+
+    if len(data) > MAX_BYTES:
+        raise BatchError(f"Batch is larger than {MAX_BYTES} bytes")
+    return data
+
+
+def _gunzip(body: bytes) -> bytes:
+    # Decompressed in bounded steps, so that a small body cannot make the
+    # handler allocate more than MAX_BYTES
+    chunks = []
+    size = 0
+    data = body
+    try:
+        while data:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            while data:
+                chunk = decompressor.decompress(data, DECOMPRESS_CHUNK_BYTES)
+                size += len(chunk)
+                if size > MAX_BYTES:
+                    raise BatchError(f"Batch is larger than {MAX_BYTES} bytes")
+                chunks.append(chunk)
+                data = decompressor.unconsumed_tail
+            if not decompressor.eof:
+                raise BatchError("Truncated gzip body")
+            # Concatenated gzip members are one stream
+            data = decompressor.unused_data
+    except zlib.error as e:
+        raise BatchError(f"Invalid gzip body: {e}")
+    return b"".join(chunks)
+
+
+def parse(data: bytes) -> Iterator[Tuple[int, Union[BatchEvent, str]]]:
+    """
+    Yields the line number and the event of each non-empty line, or the
+    reason the line is not a valid event. Raises BatchError if the batch has
+    more than MAX_EVENTS events.
+    """
+    events = 0
+    for number, line in enumerate(data.splitlines(), start=1):
+        if not line.strip():
+            continue
+        events += 1
+        if events > MAX_EVENTS:
+            raise BatchError(f"Batch has more than {MAX_EVENTS} events")
+        try:
+            yield number, parse_line(line)
+        except ValueError as e:
+            yield number, str(e)
+
+
+def parse_line(line: bytes) -> BatchEvent:
+    """
+    Returns the event of a line. Raises ValueError if it is not valid.
+    """
+    try:
+        event = fast_json.loads(line)
+    except ValueError:
+        raise ValueError("Line is not valid JSON")
+    if not isinstance(event, dict):
+        raise ValueError("Line is not a JSON object")
+
+    headers = event.get("headers", {})
+    if not isinstance(headers, dict) or not all(
+        isinstance(value, str) for value in headers.values()
+    ):
+        raise ValueError("headers must be an object of strings")
+    # Header names are case-insensitive, normalized like those of a request
+    headers = Headers({name.title(): value for name, value in headers.items()})
+
+    if "body" not in event:
+        raise ValueError("body is missing")
+    body = event["body"]
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    else:
+        # Encoded by the json module, as parsers hash the message data into
+        # the event signature
+        body = json.dumps(body).encode("utf-8")
+
+    source = event.get("source") or sources.get_source(headers)
+    if source not in sources.AUTHORIZED_SOURCES:
+        raise ValueError(f"Source not authorized: {source}")
+    return BatchEvent(source, headers, body)
@@ -0,0 +1,83 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+
+import batch
+
+import mock
+import pytest
+
+
+def test_events_are_parsed():
+    data = (
+        b'{"source": "github", "headers": {"X-Github-Event": "push"}, "body": {"a": 1}}\n'
+        b"\n"
+        b'{"headers": {"X-Gitlab-Event": "Push Hook"}, "body": "{\\"b\\": 2}"}\n'
+    )
+
+    events = list(batch.parse(data))
+
+    assert [number for number, _ in events] == [1, 3]
+    github, gitlab = events[0][1], events[1][1]
+    assert github.source == "github"
+    assert github.headers["x-github-event"] == "push"
+    assert github.body == b'{"a": 1}'
+    assert gitlab.source == "gitlab"
+    assert gitlab.body == b'{"b": 2}'
+
+
+@pytest.mark.parametrize("line, error", [
+    (b"{", "Line is not valid JSON"),
+    (b"[]", "Line is not a JSON object"),
+    (b'{"source": "github"}', "body is missing"),
+    (b'{"source": "github", "headers": {"a": 1}, "body": ""}', "headers must be an object of strings"),
+    (b'{"body": ""}', "Source not authorized: None"),
+    (b'{"source": "foo", "body": ""}', "Source not authorized: foo"),
+])
+def test_invalid_lines_are_reported(line, error):
+    assert list(batch.parse(line)) == [(1, error)]
+
+
+def test_too_many_events():
+    with mock.patch("batch.MAX_EVENTS", 1):
+        with pytest.raises(batch.BatchError):
+            list(batch.parse(b'{"body": ""}\n{"body": ""}'))
+
+
+def test_gzip_batches_are_decompressed():
+    data = b'{"source": "github", "body": {}}\n' * 100
+    # Concatenated members, as written by `gzip -c a b`
+    body = gzip.compress(data[:500]) + gzip.compress(data[500:])
+
+    assert batch.decode(body, "gzip") == data
+    assert batch.decode(data, None) == data
+
+
+def test_decompressed_size_is_bounded():
+    body = gzip.compress(bytes(10 * 1024 * 1024))
+
+    with mock.patch("batch.MAX_BYTES", 1024 * 1024):
+        with pytest.raises(batch.BatchError):
+            batch.decode(body, "gzip")
+
+
+@pytest.mark.parametrize("body, encoding", [
+    (b"not gzip", "gzip"),
+    (gzip.compress(b"{}")[:-4], "gzip"),
+    (b"{}", "br"),
+])
+def test_undecodable_batches(body, encoding):
+    with pytest.raises(batch.BatchError):
+        batch.decode(body, encoding)
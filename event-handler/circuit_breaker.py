@@ -0,0 +1,206 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Circuit breakers around calls to Secret Manager and Pub/Sub.
+
+A breaker is closed while calls succeed. Once FAILURE_RATE of the last
+WINDOW calls failed or took longer than SLOW_CALL_SECONDS, it opens and
+calls fail immediately with CircuitOpenError instead of holding a request
+thread. After OPEN_SECONDS it lets HALF_OPEN_CALLS probe calls through:
+if they succeed it closes, otherwise it opens again.
+
+    with breaker.guard():
+        client.call()
+"""
+
+import collections
+import contextlib
+import os
+import threading
+import time
+from typing import Callable, Dict
+
+import fast_json
+
+ENABLED = os.environ.get("CIRCUIT_BREAKERS", "true").lower() == "true"
+FAILURE_RATE = float(os.environ.get("CIRCUIT_BREAKER_FAILURE_RATE", 0.5))
+# Calls the failure rate is computed over, and the fewest to open on
+WINDOW = int(os.environ.get("CIRCUIT_BREAKER_WINDOW", 20))
+MINIMUM_CALLS = int(os.environ.get("CIRCUIT_BREAKER_MINIMUM_CALLS", 10))
+# Successful calls slower than this count as failures
+SLOW_CALL_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL_SECONDS", 5))
+OPEN_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_OPEN_SECONDS", 30))
+HALF_OPEN_CALLS = int(os.environ.get("CIRCUIT_BREAKER_HALF_OPEN_CALLS", 1))
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a call while the breaker is open
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Failure-rate circuit breaker shared by the request threads of the process
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = FAILURE_RATE,
+        window: int = WINDOW,
+        minimum_calls: int = MINIMUM_CALLS,
+        slow_call_seconds: float = SLOW_CALL_SECONDS,
+        open_seconds: float = OPEN_SECONDS,
+        half_open_calls: int = HALF_OPEN_CALLS,
+        is_failure: Callable[[Exception], bool] = None,
+        on_transition: Callable[[str, str, str], None] = None,
+        on_reject: Callable[[str], None] = None,
+        enabled: bool = ENABLED,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.minimum_calls = min(minimum_calls, window)
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        # Errors that are not an outage, e.g. NotFound, can be left out
+        self.is_failure = is_failure
+        self.on_transition = on_transition
+        self.on_reject = on_reject
+        self.enabled = enabled
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at = None
+        self._probes = 0
+        self._probe_successes = 0
+        self.rejected = 0
+
+    @contextlib.contextmanager
+    def guard(self):
+        """
+        Runs the body as a call through the breaker. Raises CircuitOpenError
+        without running it while the breaker is open.
+        """
+        probe = self.acquire()
+        started = self._clock()
+        try:
+            yield
+        except Exception as e:
+            self.record(self.counts_as_failure(e), probe)
+            raise
+        self.record(self._clock() - started >= self.slow_call_seconds, probe)
+
+    def acquire(self) -> bool:
+        """
+        Admits a call, returning True if it is a half-open probe. Raises
+        CircuitOpenError if the call is not admitted.
+        """
+        if not self.enabled:
+            return False
+        transition = None
+        with self._lock:
+            if self.state == OPEN and self._clock() - self._opened_at >= self.open_seconds:
+                transition = self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                admitted, probe = True, False
+            elif self.state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                admitted, probe = True, True
+            else:
+                self.rejected += 1
+                admitted = False
+        self._notify(transition)
+
+        if not admitted:
+            if self.on_reject is not None:
+                self.on_reject(self.name)
+            raise CircuitOpenError(f"Circuit breaker {self.name} is open")
+        return probe
+
+    def record(self, failed: bool, probe: bool = False):
+        """
+        Records the outcome of an admitted call
+        """
+        if not self.enabled:
+            return
+        transition = None
+        with self._lock:
+            if probe:
+                self._probes = max(0, self._probes - 1)
+                if self.state == HALF_OPEN:
+                    if failed:
+                        transition = self._transition(OPEN)
+                    else:
+                        self._probe_successes += 1
+                        if self._probe_successes >= self.half_open_calls:
+                            transition = self._transition(CLOSED)
+            elif self.state == CLOSED:
+                # Calls that end after the breaker opened are not counted
+                self._outcomes.append(failed)
+                failures = sum(self._outcomes)
+                if (
+                    len(self._outcomes) >= self.minimum_calls
+                    and failures >= self.failure_rate * len(self._outcomes)
+                ):
+                    transition = self._transition(OPEN)
+        self._notify(transition)
+
+    def counts_as_failure(self, error: Exception) -> bool:
+        return self.is_failure is None or self.is_failure(error)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": len(self._outcomes),
+                "failures": sum(self._outcomes),
+                "rejected": self.rejected,
+            }
+
+    def _transition(self, state: str):
+        # Called with self._lock held
+        previous, self.state = self.state, state
+        if state == OPEN:
+            self._opened_at = self._clock()
+        elif state == HALF_OPEN:
+            self._probes = self._probe_successes = 0
+        else:
+            self._outcomes.clear()
+        return previous, state
+
+    def _notify(self, transition):
+        if transition is None:
+            return
+        previous, state = transition
+        entry = {
+            "severity": "WARNING" if state == OPEN else "INFO",
+            "msg": "Circuit breaker state changed",
+            "breaker": self.name,
+            "from": previous,
+            "to": state,
+        }
+        print(fast_json.dumps(entry))
+        if self.on_transition is not None:
+            self.on_transition(self.name, previous, state)
@@ -0,0 +1,138 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, HALF_OPEN, OPEN
+
+import mock
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def call(breaker, error=None, seconds=0.0):
+    with breaker.guard():
+        breaker._clock.now += seconds
+        if error is not None:
+            raise error
+
+
+def fail(breaker, times=1):
+    for _ in range(times):
+        with pytest.raises(Exception):
+            call(breaker, Exception("unavailable"))
+
+
+def new_breaker(**kwargs):
+    options = dict(
+        failure_rate=0.5, window=10, minimum_calls=4, slow_call_seconds=5,
+        open_seconds=30, half_open_calls=1, clock=FakeClock(),
+    )
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+
+def test_opens_at_failure_rate():
+    breaker = new_breaker()
+
+    call(breaker)
+    call(breaker)
+    fail(breaker)
+    assert breaker.state == CLOSED
+    fail(breaker)
+    assert breaker.state == OPEN
+
+    with pytest.raises(CircuitOpenError):
+        call(breaker)
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_needs_minimum_calls():
+    breaker = new_breaker()
+
+    fail(breaker, 3)
+    assert breaker.state == CLOSED
+
+
+def test_slow_calls_are_failures():
+    breaker = new_breaker()
+
+    for _ in range(4):
+        call(breaker, seconds=10)
+    assert breaker.state == OPEN
+
+
+def test_ignored_errors_are_not_failures():
+    breaker = new_breaker(is_failure=lambda e: not isinstance(e, KeyError))
+
+    for _ in range(4):
+        with pytest.raises(KeyError):
+            call(breaker, KeyError("missing"))
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_closes():
+    breaker = new_breaker()
+    fail(breaker, 4)
+
+    breaker._clock.now += 31
+    with breaker.guard():
+        assert breaker.state == HALF_OPEN
+        # Only one probe at a time
+        with pytest.raises(CircuitOpenError):
+            call(breaker)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls"] == 0
+
+
+def test_failed_probe_opens_again():
+    breaker = new_breaker()
+    fail(breaker, 4)
+
+    breaker._clock.now += 31
+    fail(breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        call(breaker)
+
+
+def test_transitions_are_reported():
+    on_transition, on_reject = mock.MagicMock(), mock.MagicMock()
+    breaker = new_breaker(on_transition=on_transition, on_reject=on_reject)
+
+    fail(breaker, 4)
+    with pytest.raises(CircuitOpenError):
+        call(breaker)
+    breaker._clock.now += 31
+    call(breaker)
+
+    assert on_transition.call_args_list == [
+        mock.call("test", CLOSED, OPEN),
+        mock.call("test", OPEN, HALF_OPEN),
+        mock.call("test", HALF_OPEN, CLOSED),
+    ]
+    on_reject.assert_called_once_with("test")
+
+
+def test_disabled_breaker_never_opens():
+    breaker = new_breaker(enabled=False)
+
+    fail(breaker, 10)
+    call(breaker)
+    assert breaker.state == CLOSED
@@ -0,0 +1,84 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compression of Pub/Sub message data. Compressed messages carry a
+"content-encoding" attribute, which the parsers use to decompress them in
+shared.decode_data.
+"""
+
+import gzip
+import os
+import threading
+from typing import Tuple, Union
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+# "gzip", "zstd" or empty to publish bodies as they are
+ENCODING = os.environ.get("PUBSUB_COMPRESSION", "").lower()
+# Smaller bodies are not worth the CPU
+MIN_BYTES = int(os.environ.get("PUBSUB_COMPRESSION_MIN_BYTES", 4096))
+# Defaults to 6 for gzip and 3 for zstd
+LEVEL = os.environ.get("PUBSUB_COMPRESSION_LEVEL")
+
+if ENCODING not in ("", GZIP, ZSTD):
+    raise ValueError(f"Unsupported PUBSUB_COMPRESSION: {ENCODING}")
+
+_zstd_compressors = threading.local()
+
+
+def compress(
+    data: bytes,
+    encoding: str = None,
+    min_bytes: int = None,
+    level: Union[int, str] = None,
+) -> Tuple[bytes, Union[str, None]]:
+    """
+    Returns the data to publish and its content encoding, or None if it
+    was not compressed. Arguments default to the environment configuration.
+    """
+    encoding = ENCODING if encoding is None else encoding
+    min_bytes = MIN_BYTES if min_bytes is None else min_bytes
+    level = LEVEL if level is None else level
+    if not encoding or len(data) < min_bytes:
+        return data, None
+
+    if encoding == GZIP:
+        # mtime=0 keeps the output identical for identical bodies
+        compressed = gzip.compress(
+            data, compresslevel=int(level or 6), mtime=0
+        )
+    elif encoding == ZSTD:
+        compressed = _zstd_compressor(int(level or 3)).compress(data)
+    else:
+        raise ValueError(f"Unsupported compression: {encoding}")
+
+    # Incompressible bodies are published as they are
+    if len(compressed) >= len(data):
+        return data, None
+    return compressed, encoding
+
+
+def _zstd_compressor(level: int):
+    # Compressors are not thread-safe, so each request thread keeps its own
+    compressors = getattr(_zstd_compressors, "by_level", None)
+    if compressors is None:
+        compressors = _zstd_compressors.by_level = {}
+    compressor = compressors.get(level)
+    if compressor is None:
+        import zstandard
+
+        compressor = compressors[level] = zstandard.ZstdCompressor(level=level)
+    return compressor
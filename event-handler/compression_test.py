@@ -0,0 +1,54 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+
+from compression import compress
+
+import pytest
+import zstandard
+
+PAYLOAD = json.dumps({"commits": [{"id": str(i), "message": "Fix"} for i in range(200)]}).encode()
+
+
+def test_compression_is_off_by_default():
+    assert compress(PAYLOAD, encoding="") == (PAYLOAD, None)
+
+
+def test_gzip():
+    data, encoding = compress(PAYLOAD, encoding="gzip", min_bytes=0)
+
+    assert encoding == "gzip"
+    assert len(data) < len(PAYLOAD)
+    assert gzip.decompress(data) == PAYLOAD
+    # Identical bodies compress identically
+    assert compress(PAYLOAD, encoding="gzip", min_bytes=0)[0] == data
+
+
+def test_zstd():
+    data, encoding = compress(PAYLOAD, encoding="zstd", min_bytes=0, level=19)
+
+    assert encoding == "zstd"
+    assert zstandard.ZstdDecompressor().decompress(data) == PAYLOAD
+
+
+def test_small_and_incompressible_bodies_are_not_compressed():
+    assert compress(b"Hello", encoding="gzip", min_bytes=1024) == (b"Hello", None)
+    assert compress(b"Hello", encoding="gzip", min_bytes=0) == (b"Hello", None)
+
+
+def test_unsupported_encoding():
+    with pytest.raises(ValueError):
+        compress(PAYLOAD, encoding="brotli", min_bytes=0)
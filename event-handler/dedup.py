@@ -0,0 +1,157 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time-bounded memory of webhook deliveries, used to drop redeliveries before
+they are published.
+
+Recent deliveries are kept exactly in an LRU. Deliveries evicted from the LRU
+are still remembered, with a small false positive rate, by a Bloom filter of
+two generations that rotates every `window` seconds (or once a generation
+holds `capacity` keys), so a key is remembered for one to two windows.
+"""
+
+import collections
+import hashlib
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict
+
+WINDOW = float(os.environ.get("DEDUP_WINDOW", 3600))
+LRU_SIZE = int(os.environ.get("DEDUP_LRU_SIZE", 10000))
+BLOOM_CAPACITY = int(os.environ.get("DEDUP_BLOOM_CAPACITY", 100000))
+BLOOM_FALSE_POSITIVE_RATE = float(
+    os.environ.get("DEDUP_BLOOM_FALSE_POSITIVE_RATE", 0.000001)
+)
+
+
+class BloomFilter(object):
+    """
+    Fixed-size Bloom filter sized for `capacity` keys at the given false
+    positive rate
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        bits = -capacity * math.log(false_positive_rate) / (math.log(2) ** 2)
+        self.size = max(8, int(math.ceil(bits)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class DeliveryDeduplicator(object):
+    """
+    Remembers delivery keys for a bounded time
+    """
+
+    def __init__(
+        self,
+        window: float = WINDOW,
+        lru_size: int = LRU_SIZE,
+        bloom_capacity: int = BLOOM_CAPACITY,
+        bloom_false_positive_rate: float = BLOOM_FALSE_POSITIVE_RATE,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.window = window
+        self.lru_size = lru_size
+        self.bloom_capacity = bloom_capacity
+        self.bloom_false_positive_rate = bloom_false_positive_rate
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._recent = collections.OrderedDict()
+        self._current = self._new_bloom()
+        self._previous = self._new_bloom()
+        self._rotated_at = clock()
+
+        self.unique = 0
+        self.duplicates = 0
+        self.probable_duplicates = 0
+
+    def is_duplicate(self, key: str) -> bool:
+        """
+        Returns True if the key was added within the window
+        """
+        with self._lock:
+            now = self._clock()
+            self._maybe_rotate(now)
+
+            added_at = self._recent.get(key)
+            if added_at is not None:
+                if now - added_at < self.window:
+                    self._recent.move_to_end(key)
+                    self.duplicates += 1
+                    return True
+                del self._recent[key]
+            elif key in self._current or key in self._previous:
+                self.probable_duplicates += 1
+                return True
+
+            self.unique += 1
+            return False
+
+    def add(self, key: str):
+        """
+        Remembers a delivery that was accepted
+        """
+        with self._lock:
+            now = self._clock()
+            self._maybe_rotate(now)
+
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.lru_size:
+                self._recent.popitem(last=False)
+            self._current.add(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "unique": self.unique,
+                "duplicates": self.duplicates,
+                "probable_duplicates": self.probable_duplicates,
+                "lru_size": len(self._recent),
+            }
+
+    def _new_bloom(self) -> BloomFilter:
+        return BloomFilter(self.bloom_capacity, self.bloom_false_positive_rate)
+
+    def _maybe_rotate(self, now: float):
+        if (
+            now - self._rotated_at >= self.window
+            or self._current.count >= self.bloom_capacity
+        ):
+            self._previous = self._current
+            self._current = self._new_bloom()
+            self._rotated_at = now
@@ -0,0 +1,69 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from dedup import BloomFilter, DeliveryDeduplicator
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.001)
+    keys = [f"github:{i}" for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    false_positives = sum(f"gitlab:{i}" in bloom for i in range(10000))
+    assert false_positives < 50
+
+
+def test_added_deliveries_are_duplicates():
+    dedup = DeliveryDeduplicator(clock=FakeClock())
+
+    assert not dedup.is_duplicate("github:1")
+    dedup.add("github:1")
+    assert dedup.is_duplicate("github:1")
+    assert not dedup.is_duplicate("github:2")
+
+    assert dedup.stats()["duplicates"] == 1
+    assert dedup.stats()["unique"] == 2
+
+
+def test_deliveries_evicted_from_lru_are_caught_by_bloom_filter():
+    dedup = DeliveryDeduplicator(lru_size=1, clock=FakeClock())
+    dedup.add("github:1")
+    dedup.add("github:2")
+
+    assert dedup.is_duplicate("github:1")
+    assert dedup.stats()["probable_duplicates"] == 1
+
+
+def test_deliveries_are_forgotten_after_two_windows():
+    clock = FakeClock()
+    dedup = DeliveryDeduplicator(window=10, lru_size=1, clock=clock)
+    dedup.add("github:1")
+    dedup.add("github:2")
+
+    clock.now = 15
+    assert dedup.is_duplicate("github:1")
+
+    clock.now = 25
+    assert not dedup.is_duplicate("github:1")
+    assert not dedup.is_duplicate("github:2")
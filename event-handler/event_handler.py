@@ -12,18 +12,111 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+from concurrent import futures
 import json
+import math
 import os
 import sys
+import threading
+import time
 
-from flask import abort, Flask, request
-from google.cloud import pubsub_v1
+from flask import abort, Flask, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
+import batch
+import circuit_breaker
+import compression
+import dedup
+import fast_json
+import ingress
+import metrics
+import outbox
+import publish_queue
+import publisher
+import rate_limit
+import routing
 import sources
 
 PROJECT_NAME = os.environ.get("PROJECT_NAME")
+PUBLISH_TIMEOUT = float(os.environ.get("PUBSUB_PUBLISH_TIMEOUT", 60))
+
+# Larger request bodies are rejected with 413. GitHub caps payloads at 25 MB.
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", 25 * 1024 * 1024))
+READ_CHUNK_BYTES = 64 * 1024
+# Per-thread body buffers larger than this are not kept between requests
+RETAINED_BUFFER_BYTES = 1024 * 1024
+_body_buffers = threading.local()
+
+# Webhook headers are published as individual attributes. Set
+# PUBSUB_HEADERS_ATTRIBUTE to also publish them as a JSON object in the
+# "headers" attribute, as read by parsers deployed before this change.
+HEADERS_ATTRIBUTE = (
+    os.environ.get("PUBSUB_HEADERS_ATTRIBUTE", "false").lower() == "true"
+)
+
+# Events of the teams listed in TOPIC_SHARDS are published to shard topics
+# of their source topic. See routing.py for the format.
+TOPIC_ROUTER = routing.TopicRouter(routing.load_shards(routing.SHARDS))
+
+# Publishing fails fast, to the outbox, while Pub/Sub is failing. Topics that
+# do not exist are handled by the topic router rather than counted.
+PUBLISH_BREAKER = circuit_breaker.CircuitBreaker(
+    metrics.PUBSUB,
+    is_failure=lambda error: not routing.is_missing_topic(error),
+    on_transition=metrics.circuit_breaker_transition,
+    on_reject=metrics.circuit_breaker_rejected,
+)
+
+# Messages that fail to publish are kept on disk and replayed in the
+# background when an outbox directory is configured.
+OUTBOX = None
+if os.environ.get("OUTBOX_DIR"):
+    OUTBOX = outbox.open_outbox(os.environ["OUTBOX_DIR"])
+    outbox.OutboxDrainer(
+        OUTBOX,
+        lambda topic, data, **attributes: publish_with_fallback(topic, data, attributes),
+        publish_timeout=PUBLISH_TIMEOUT,
+    ).start()
+    metrics.register_outbox(OUTBOX.stats)
+
+# In fast-ack mode, verified webhooks are acknowledged with 202 as soon as
+# they are queued, and worker threads publish them in the background.
+PUBLISH_QUEUE = None
+if os.environ.get("FAST_ACK", "false").lower() == "true":
+    PUBLISH_QUEUE = publish_queue.PublishQueue(
+        lambda source, msg, headers, done: publish_queued(source, msg, headers, done)
+    )
+    atexit.register(PUBLISH_QUEUE.close, PUBLISH_TIMEOUT)
+
+# Redeliveries of webhooks accepted within DEDUP_WINDOW are not published
+# again. Setting DEDUP_WINDOW to 0 disables deduplication.
+DEDUPLICATOR = None
+if dedup.WINDOW > 0:
+    DEDUPLICATOR = dedup.DeliveryDeduplicator()
+
+# Webhooks over the RATE_LIMITS of their team or source are rejected with 429
+RATE_LIMITER = rate_limit.from_environment()
+
+# Event types the parsers do not store are dropped (or diverted to another
+# topic) before publishing. See ingress.py for the INGRESS_FILTERS format.
+INGRESS_FILTER = ingress.IngressFilter(
+    ingress.load_rules(os.environ.get("INGRESS_FILTERS"))
+)
+
+# Responses to requests rejected with 403, by reason
+REJECTION_MESSAGES = {
+    metrics.SOURCE_NOT_AUTHORIZED: "Source not authorized: {source}",
+    metrics.SIGNATURE_MISSING: "Signature not found in request headers",
+    metrics.SECRET_UNAVAILABLE: "Signature does not match expected signature",
+    metrics.SIGNATURE_MISMATCH: "Signature does not match expected signature",
+}
+
+_warm = False
+_warm_up_lock = threading.Lock()
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_BODY_BYTES
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -33,68 +126,554 @@ def index():
     checks if the signature is verified, and then sends the data to Pub/Sub.
     """
 
+    g.started = time.perf_counter()
+
     # Check if the source is authorized
-    source = sources.get_source(request.headers)
+    source, team, signature = get_signature(request.headers, request.args)
+    auth_source = sources.AUTHORIZED_SOURCES[source]
+    team_metrics = g.team_metrics = metrics.for_team(source, team)
+
+    # Load the team secret, so that the HMAC and the verification function
+    # below are served from the secret cache.
+    started = time.perf_counter()
+    try:
+        sources.read_secret(team)
+    except Exception as e:
+        secret_unavailable(source, e)
+    team_metrics.secret.observe(time.perf_counter() - started)
+
+    # Read the body, hashing it as it arrives for sources that sign it.
+    # Werkzeug rejects bodies over MAX_CONTENT_LENGTH with 413.
+    started = time.perf_counter()
+    stream = request.stream
+    mac = new_body_hmac(auth_source, team, source)
+    body = read_body(stream, mac)
+
+    # Verify the signature
+    verify_signature = auth_source.verification
+    if not verify_signature(signature, team, body, mac=mac):
+        reject(source, metrics.SIGNATURE_MISMATCH)
+    team_metrics.verify.observe(time.perf_counter() - started)
+
+    # Drop or divert event types the parsers do not store
+    action, event_type, topic = INGRESS_FILTER.decide(source, request.headers, body)
+    if action == ingress.DROP:
+        return f"Event ignored: {event_type}", 200
+
+    # Drop redeliveries of webhooks that were already accepted
+    delivery = None
+    if DEDUPLICATOR is not None:
+        delivery = sources.delivery_key(source, request.headers, signature, body)
+        if DEDUPLICATOR.is_duplicate(delivery):
+            return "Duplicate delivery", 200
+
+    # Throttle teams and sources over their rate limit
+    if RATE_LIMITER is not None:
+        wait, scope = RATE_LIMITER.acquire(source, team)
+        if scope is not None:
+            return throttled(team_metrics, wait, scope)
+
+    # Queue for Pub/Sub in fast-ack mode
+    headers = pubsub_headers(request.headers, team, auth_source)
+    if PUBLISH_QUEUE is not None:
+        if not PUBLISH_QUEUE.put(topic, body, headers):
+            return queue_full()
+        accepted(delivery)
+        return "", 202
+
+    # Publish to Pub/Sub
+    if publish_to_pubsub(topic, body, headers):
+        accepted(delivery)
+
+    # Flush the stdout to avoid log buffering.
+    sys.stdout.flush()
+    return "", 204
+
+
+@app.route("/batch", methods=["POST"])
+def batch_endpoint():
+    """
+    Receives a signed NDJSON batch of events, e.g. to backfill the history
+    of a team, and publishes every event. Responds with the result of each
+    line. See batch.py for the format.
+    """
+
+    g.started = time.perf_counter()
+
+    team = request.args.get("team", default=None)
+    team_metrics = g.team_metrics = metrics.for_team(batch.SOURCE, team)
+    signature = request.headers.get(batch.SIGNATURE_HEADER)
+    if not signature:
+        reject(batch.SOURCE, metrics.SIGNATURE_MISSING)
+
+    started = time.perf_counter()
+    try:
+        sources.read_secret(team)
+    except Exception as e:
+        secret_unavailable(batch.SOURCE, e)
+    team_metrics.secret.observe(time.perf_counter() - started)
+
+    # The signature covers the body as sent, so it is checked before the
+    # body is decompressed
+    started = time.perf_counter()
+    mac = new_body_hmac(batch.EVENT_SOURCE, team, batch.SOURCE)
+    body = read_body(request.stream, mac)
+    if not batch.batch_verification(signature, team, body, mac=mac):
+        reject(batch.SOURCE, metrics.SIGNATURE_MISMATCH)
+    team_metrics.verify.observe(time.perf_counter() - started)
+
+    # A batch takes one token of its team and of the "batch" source
+    if RATE_LIMITER is not None:
+        wait, scope = RATE_LIMITER.acquire(batch.SOURCE, team)
+        if scope is not None:
+            return throttled(team_metrics, wait, scope)
+
+    try:
+        data = batch.decode(body, request.headers.get("Content-Encoding"))
+        results = publish_batch(data, team)
+    except batch.BatchError as e:
+        abort(400, str(e))
+    return batch_response(results)
+
+
+@app.after_request
+def observe_request(response):
+    team_metrics = g.get("team_metrics")
+    if team_metrics is not None:
+        team_metrics.request.observe(time.perf_counter() - g.started)
+    return response
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Readiness check. Warms the instance up, so that the first webhook does
+    not wait for the Google client libraries.
+    """
+    warm_up()
+    return "ok", 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    Serves the metrics of this process in the Prometheus text format
+    """
+    return generate_latest(metrics.REGISTRY), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+
+def warm_up():
+    """
+    Imports the Google client libraries, creates the Pub/Sub and Secret
+    Manager clients and topic paths, and loads the default secret
+    """
+    global _warm
+    if _warm:
+        return
+    with _warm_up_lock:
+        if _warm:
+            return
+        for topic in (*sources.AUTHORIZED_SOURCES, *TOPIC_ROUTER.topics()):
+            publisher.topic_path(topic)
+        sources.get_secret_client()
+        # Also opens the connection to Secret Manager
+        try:
+            sources.read_secret()
+        except Exception as e:
+            entry = {
+                "severity": "WARNING",
+                "msg": "Default secret not loaded during warm-up",
+                "errors": str(e),
+            }
+            print(fast_json.dumps(entry))
+        _warm = True
+
+
+def reject(source, reason):
+    """
+    Counts the rejection of a request and aborts it with 403
+    """
+    metrics.rejected(source, reason)
+    abort(403, REJECTION_MESSAGES[reason].format(source=source))
+
+
+def secret_unavailable(source, error):
+    """
+    Logs why the team secret could not be read and aborts with 403
+    """
+    entry = {
+        "severity": "WARNING",
+        "msg": "Secret not available",
+        "source": source,
+        "errors": f"{type(error).__name__}: {error}",
+    }
+    print(fast_json.dumps(entry))
+    reject(source, metrics.SECRET_UNAVAILABLE)
+
+
+def get_signature(headers, args):
+    """
+    Checks that the request comes from an authorized source and returns the
+    source, the team and the signature to verify
+    """
+    source = sources.get_source(headers)
 
     if source not in sources.AUTHORIZED_SOURCES:
+        metrics.rejected(metrics.UNAUTHORIZED, metrics.SOURCE_NOT_AUTHORIZED)
         abort(403, f"Source not authorized: {source}")
 
     auth_source = sources.AUTHORIZED_SOURCES[source]
-    team = request.args.get("team", default=None)
-    signature_sources = {**request.headers, **request.args}
+    team = args.get("team", default=None)
+    signature_sources = {**headers, **args}
     signature = signature_sources.get(auth_source.signature, None)
 
     if not signature:
-        abort(403, "Signature not found in request headers")
+        reject(source, metrics.SIGNATURE_MISSING)
 
-    body = request.data
+    return source, team, signature
 
-    # Verify the signature
-    verify_signature = auth_source.verification
-    if not verify_signature(signature, team, body):
-        abort(403, "Signature does not match expected signature")
 
+def new_body_hmac(auth_source, team, source=None):
+    """
+    Returns an HMAC to feed the body to, for sources that sign the body
+    """
+    if auth_source.digestmod is None:
+        return None
+    try:
+        return sources.new_hmac(team, auth_source.digestmod)
+    except Exception as e:
+        secret_unavailable(source, e)
+
+
+def read_body(stream, mac=None) -> bytes:
+    """
+    Reads the request body in chunks into a buffer reused by the requests of
+    the thread, feeding every chunk to the HMAC as it arrives
+    """
+    buffer = getattr(_body_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _body_buffers.buffer = bytearray(READ_CHUNK_BYTES)
+
+    size = 0
+    while True:
+        if len(buffer) - size < READ_CHUNK_BYTES:
+            buffer.extend(bytes(len(buffer)))
+        with memoryview(buffer) as view:
+            with view[size:size + READ_CHUNK_BYTES] as chunk:
+                read = stream.readinto(chunk)
+                if read and mac is not None:
+                    mac.update(chunk[:read])
+        if not read:
+            break
+        size += read
+
+    with memoryview(buffer) as view:
+        body = view[:size].tobytes()
+    if len(buffer) > RETAINED_BUFFER_BYTES:
+        del _body_buffers.buffer
+    return body
+
+
+def pubsub_headers(headers, team, auth_source=None):
+    """
+    Returns the request headers to publish along with the event: the headers
+    the parser of the source reads, and the team
+    """
     # Remove the Auth header so we do not publish it to Pub/Sub
-    pubsub_headers = dict(request.headers)
-    if "Authorization" in pubsub_headers:
-        del pubsub_headers["Authorization"]
-    if "X-Team" in pubsub_headers:
-        del pubsub_headers["X-Team"]
+    pubsub_headers = {
+        name: value for name, value in headers.items()
+        if name not in ("Authorization", "X-Team")
+        and (auth_source is None or auth_source.forwards(name))
+    }
 
     pubsub_headers["X-Team"] = team if team else "default"
+    return pubsub_headers
 
-    # Publish to Pub/Sub
-    publish_to_pubsub(source, body, pubsub_headers)
 
-    # Flush the stdout to avoid log buffering.
+def pubsub_message(msg, headers):
+    """
+    Returns the data and attributes of the Pub/Sub message of an event,
+    compressing the data when PUBSUB_COMPRESSION is set
+    """
+    # Pub/Sub data must be bytestring, attributes must be strings
+    attributes = dict(headers)
+    if HEADERS_ATTRIBUTE:
+        # Parsers hash the attributes into the event signature, so they are
+        # encoded by the json module as they always were
+        attributes["headers"] = json.dumps(headers)
+
+    data, encoding = compression.compress(msg)
+    if encoding is not None:
+        attributes["content-encoding"] = encoding
+    return data, attributes
+
+
+def accepted(delivery):
+    """
+    Remembers a delivery once it has been published or queued
+    """
+    if delivery is not None:
+        DEDUPLICATOR.add(delivery)
+
+
+def throttled(team_metrics, wait, scope):
+    """
+    Asks the sender to retry once its team or source has a token again
+    """
+    team_metrics.throttled[scope].inc()
+    retry_after = str(max(1, math.ceil(wait)))
+    return f"Too many requests for this {scope}", 429, {"Retry-After": retry_after}
+
+
+def queue_full():
+    """
+    Asks the sender to retry later when the publish queue is full
+    """
+    entry = {
+        "severity": "WARNING",
+        "msg": "Publish queue full, rejecting webhook",
+        **PUBLISH_QUEUE.stats(),
+    }
+    print(fast_json.dumps(entry))
+    retry_after = str(publish_queue.RETRY_AFTER)
+    return "Publish queue is full", 503, {"Retry-After": retry_after}
+
+
+def publish_batch(data, team):
+    """
+    Publishes the events of a batch, filtered and deduplicated like webhooks,
+    and returns the result of each line. Events are handed to the batching
+    publisher without waiting, so its flow control bounds the messages in
+    flight; messages that fail go to the outbox.
+    """
+    # Parsed up front, so that a batch over MAX_EVENTS publishes nothing
+    events = list(batch.parse(data))
+
+    results = []
+    pending = []
+    seen = set()
+    for number, event in events:
+        result = {"line": number}
+        results.append(result)
+        if isinstance(event, str):
+            result.update(status=batch.INVALID, error=event)
+            continue
+
+        source = event.source
+        action, event_type, topic = INGRESS_FILTER.decide(
+            source, event.headers, event.body
+        )
+        if action == ingress.DROP:
+            result.update(status=batch.IGNORED, event_type=event_type)
+            continue
+
+        delivery = None
+        if DEDUPLICATOR is not None:
+            delivery = sources.delivery_key(source, event.headers, None, event.body)
+            if delivery in seen or DEDUPLICATOR.is_duplicate(delivery):
+                result["status"] = batch.DUPLICATE
+                continue
+            seen.add(delivery)
+
+        auth_source = sources.AUTHORIZED_SOURCES[source]
+        headers = pubsub_headers(event.headers, team, auth_source)
+        msg, attributes = pubsub_message(event.body, headers)
+        routed, probe = topic, None
+        try:
+            probe = PUBLISH_BREAKER.acquire()
+            routed, future = publish_routed(topic, msg, attributes)
+        except Exception as e:
+            future = e
+        pending.append((result, topic, routed, msg, attributes, delivery, future, probe))
+
+    for result, topic, routed, msg, attributes, delivery, future, probe in pending:
+        try:
+            if isinstance(future, Exception):
+                raise future
+            result.update(
+                status=batch.PUBLISHED,
+                message_id=wait_for_message(topic, routed, future, msg, attributes),
+            )
+            PUBLISH_BREAKER.record(False, probe)
+        except Exception as e:
+            if probe is not None:
+                PUBLISH_BREAKER.record(PUBLISH_BREAKER.counts_as_failure(e), probe)
+            if publish_failed(topic, msg, attributes, e):
+                result["status"] = batch.OUTBOX
+            else:
+                result.update(status=batch.FAILED, error=str(e))
+                continue
+        accepted(delivery)
+
+    return results
+
+
+def batch_response(results):
+    """
+    Returns the response to a batch: the count of each result and the
+    result of each line
+    """
+    summary = dict.fromkeys(batch.STATUSES, 0)
+    for result in results:
+        summary[result["status"]] += 1
+    entry = {"severity": "INFO", "msg": "Batch processed", **summary}
+    print(fast_json.dumps(entry))
     sys.stdout.flush()
-    return "", 204
+    body = json.dumps({"summary": summary, "results": results})
+    return body, 200, {"Content-Type": "application/json"}
 
 
 def publish_to_pubsub(source, msg, headers):
     """
-    Publishes the message to Cloud Pub/Sub
+    Publishes the message to Cloud Pub/Sub, falling back to the outbox.
+    Returns False if the message was lost.
     """
+    data, attributes = pubsub_message(msg, headers)
     try:
-        publisher = pubsub_v1.PublisherClient()
-        topic_path = publisher.topic_path(PROJECT_NAME, source)
-        print(topic_path)
-
-        # Pub/Sub data must be bytestring, attributes must be strings
-        future = publisher.publish(
-            topic_path, data=msg, headers=json.dumps(headers)
+        # The publisher is shared by all request threads, so messages
+        # published concurrently are sent to Pub/Sub in one batch.
+        started = time.perf_counter()
+        with PUBLISH_BREAKER.guard():
+            routed, future = publish_routed(source, data, attributes)
+            message_id = wait_for_message(source, routed, future, data, attributes)
+        metrics.for_team(source, headers.get("X-Team")).publish.observe(
+            time.perf_counter() - started
         )
 
-        exception = future.exception()
-        if exception:
-            raise Exception(exception)
+        print(f"Published message: {message_id}")
+        return True
+
+    except Exception as e:
+        return publish_failed(source, data, attributes, e)
 
-        print(f"Published message: {future.result()}")
 
+def publish_queued(source, msg, headers, done):
+    """
+    Hands a message of the fast-ack queue to the publisher without waiting
+    for Pub/Sub, like publish_to_pubsub otherwise. `done` is called with
+    the outcome of the message, see publish_queue.py.
+    """
+    data, attributes = pubsub_message(msg, headers)
+    started = time.perf_counter()
+    probe = None
+
+    def failed(error):
+        if probe is not None:
+            PUBLISH_BREAKER.record(PUBLISH_BREAKER.counts_as_failure(error), probe)
+        outcome = publish_queue.LOST
+        try:
+            if publish_failed(source, data, attributes, error):
+                outcome = publish_queue.OUTBOX
+        except Exception as e:
+            # e.g. the outbox disk is full; runs in a future callback, where
+            # the error would go unnoticed
+            team_metrics = metrics.for_team(source, attributes.get("X-Team"))
+            team_metrics.publish_failures[metrics.LOST].inc()
+            entry = {
+                "severity": "ERROR",
+                "msg": "Queued message lost, outbox append failed",
+                "errors": str(e),
+            }
+            print(fast_json.dumps(entry))
+        finally:
+            done(outcome)
+
+    def published(future):
+        try:
+            message_id = future.result()
+        except Exception as e:
+            failed(e)
+            return
+        elapsed = time.perf_counter() - started
+        PUBLISH_BREAKER.record(elapsed >= PUBLISH_BREAKER.slow_call_seconds, probe)
+        metrics.for_team(source, headers.get("X-Team")).publish.observe(elapsed)
+        print(f"Published message: {message_id}")
+        done(publish_queue.PUBLISHED)
+
+    try:
+        probe = PUBLISH_BREAKER.acquire()
+        future = publish_with_fallback(source, data, attributes)
     except Exception as e:
-        # Log any exceptions to stackdriver
-        entry = dict(severity="WARNING", message=e)
-        print(entry)
+        failed(e)
+        return
+    future.add_done_callback(published)
+
+
+def publish_with_fallback(topic, data, attributes):
+    """
+    Queues a message for the shard topic of its team and returns a future of
+    its message ID. Like wait_for_message, but without blocking, the message
+    is published again to its topic if the shard topic does not exist.
+    """
+    result = futures.Future()
+
+    def published(future, routed):
+        try:
+            result.set_result(future.result())
+        except Exception as e:
+            if routed == topic or not routing.is_missing_topic(e):
+                result.set_exception(e)
+                return
+            TOPIC_ROUTER.missing(routed)
+            try:
+                publisher.publish(topic, data, **attributes).add_done_callback(
+                    lambda future: published(future, topic)
+                )
+            except Exception as error:
+                result.set_exception(error)
+
+    routed, future = publish_routed(topic, data, attributes)
+    future.add_done_callback(lambda future: published(future, routed))
+    return result
+
+
+def publish_routed(topic, data, attributes):
+    """
+    Queues a message for the shard topic of its team, see routing.py.
+    Returns the topic it was queued for and its publish future.
+    """
+    routed = TOPIC_ROUTER.route(topic, attributes.get("X-Team"))
+    return routed, publisher.publish(routed, data, **attributes)
+
+
+def wait_for_message(topic, routed, future, data, attributes):
+    """
+    Returns the message ID of a published message, publishing it again to
+    its topic if it was queued for a shard topic that does not exist
+    """
+    try:
+        return future.result(timeout=PUBLISH_TIMEOUT)
+    except Exception as e:
+        if routed == topic or not routing.is_missing_topic(e):
+            raise
+        TOPIC_ROUTER.missing(routed)
+    future = publisher.publish(topic, data, **attributes)
+    return future.result(timeout=PUBLISH_TIMEOUT)
+
+
+def publish_failed(source, msg, attributes, error):
+    """
+    Queues a message that could not be published in the outbox, or logs the
+    error when there is no outbox. Returns False if the message was lost.
+    """
+    failures = metrics.for_team(source, attributes.get("X-Team")).publish_failures
+    if OUTBOX is not None:
+        OUTBOX.append(source, msg, attributes)
+        failures[metrics.OUTBOX].inc()
+        entry = {
+            "severity": "WARNING",
+            "msg": "Publish failed, message queued in outbox",
+            "errors": str(error),
+            "depth": OUTBOX.depth(),
+        }
+        print(fast_json.dumps(entry))
+        return True
+
+    # Log any exceptions to stackdriver
+    failures[metrics.LOST].inc()
+    entry = dict(severity="WARNING", message=error)
+    print(entry)
+    return False
 
 
 if __name__ == "__main__":
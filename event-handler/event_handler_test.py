@@ -12,19 +12,63 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
 import hmac
-from hashlib import sha1
+from concurrent import futures
+from hashlib import sha1, sha256
+import io
+import json
 
+from google.api_core.exceptions import NotFound
+import prometheus_client
+
+import circuit_breaker
+import dedup
 import event_handler
+import ingress
+import metrics
+import outbox
+import publish_queue
+import publisher
+import rate_limit
+import routing
+import sources
 
 import mock
 import pytest
 
+# Some tests below replace event_handler.publish_to_pubsub for good
+publish_to_pubsub = event_handler.publish_to_pubsub
+
 
 def get_secrets_fake(project_name, secret_name, version_num) -> bytes:
     return {"event-handler": b"foo", "event-handler-team1": b"foo-team1"}[secret_name]
 
 
+@pytest.fixture(autouse=True)
+def clear_secret_cache():
+    sources.SECRET_CACHE.invalidate()
+
+
+@pytest.fixture(autouse=True)
+def deduplicator():
+    with mock.patch("event_handler.DEDUPLICATOR", dedup.DeliveryDeduplicator()) as d:
+        yield d
+
+
+@pytest.fixture(autouse=True)
+def circuit_breakers():
+    options = dict(
+        minimum_calls=2, window=2,
+        on_transition=metrics.circuit_breaker_transition,
+        on_reject=metrics.circuit_breaker_rejected,
+    )
+    publish = circuit_breaker.CircuitBreaker(metrics.PUBSUB, **options)
+    secret = circuit_breaker.CircuitBreaker(metrics.SECRET_MANAGER, **options)
+    with mock.patch("event_handler.PUBLISH_BREAKER", publish), mock.patch("sources.SECRET_BREAKER", secret):
+        yield publish, secret
+
+
 @pytest.fixture
 def client():
     event_handler.app.testing = True
@@ -195,9 +239,6 @@ def test_data_sent_to_pubsub(client):
 
     event_handler.publish_to_pubsub.assert_called_with(
         "github", b"Hello", {
-            "User-Agent": "GitHub-Hookshot",
-            "Host": "localhost",
-            "Content-Length": "5",
             "X-Hub-Signature": signature,
             "X-Team": "default",
         }
@@ -219,10 +260,569 @@ def test_data_sent_to_pubsub_with_team(client):
 
     event_handler.publish_to_pubsub.assert_called_with(
         "github", b"Hello", {
-            "User-Agent": "GitHub-Hookshot",
-            "Host": "localhost",
-            "Content-Length": "5",
             "X-Hub-Signature": signature,
             "X-Team": "team1",
         }
     )
+
+
+@mock.patch("publisher.publish")
+def test_publish_to_pubsub_waits_for_result(publish):
+    publish.return_value.result.return_value = "1"
+    publish_to_pubsub("github", b"Hello", {"X-Team": "default"})
+
+    publish.assert_called_once_with("github", b"Hello", **{"X-Team": "default"})
+    publish.return_value.result.assert_called_once_with(
+        timeout=event_handler.PUBLISH_TIMEOUT
+    )
+
+
+@mock.patch("publisher.publish")
+def test_failed_publish_is_queued_in_outbox(publish, tmp_path):
+    publish.return_value.result.side_effect = Exception("unavailable")
+    box = outbox.Outbox(str(tmp_path))
+
+    with mock.patch("event_handler.OUTBOX", box):
+        publish_to_pubsub("github", b"Hello", {"X-Team": "default"})
+
+    records = box.read_batch(10)
+    assert [(r.source, r.data, r.attributes) for r in records] == [
+        ("github", b"Hello", {"X-Team": "default"})
+    ]
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+def test_fast_ack_queues_message(client):
+    queue = mock.MagicMock()
+    queue.put.return_value = True
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+
+    with mock.patch("event_handler.PUBLISH_QUEUE", queue):
+        r = client.post("/", data="Hello", headers={
+            "User-Agent": "GitHub-Hookshot",
+            "X-Hub-Signature": signature,
+        })
+
+    assert r.status_code == 202
+    queue.put.assert_called_once()
+    assert queue.put.call_args.args[:2] == ("github", b"Hello")
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+def test_fast_ack_full_queue_returns_503(client):
+    queue = mock.MagicMock()
+    queue.put.return_value = False
+    queue.stats.return_value = {"depth": 1000}
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+
+    with mock.patch("event_handler.PUBLISH_QUEUE", queue):
+        r = client.post("/", data="Hello", headers={
+            "User-Agent": "GitHub-Hookshot",
+            "X-Hub-Signature": signature,
+        })
+
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == str(event_handler.publish_queue.RETRY_AFTER)
+
+
+def completed(result=None, error=None):
+    future = futures.Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+@mock.patch("publisher.publish")
+def test_queued_message_is_published_without_waiting(publish):
+    publish.return_value = futures.Future()
+    done = mock.MagicMock()
+
+    event_handler.publish_queued("github", b"Hello", {"X-Team": "default"}, done)
+    done.assert_not_called()
+
+    publish.return_value.set_result("1")
+    done.assert_called_once_with(publish_queue.PUBLISHED)
+
+
+@mock.patch("publisher.publish")
+def test_queued_message_that_fails_is_lost_or_queued_in_outbox(publish, tmp_path):
+    publish.side_effect = lambda *args, **kwargs: completed(error=Exception("unavailable"))
+    done = mock.MagicMock()
+
+    event_handler.publish_queued("github", b"Hello", {"X-Team": "default"}, done)
+    with mock.patch("event_handler.OUTBOX", outbox.Outbox(str(tmp_path))):
+        event_handler.publish_queued("github", b"Hello", {"X-Team": "default"}, done)
+
+    assert done.call_args_list == [
+        mock.call(publish_queue.LOST), mock.call(publish_queue.OUTBOX)
+    ]
+
+
+@mock.patch("publisher.publish")
+def test_queued_message_is_lost_when_outbox_append_fails(publish):
+    publish.side_effect = lambda *args, **kwargs: completed(error=Exception("unavailable"))
+    box = mock.MagicMock()
+    box.append.side_effect = OSError("No space left on device")
+    done = mock.MagicMock()
+
+    with mock.patch("event_handler.OUTBOX", box):
+        event_handler.publish_queued("github", b"Hello", {"X-Team": "default"}, done)
+
+    done.assert_called_once_with(publish_queue.LOST)
+
+
+@mock.patch("publisher.publish")
+def test_queued_message_of_missing_shard_falls_back_to_topic(publish):
+    router = routing.TopicRouter(routing.load_shards('{"github": {"teams": {"team1": "team1"}}}'))
+    publish.side_effect = [completed(error=NotFound("topic")), completed("1")]
+    done = mock.MagicMock()
+
+    with mock.patch("event_handler.TOPIC_ROUTER", router):
+        event_handler.publish_queued("github", b"Hello", {"X-Team": "team1"}, done)
+
+    assert [c.args[0] for c in publish.call_args_list] == ["github-team1", "github"]
+    done.assert_called_once_with(publish_queue.PUBLISHED)
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub")
+def test_large_body_is_hashed_in_chunks(publish_to_pubsub, client):
+    body = b"x" * (event_handler.READ_CHUNK_BYTES * 3 + 7)
+    signature = "sha1=" + hmac.new(b"foo", body, sha1).hexdigest()
+    r = client.post("/", data=body, headers={
+        "User-Agent": "GitHub-Hookshot",
+        "X-Hub-Signature": signature,
+    })
+
+    assert r.status_code == 204
+    assert publish_to_pubsub.call_args.args[1] == body
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub")
+def test_circleci_signature_is_streamed(publish_to_pubsub, client):
+    signature = "v1=" + hmac.new(b"foo", b"Hello", sha256).hexdigest()
+    r = client.post("/", data="Hello", headers={
+        "Circleci-Event-Type": "workflow-completed",
+        "Circleci-Signature": signature,
+    })
+    assert r.status_code == 204
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub")
+def test_oversized_body_is_rejected(publish_to_pubsub, client):
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+    with mock.patch.dict(event_handler.app.config, {"MAX_CONTENT_LENGTH": 4}):
+        r = client.post("/", data="Hello", headers={
+            "User-Agent": "GitHub-Hookshot",
+            "X-Hub-Signature": signature,
+        })
+
+    assert r.status_code == 413
+    publish_to_pubsub.assert_not_called()
+
+
+def test_read_body_reuses_buffer():
+    first = event_handler.read_body(io.BytesIO(b"Hello"))
+    buffer = event_handler._body_buffers.buffer
+    second = event_handler.read_body(io.BytesIO(b"Hi"))
+
+    assert (first, second) == (b"Hello", b"Hi")
+    assert event_handler._body_buffers.buffer is buffer
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub")
+def test_redelivery_is_not_published(publish_to_pubsub, client, deduplicator):
+    publish_to_pubsub.return_value = True
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+    headers = {
+        "User-Agent": "GitHub-Hookshot",
+        "X-Hub-Signature": signature,
+        "X-GitHub-Delivery": "72d3162e-cc78-11e3-81ab-4c9367dc0958",
+    }
+
+    assert client.post("/", data="Hello", headers=headers).status_code == 204
+    assert client.post("/", data="Hello", headers=headers).status_code == 200
+    publish_to_pubsub.assert_called_once()
+    assert deduplicator.stats()["duplicates"] == 1
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub")
+def test_lost_delivery_can_be_redelivered(publish_to_pubsub, client):
+    publish_to_pubsub.return_value = False
+    headers = {"X-Gitlab-Event": "test", "X-Gitlab-Token": "foo"}
+
+    assert client.post("/", data="Hello", headers=headers).status_code == 204
+    assert client.post("/", data="Hello", headers=headers).status_code == 204
+    assert publish_to_pubsub.call_count == 2
+
+
+def test_delivery_key():
+    headers = {"X-GitHub-Delivery": "abc"}
+    assert sources.delivery_key("github", headers, "sha1=x", b"") == "github:abc"
+    assert sources.delivery_key("github", {}, "sha1=x", b"") == "github:sha1=x"
+    assert sources.delivery_key("jira", {}, "foo", b"Hello") == (
+        "jira:" + sha1(b"Hello").hexdigest()
+    )
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub")
+def test_unsupported_event_is_not_published(publish_to_pubsub, client):
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+    r = client.post("/", data="Hello", headers={
+        "User-Agent": "GitHub-Hookshot",
+        "X-Github-Event": "watch",
+        "X-Hub-Signature": signature,
+    })
+
+    assert r.status_code == 200
+    publish_to_pubsub.assert_not_called()
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub")
+def test_unsupported_event_is_diverted(publish_to_pubsub, client):
+    publish_to_pubsub.return_value = True
+    rules = ingress.load_rules('{"gitlab": {"deny": ["note"], "action": "divert"}}')
+    body = b'{"object_kind": "note"}'
+
+    with mock.patch("event_handler.INGRESS_FILTER", ingress.IngressFilter(rules)):
+        r = client.post("/", data=body, headers={
+            "X-Gitlab-Event": "Note Hook",
+            "X-Gitlab-Token": "foo",
+        })
+
+    assert r.status_code == 204
+    assert publish_to_pubsub.call_args.args[0] == "gitlab-ignored"
+
+
+@mock.patch("publisher.publish")
+def test_headers_attribute_for_older_parsers(publish):
+    publish.return_value.result.return_value = "1"
+    with mock.patch("event_handler.HEADERS_ATTRIBUTE", True):
+        publish_to_pubsub("github", b"Hello", {"X-Team": "default"})
+
+    publish.assert_called_once_with(
+        "github", b"Hello", headers='{"X-Team": "default"}', **{"X-Team": "default"}
+    )
+
+
+def test_only_parser_headers_are_published():
+    headers = {
+        "User-Agent": "CloudEvents",
+        "Content-Type": "application/json",
+        "Ce-Id": "1",
+        "Ce-Type": "dev.tekton.event",
+        "Authorization": "Bearer secret",
+        "X-Team": "spoofed",
+    }
+
+    assert event_handler.pubsub_headers(
+        headers, "team1", sources.AUTHORIZED_SOURCES["tekton"]
+    ) == {
+        "Content-Type": "application/json",
+        "Ce-Id": "1",
+        "Ce-Type": "dev.tekton.event",
+        "X-Team": "team1",
+    }
+
+
+@mock.patch("publisher.publish")
+def test_compressed_message_is_marked(publish):
+    publish.return_value.result.return_value = "1"
+    body = b"Hello" * 1000
+    with mock.patch("compression.ENCODING", "gzip"):
+        publish_to_pubsub("github", body, {"X-Team": "default"})
+
+    data = publish.call_args.args[1]
+    assert gzip.decompress(data) == body
+    assert publish.call_args.kwargs == {"X-Team": "default", "content-encoding": "gzip"}
+
+
+def sample(name, **labels):
+    return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub", mock.MagicMock(return_value=True))
+def test_request_metrics(client):
+    requests = sample("event_handler_request_seconds_count", source="github", team="team1")
+    mismatches = sample(
+        "event_handler_rejected_requests_total", source="github", reason="signature_mismatch"
+    )
+    signature = "sha1=" + hmac.new(b"foo-team1", b"Hello", sha1).hexdigest()
+    headers = {"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature}
+
+    client.post("/?team=team1", data="Hello", headers=headers)
+    client.post("/?team=team1", data="Hi", headers=headers)
+
+    assert sample(
+        "event_handler_request_seconds_count", source="github", team="team1"
+    ) == requests + 2
+    assert sample(
+        "event_handler_rejected_requests_total", source="github", reason="signature_mismatch"
+    ) == mismatches + 1
+
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert b'event_handler_secret_lookup_seconds_count{source="github",team="team1"}' in r.data
+
+
+@mock.patch("publisher.publish")
+def test_publish_failure_metrics(publish):
+    publish.return_value.result.side_effect = Exception("unavailable")
+    lost = sample(
+        "event_handler_publish_failures_total", source="github", team="team1", outcome="lost"
+    )
+
+    publish_to_pubsub("github", b"Hello", {"X-Team": "team1"})
+
+    assert sample(
+        "event_handler_publish_failures_total", source="github", team="team1", outcome="lost"
+    ) == lost + 1
+
+
+def test_secret_cache_metrics(client):
+    misses = sample("event_handler_secret_cache_lookups_total", outcome="miss")
+    hits = sample("event_handler_secret_cache_lookups_total", outcome="hit")
+
+    with mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake)):
+        sources.read_secret("team1")
+        sources.read_secret("team1")
+
+    assert sample("event_handler_secret_cache_lookups_total", outcome="miss") == misses + 1
+    assert sample("event_handler_secret_cache_lookups_total", outcome="hit") == hits + 1
+    assert sample("event_handler_secret_cache_size") == 1
+    assert b"event_handler_secret_cache_evictions_total" in client.get("/metrics").data
+
+
+def test_team_labels_are_bounded():
+    with mock.patch("metrics.MAX_TEAMS", len(metrics._teams)):
+        assert metrics.for_team("github", "spam-1") is metrics.for_team("github", "spam-2")
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("event_handler.publish_to_pubsub")
+def test_team_over_rate_limit_is_throttled(publish_to_pubsub, client):
+    publish_to_pubsub.return_value = True
+    limiter = rate_limit.RateLimiter(
+        rate_limit.Limits({"team": {"rate": 0.1, "burst": 1}})
+    )
+
+    def post(body):
+        signature = "sha1=" + hmac.new(b"foo-team1", body, sha1).hexdigest()
+        headers = {"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature}
+        return client.post("/?team=team1", data=body, headers=headers)
+
+    with mock.patch("event_handler.RATE_LIMITER", limiter):
+        assert post(b"Hello").status_code == 204
+        r = post(b"Hi")
+
+    assert r.status_code == 429
+    assert r.headers["Retry-After"] == "10"
+    publish_to_pubsub.assert_called_once()
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("sources.get_secret_client")
+@mock.patch("publisher.get_publisher")
+def test_healthz_warms_up(get_publisher, get_secret_client, client):
+    with mock.patch("event_handler._warm", False), mock.patch.dict(publisher._topic_paths, clear=True):
+        assert client.get("/healthz").status_code == 200
+        assert client.get("/healthz").status_code == 200
+
+        get_secret_client.assert_called_once()
+        assert set(publisher._topic_paths) == set(sources.AUTHORIZED_SOURCES)
+    assert sources.SECRET_CACHE.stats()["size"] == 1
+
+
+def batch_request(lines, secret=b"foo-team1", compress=False):
+    body = b"".join(json.dumps(line).encode() + b"\n" for line in lines)
+    if compress:
+        body = gzip.compress(body)
+    signature = "sha256=" + hmac.new(secret, body, sha256).hexdigest()
+    headers = {"X-Batch-Signature": signature}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("publisher.publish")
+def test_batch_is_published(publish, client):
+    publish.return_value.result.return_value = "1"
+    push = {"source": "github", "headers": {"X-Github-Event": "push"}, "body": {"a": 1}}
+    lines = [
+        push,
+        {"source": "github", "headers": {"X-Github-Event": "watch"}, "body": {}},
+        push,
+        {"source": "foo", "body": {}},
+    ]
+    body, headers = batch_request(lines, compress=True)
+
+    r = client.post("/batch?team=team1", data=body, headers=headers)
+
+    assert r.status_code == 200
+    assert r.json["summary"] == {
+        "published": 1, "ignored": 1, "duplicate": 1, "invalid": 1, "outbox": 0, "failed": 0
+    }
+    assert [result["status"] for result in r.json["results"]] == [
+        "published", "ignored", "duplicate", "invalid"
+    ]
+    assert r.json["results"][0]["message_id"] == "1"
+    publish.assert_called_once_with(
+        "github", b'{"a": 1}', **{"X-Github-Event": "push", "X-Team": "team1"}
+    )
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("publisher.publish")
+def test_batch_header_names_are_case_insensitive(publish, client):
+    publish.return_value.result.return_value = "1"
+    lines = [{"headers": {"user-agent": "GitHub-Hookshot", "X-GitHub-Event": "push"}, "body": {}}]
+    body, headers = batch_request(lines)
+
+    r = client.post("/batch?team=team1", data=body, headers=headers)
+
+    assert [result["status"] for result in r.json["results"]] == ["published"]
+    publish.assert_called_once_with(
+        "github", b"{}", **{"X-Github-Event": "push", "X-Team": "team1"}
+    )
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("publisher.publish")
+def test_batch_publish_failures_are_reported(publish, client):
+    publish.return_value.result.side_effect = Exception("unavailable")
+    body, headers = batch_request([{"source": "gitlab", "body": {}}])
+
+    r = client.post("/batch?team=team1", data=body, headers=headers)
+
+    assert r.status_code == 200
+    assert r.json["results"] == [{"line": 1, "status": "failed", "error": "unavailable"}]
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("publisher.publish")
+def test_batch_signature_is_verified(publish, client):
+    body, headers = batch_request([{"source": "github", "body": {}}], secret=b"foo")
+
+    assert client.post("/batch?team=team1", data=body).status_code == 403
+    assert client.post("/batch?team=team1", data=body, headers=headers).status_code == 403
+    publish.assert_not_called()
+
+
+@mock.patch("sources.get_secret", mock.MagicMock(side_effect=get_secrets_fake))
+@mock.patch("publisher.publish")
+def test_oversized_batch_publishes_nothing(publish, client):
+    body, headers = batch_request([{"source": "github", "body": {}}] * 2)
+
+    with mock.patch("batch.MAX_EVENTS", 1):
+        r = client.post("/batch?team=team1", data=body, headers=headers)
+
+    assert r.status_code == 400
+    publish.assert_not_called()
+
+
+@mock.patch("publisher.publish")
+def test_team_is_published_to_its_shard(publish):
+    router = routing.TopicRouter(routing.load_shards('{"github": {"teams": {"team1": "team1"}}}'))
+    publish.return_value.result.return_value = "1"
+
+    with mock.patch("event_handler.TOPIC_ROUTER", router):
+        assert publish_to_pubsub("github", b"Hello", {"X-Team": "team1"})
+
+    publish.assert_called_once_with("github-team1", b"Hello", **{"X-Team": "team1"})
+
+
+@mock.patch("publisher.publish")
+def test_missing_shard_falls_back_to_topic(publish):
+    router = routing.TopicRouter(routing.load_shards('{"github": {"teams": {"team1": "team1"}}}'))
+    missing, found = mock.MagicMock(), mock.MagicMock()
+    missing.result.side_effect = NotFound("topic")
+    found.result.return_value = "1"
+    publish.side_effect = [missing, found, found]
+
+    with mock.patch("event_handler.TOPIC_ROUTER", router):
+        assert publish_to_pubsub("github", b"Hello", {"X-Team": "team1"})
+        assert publish_to_pubsub("github", b"Hello", {"X-Team": "team1"})
+
+    assert [c.args[0] for c in publish.call_args_list] == ["github-team1", "github", "github"]
+
+
+@mock.patch("publisher.publish")
+def test_outbox_replay_falls_back_from_missing_shard(publish, tmp_path):
+    router = routing.TopicRouter(routing.load_shards('{"github": {"teams": {"team1": "team1"}}}'))
+    publish.side_effect = [completed(error=NotFound("topic")), completed("1")]
+    box = outbox.Outbox(str(tmp_path))
+    box.append("github", b"Hello", {"X-Team": "team1"})
+    drainer = outbox.OutboxDrainer(
+        box, lambda topic, data, **attributes: event_handler.publish_with_fallback(
+            topic, data, attributes
+        ),
+    )
+
+    with mock.patch("event_handler.TOPIC_ROUTER", router):
+        assert drainer.drain_batch(box.read_batch(10)) == 1
+
+    assert [c.args[0] for c in publish.call_args_list] == ["github-team1", "github"]
+    assert box.depth() == 0
+
+
+def test_outbox_metrics(tmp_path):
+    registry = prometheus_client.CollectorRegistry()
+    box = outbox.Outbox(str(tmp_path))
+    metrics.register_outbox(box.stats, registry)
+
+    with mock.patch("outbox.time.time", return_value=100.0):
+        box.append("github", b"Hello", {})
+    with mock.patch("outbox.time.time", return_value=130.0):
+        assert registry.get_sample_value("event_handler_outbox_depth") == 1
+        assert registry.get_sample_value("event_handler_outbox_oldest_age_seconds") == 30
+
+
+@mock.patch("publisher.publish")
+def test_open_publish_breaker_fails_fast_to_outbox(publish, tmp_path, circuit_breakers):
+    publish.return_value.result.side_effect = Exception("unavailable")
+    box = outbox.Outbox(str(tmp_path))
+
+    with mock.patch("event_handler.OUTBOX", box):
+        for _ in range(3):
+            assert publish_to_pubsub("github", b"Hello", {"X-Team": "default"})
+
+    assert publish.call_count == 2
+    assert circuit_breakers[0].state == circuit_breaker.OPEN
+    assert len(box.read_batch(10)) == 3
+    assert sample("event_handler_circuit_breaker_state", breaker="pubsub") == 2
+
+
+@mock.patch("sources.get_secret_client")
+def test_open_secret_breaker_serves_last_known_secret(get_secret_client, client, circuit_breakers):
+    access_secret_version = get_secret_client.return_value.access_secret_version
+    access_secret_version.side_effect = [
+        mock.MagicMock(**{"payload.data": b"foo"}),
+        Exception("unavailable"),
+    ]
+
+    def post(body):
+        signature = "sha1=" + hmac.new(b"foo", body, sha1).hexdigest()
+        headers = {"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature}
+        return client.post("/", data=body, headers=headers)
+
+    with mock.patch("event_handler.publish_to_pubsub", mock.MagicMock(return_value=True)):
+        assert post(b"Hello").status_code == 204
+        for n in range(3):
+            # Expire the cached secret, so that it is fetched again
+            sources.SECRET_CACHE._entries["event-handler"].fetched_at -= 10000
+            assert post(b"Hello %d" % n).status_code == 204
+
+    assert circuit_breakers[1].state == circuit_breaker.OPEN
+    assert access_secret_version.call_count == 2
+    # The secret is read before the body and again for its HMAC
+    assert sources.SECRET_CACHE.stats()["fallback_hits"] == 6
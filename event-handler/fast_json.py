@@ -0,0 +1,83 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON encoding and decoding with orjson when it is installed, and the json
+module otherwise. shared.json_loads and shared.json_dumps do the same in the
+parsers.
+
+dumps is compact and does not escape non-ASCII characters, so its output is
+not byte-identical to json.dumps. Anything that ends up in the data or the
+attributes of a Pub/Sub message is hashed into the event signature by the
+parsers, and must keep using json.dumps.
+"""
+
+import json
+import os
+
+# "orjson", "json", or "auto" for orjson if it is installed
+BACKEND = os.environ.get("JSON_BACKEND", "auto").lower()
+
+if BACKEND not in ("auto", "orjson", "json"):
+    raise ValueError(f"Unsupported JSON_BACKEND: {BACKEND}")
+
+
+def load_orjson(backend: str = BACKEND):
+    """
+    Returns the orjson module, or None if the json module is to be used
+    """
+    if backend == "json":
+        return None
+    try:
+        import orjson
+    except ImportError:
+        if backend == "orjson":
+            raise
+        return None
+    return orjson
+
+
+_orjson = load_orjson()
+
+
+def loads(data):
+    """
+    Decodes JSON from a str or bytes
+    """
+    if _orjson is not None:
+        try:
+            return _orjson.loads(data)
+        except _orjson.JSONDecodeError:
+            # orjson rejects some documents the json module accepts, e.g.
+            # NaN or integers of more than 64 bits. Invalid documents raise
+            # ValueError from the json module below.
+            pass
+    return json.loads(data)
+
+
+def dumps(obj, default=None) -> str:
+    """
+    Encodes an object to a compact JSON str. `default` is called for objects
+    that cannot be encoded, as in json.dumps.
+    """
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(
+                obj, default=default, option=_orjson.OPT_NON_STR_KEYS
+            ).decode("utf-8")
+        except TypeError:
+            # Types orjson does not encode, e.g. integers of more than 64
+            # bits, fall back to the json module
+            pass
+    return json.dumps(obj, default=default, separators=(",", ":"), ensure_ascii=False)
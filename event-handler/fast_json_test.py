@@ -0,0 +1,77 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import math
+
+import fast_json
+
+import mock
+import pytest
+
+ENTRY = {
+    "severity": "WARNING",
+    "msg": "Publish failed, event spooled to the outbox",
+    "source": "github",
+    "attributes": {"X-Github-Event": "push", "X-Team": "café"},
+    "depth": 3,
+    "ratio": 0.25,
+    "ok": False,
+    "errors": None,
+}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    orjson = fast_json.load_orjson(request.param)
+    with mock.patch.object(fast_json, "_orjson", orjson):
+        yield request.param
+
+
+def test_orjson_is_used_when_installed():
+    pytest.importorskip("orjson")
+
+    assert fast_json.load_orjson("auto") is not None
+    assert fast_json.load_orjson("json") is None
+
+
+def test_backends_encode_identically(backend):
+    assert fast_json.dumps(ENTRY) == (
+        '{"severity":"WARNING","msg":"Publish failed, event spooled to the outbox",'
+        '"source":"github","attributes":{"X-Github-Event":"push","X-Team":"café"},'
+        '"depth":3,"ratio":0.25,"ok":false,"errors":null}'
+    )
+    assert fast_json.loads(fast_json.dumps(ENTRY)) == ENTRY
+    assert fast_json.loads(fast_json.dumps(ENTRY).encode("utf-8")) == ENTRY
+
+
+def test_values_orjson_rejects_fall_back(backend):
+    assert fast_json.loads('{"n": NaN, "big": 123456789012345678901234567890}')["big"] == (
+        123456789012345678901234567890
+    )
+    assert math.isnan(fast_json.loads("NaN"))
+    assert fast_json.dumps({"big": 2 ** 70}) == '{"big":1180591620717411303424}'
+
+
+def test_default_encodes_unsupported_types(backend):
+    value = {1: datetime.timedelta(seconds=1)}
+
+    assert fast_json.dumps(value, default=str) == '{"1":"0:00:01"}'
+
+
+def test_invalid_json_raises_value_error(backend):
+    with pytest.raises(ValueError):
+        fast_json.loads(b'{"source": ')
@@ -0,0 +1,171 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-source allowlists of event types, evaluated before publishing so that
+events the parsers would reject never reach Pub/Sub.
+
+The default rules mirror the event types each parser stores. They can be
+changed with the INGRESS_FILTERS environment variable, a JSON object keyed
+by source, e.g. to also drop GitHub check runs and GitLab notes:
+
+    {"github": {"deny": ["check_run", "status"]}, "gitlab": {"deny": ["note"]}}
+
+A rule may also set "allow" to replace the allowlist, and "action" to
+"divert" (with an optional "topic", by default "{source}-ignored") to publish
+rejected events to another topic instead of dropping them.
+"""
+
+import collections
+import re
+import threading
+from typing import Dict, Iterable, Tuple, Union
+
+from werkzeug.datastructures import Headers
+
+import fast_json
+import metrics
+
+ALLOW = "allow"
+DROP = "drop"
+DIVERT = "divert"
+
+# Bytes of the body searched by body-based rules
+BODY_PREFIX_BYTES = 4096
+
+
+class IngressRule(object):
+    """
+    Allowlist of the event types of one source, read from a header or from
+    the beginning of the body
+    """
+
+    def __init__(
+        self,
+        allow: Iterable[str],
+        header: str = None,
+        body_pattern: str = None,
+        action: str = DROP,
+        topic: str = None,
+    ):
+        self.allow = frozenset(allow)
+        self.header = header
+        self.body_pattern = re.compile(body_pattern.encode()) if body_pattern else None
+        self.action = action
+        self.topic = topic
+
+    def event_type(self, headers: Headers, body: bytes) -> Union[str, None]:
+        """
+        Returns the event type of the request, or None if it is not found
+        """
+        if self.header:
+            return headers.get(self.header)
+        match = self.body_pattern.search(body, 0, BODY_PREFIX_BYTES)
+        if match:
+            return match.group(1).decode("utf-8", "replace")
+        return None
+
+
+DEFAULT_RULES = {
+    "github": IngressRule(
+        header="X-Github-Event",
+        allow={"push", "pull_request", "pull_request_review",
+               "pull_request_review_comment", "issues",
+               "issue_comment", "check_run", "check_suite", "status",
+               "deployment_status", "release"},
+    ),
+    "gitlab": IngressRule(
+        body_pattern=r'"object_kind"\s*:\s*"([^"]+)"',
+        allow={"push", "merge_request",
+               "note", "tag_push", "issue",
+               "pipeline", "job", "deployment",
+               "build"},
+    ),
+    "circleci": IngressRule(
+        header="Circleci-Event-Type",
+        allow={"workflow-completed", "job-completed"},
+    ),
+    "pagerduty": IngressRule(
+        body_pattern=r'"event_type"\s*:\s*"([^"]+)"',
+        allow={"incident.triggered", "incident.resolved"},
+    ),
+}
+
+
+def load_rules(config: str = None) -> Dict[str, IngressRule]:
+    """
+    Returns the default rules updated with a JSON configuration
+    """
+    rules = dict(DEFAULT_RULES)
+    if not config:
+        return rules
+
+    for source, options in fast_json.loads(config).items():
+        default = rules.get(source)
+        if default is None and ("header" not in options and "body_pattern" not in options):
+            raise ValueError(f"Ingress filter for {source} needs a header or body_pattern")
+        allow = set(options.get("allow", default.allow if default else ()))
+        allow -= set(options.get("deny", ()))
+        body_pattern = options.get("body_pattern")
+        if body_pattern is None and default is not None and default.body_pattern:
+            body_pattern = default.body_pattern.pattern.decode()
+        rules[source] = IngressRule(
+            allow=allow,
+            header=options.get("header", default.header if default else None),
+            body_pattern=body_pattern,
+            action=options.get("action", DROP),
+            topic=options.get("topic"),
+        )
+    return rules
+
+
+class IngressFilter(object):
+    """
+    Applies the rules of each source and counts the decisions per event type
+    """
+
+    def __init__(self, rules: Dict[str, IngressRule]):
+        self.rules = rules
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def decide(self, source: str, headers: Headers, body: bytes) -> Tuple[str, str, str]:
+        """
+        Returns the action for the request (ALLOW, DROP or DIVERT), its event
+        type and the topic to publish it to
+        """
+        rule = self.rules.get(source)
+        if rule is None:
+            return ALLOW, None, source
+
+        event_type = rule.event_type(headers, body)
+        # Requests without a recognizable event type are left to the parser
+        if event_type is None or event_type in rule.allow:
+            action, topic = ALLOW, source
+        elif rule.action == DIVERT:
+            action, topic = DIVERT, rule.topic or f"{source}-ignored"
+        else:
+            action, topic = DROP, None
+
+        with self._lock:
+            self.counts[(source, event_type, action)] += 1
+        metrics.ingress_decision(source, event_type, action)
+        return action, event_type, topic
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                f"{source}/{event_type}/{action}": count
+                for (source, event_type, action), count in self.counts.items()
+            }
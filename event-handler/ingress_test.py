@@ -0,0 +1,112 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+
+from ingress import ALLOW, DIVERT, DROP, IngressFilter, load_rules
+
+import metrics
+
+import pytest
+
+
+def test_header_rule():
+    ingress = IngressFilter(load_rules())
+
+    assert ingress.decide("github", {"X-Github-Event": "push"}, b"") == (
+        ALLOW, "push", "github"
+    )
+    assert ingress.decide("github", {"X-Github-Event": "watch"}, b"") == (
+        DROP, "watch", None
+    )
+
+
+def test_body_prefix_rule():
+    ingress = IngressFilter(load_rules())
+
+    body = b'{"object_kind": "wiki_page", "user": {}}'
+    assert ingress.decide("gitlab", {}, body) == (DROP, "wiki_page", None)
+
+    # Only the beginning of the body is searched
+    body = b'{"padding": "' + b"x" * 5000 + b'", "object_kind": "wiki_page"}'
+    assert ingress.decide("gitlab", {}, body) == (ALLOW, None, "gitlab")
+
+
+def test_unknown_event_type_and_source_are_allowed():
+    ingress = IngressFilter(load_rules())
+
+    assert ingress.decide("github", {}, b"")[0] == ALLOW
+    assert ingress.decide("tekton", {}, b"")[0] == ALLOW
+
+
+def test_configured_rules():
+    rules = load_rules(
+        '{"github": {"deny": ["check_run", "status"]},'
+        ' "gitlab": {"deny": ["note"], "action": "divert", "topic": "notes"}}'
+    )
+    ingress = IngressFilter(rules)
+
+    assert ingress.decide("github", {"X-Github-Event": "status"}, b"")[0] == DROP
+    assert ingress.decide("github", {"X-Github-Event": "push"}, b"")[0] == ALLOW
+    assert ingress.decide("gitlab", {}, b'{"object_kind":"note"}') == (
+        DIVERT, "note", "notes"
+    )
+
+
+def test_new_source_needs_an_event_type():
+    with pytest.raises(ValueError):
+        load_rules('{"argocd": {"allow": ["deployment"]}}')
+
+    rules = load_rules('{"argocd": {"header": "X-Event", "allow": ["deployment"]}}')
+    assert IngressFilter(rules).decide("argocd", {"X-Event": "sync"}, b"")[0] == DROP
+
+
+def test_counts_per_event_type():
+    ingress = IngressFilter(load_rules())
+    for event_type in ("push", "status", "watch", "watch"):
+        ingress.decide("github", {"X-Github-Event": event_type}, b"")
+
+    assert ingress.stats() == {
+        "github/push/allow": 1,
+        "github/status/allow": 1,
+        "github/watch/drop": 2,
+    }
+
+
+def decisions(**labels):
+    return metrics.REGISTRY.get_sample_value("event_handler_ingress_decisions_total", labels) or 0
+
+
+def test_decisions_are_exported():
+    ingress = IngressFilter(load_rules())
+    dropped = decisions(source="github", event_type="watch", action="drop")
+    unknown = decisions(source="gitlab", event_type="unknown", action="allow")
+
+    ingress.decide("github", {"X-Github-Event": "watch"}, b"")
+    ingress.decide("gitlab", {}, b"{}")
+
+    assert decisions(source="github", event_type="watch", action="drop") == dropped + 1
+    assert decisions(source="gitlab", event_type="unknown", action="allow") == unknown + 1
+
+
+def test_event_type_labels_are_bounded():
+    ingress = IngressFilter(load_rules())
+    other = decisions(source="github", event_type="other", action="drop")
+
+    with mock.patch("metrics.MAX_EVENT_TYPES", 0):
+        ingress.decide("github", {"X-Github-Event": "spam-1"}, b"")
+        ingress.decide("github", {"X-Github-Event": "spam-2"}, b"")
+
+    assert decisions(source="github", event_type="other", action="drop") == other + 2
+    assert decisions(source="github", event_type="spam-1", action="drop") == 0
@@ -0,0 +1,293 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Prometheus metrics of the event handler, served on /metrics.
+
+Label children are bound once per source and team and then reused, so
+recording a request only costs a few observations.
+"""
+
+import os
+import threading
+from typing import Callable, Dict, Tuple, Union
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Teams are named by the "team" query parameter of unauthenticated requests,
+# so only this many are labelled individually; others are labelled "other".
+MAX_TEAMS = int(os.environ.get("METRICS_MAX_TEAMS", 100))
+# Event types are read from the request before it is authenticated, so only
+# this many are labelled individually per source; others are labelled "other".
+MAX_EVENT_TYPES = int(os.environ.get("METRICS_MAX_EVENT_TYPES", 100))
+
+# Reasons a request is rejected with 403
+SOURCE_NOT_AUTHORIZED = "source_not_authorized"
+SIGNATURE_MISSING = "signature_missing"
+SECRET_UNAVAILABLE = "secret_unavailable"
+SIGNATURE_MISMATCH = "signature_mismatch"
+REJECTION_REASONS = (
+    SOURCE_NOT_AUTHORIZED, SIGNATURE_MISSING, SECRET_UNAVAILABLE, SIGNATURE_MISMATCH
+)
+
+# Outcomes of a failed publish
+OUTBOX = "outbox"
+LOST = "lost"
+
+# Source label of requests from unauthorized sources
+UNAUTHORIZED = "unauthorized"
+
+# Circuit breakers
+SECRET_MANAGER = "secret_manager"
+PUBSUB = "pubsub"
+CIRCUIT_BREAKERS = (SECRET_MANAGER, PUBSUB)
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+REGISTRY = CollectorRegistry()
+
+REQUEST_SECONDS = Histogram(
+    "event_handler_request_seconds",
+    "Time spent handling a webhook",
+    ("source", "team"), buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+SECRET_SECONDS = Histogram(
+    "event_handler_secret_lookup_seconds",
+    "Time spent reading the team secret, from the cache or Secret Manager",
+    ("source", "team"), buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+VERIFY_SECONDS = Histogram(
+    "event_handler_signature_verification_seconds",
+    "Time spent reading and hashing the body and verifying its signature",
+    ("source", "team"), buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+PUBLISH_SECONDS = Histogram(
+    "event_handler_publish_seconds",
+    "Time spent waiting for Pub/Sub to accept a message",
+    ("source", "team"), buckets=LATENCY_BUCKETS, registry=REGISTRY,
+)
+REJECTED = Counter(
+    "event_handler_rejected_requests",
+    "Requests rejected with 403, by reason",
+    ("source", "reason"), registry=REGISTRY,
+)
+THROTTLED = Counter(
+    "event_handler_throttled_requests",
+    "Requests rejected with 429, by the rate limit scope (team or source)",
+    ("source", "team", "scope"), registry=REGISTRY,
+)
+PUBLISH_FAILURES = Counter(
+    "event_handler_publish_failures",
+    "Messages that could not be published, by outcome",
+    ("source", "team", "outcome"), registry=REGISTRY,
+)
+INGRESS_DECISIONS = Counter(
+    "event_handler_ingress_decisions",
+    "Requests checked by the ingress filter, by event type and action",
+    ("source", "event_type", "action"), registry=REGISTRY,
+)
+
+CIRCUIT_BREAKER_STATE = Gauge(
+    "event_handler_circuit_breaker_state",
+    "State of a circuit breaker: 0 closed, 1 half-open, 2 open",
+    ("breaker",), registry=REGISTRY,
+)
+CIRCUIT_BREAKER_TRANSITIONS = Counter(
+    "event_handler_circuit_breaker_transitions",
+    "Circuit breaker state changes, by the state entered",
+    ("breaker", "state"), registry=REGISTRY,
+)
+CIRCUIT_BREAKER_REJECTED = Counter(
+    "event_handler_circuit_breaker_rejected_calls",
+    "Calls failed immediately by an open circuit breaker",
+    ("breaker",), registry=REGISTRY,
+)
+CIRCUIT_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+for breaker in CIRCUIT_BREAKERS:
+    CIRCUIT_BREAKER_STATE.labels(breaker).set(0)
+
+
+class SecretCacheCollector(object):
+    """
+    Exports the counters of a secret_cache.SecretCache, read when /metrics is
+    served so that lookups do not pay for them
+    """
+
+    # Lookup outcomes and the stats they are read from
+    LOOKUPS = (
+        ("hit", "hits"), ("stale", "stale_hits"),
+        ("negative", "negative_hits"), ("miss", "misses"),
+    )
+
+    def __init__(self, stats: Callable[[], Dict[str, int]]):
+        self._stats = stats
+
+    def collect(self):
+        stats = self._stats()
+        lookups = CounterMetricFamily(
+            "event_handler_secret_cache_lookups",
+            "Secret cache lookups, by outcome",
+            labels=("outcome",),
+        )
+        for outcome, name in self.LOOKUPS:
+            lookups.add_metric((outcome,), stats[name])
+        yield lookups
+        yield CounterMetricFamily(
+            "event_handler_secret_cache_fallbacks",
+            "Secrets served from the cache because Secret Manager failed",
+            value=stats["fallback_hits"],
+        )
+        yield CounterMetricFamily(
+            "event_handler_secret_cache_refresh_errors",
+            "Background refreshes of stale secrets that failed",
+            value=stats["refresh_errors"],
+        )
+        yield CounterMetricFamily(
+            "event_handler_secret_cache_evictions",
+            "Secrets dropped from the cache to keep it under its size",
+            value=stats["evictions"],
+        )
+        yield GaugeMetricFamily(
+            "event_handler_secret_cache_size",
+            "Secrets held in the cache",
+            value=stats["size"],
+        )
+
+
+def register_secret_cache(stats: Callable[[], Dict[str, int]]):
+    """
+    Exports the counters of a secret cache
+    """
+    REGISTRY.register(SecretCacheCollector(stats))
+
+
+class OutboxCollector(object):
+    """
+    Exports the backlog of an outbox.Outbox, read when /metrics is served
+    """
+
+    def __init__(self, stats: Callable[[], Dict[str, float]]):
+        self._stats = stats
+
+    def collect(self):
+        stats = self._stats()
+        yield GaugeMetricFamily(
+            "event_handler_outbox_depth",
+            "Messages in the outbox waiting to be replayed to Pub/Sub",
+            value=stats["depth"],
+        )
+        yield GaugeMetricFamily(
+            "event_handler_outbox_oldest_age_seconds",
+            "Age of the oldest message in the outbox, 0 when it is empty",
+            value=stats["oldest_age_seconds"],
+        )
+
+
+def register_outbox(stats: Callable[[], Dict[str, float]], registry=REGISTRY):
+    """
+    Exports the backlog of an outbox
+    """
+    registry.register(OutboxCollector(stats))
+
+
+class TeamMetrics(object):
+    """
+    Label children of the metrics of one source and team
+    """
+
+    def __init__(self, source: str, team: str):
+        self.request = REQUEST_SECONDS.labels(source, team)
+        self.secret = SECRET_SECONDS.labels(source, team)
+        self.verify = VERIFY_SECONDS.labels(source, team)
+        self.publish = PUBLISH_SECONDS.labels(source, team)
+        self.throttled = {
+            scope: THROTTLED.labels(source, team, scope) for scope in ("team", "source")
+        }
+        self.publish_failures = {
+            outcome: PUBLISH_FAILURES.labels(source, team, outcome)
+            for outcome in (OUTBOX, LOST)
+        }
+
+
+_team_metrics: Dict[Tuple[str, str], TeamMetrics] = {}
+_teams = set()
+_lock = threading.Lock()
+_rejections = {}
+_ingress_decisions = {}
+_event_types = {}
+
+
+def for_team(source: str, team: Union[str, None]) -> TeamMetrics:
+    """
+    Returns the metrics of a source and team, binding them on first use
+    """
+    team = team or "default"
+    metrics = _team_metrics.get((source, team))
+    if metrics is None:
+        with _lock:
+            if team not in _teams and len(_teams) >= MAX_TEAMS:
+                team = "other"
+            metrics = _team_metrics.get((source, team))
+            if metrics is None:
+                _teams.add(team)
+                metrics = _team_metrics[(source, team)] = TeamMetrics(source, team)
+    return metrics
+
+
+def rejected(source: str, reason: str):
+    """
+    Counts a request rejected with 403
+    """
+    child = _rejections.get((source, reason))
+    if child is None:
+        child = _rejections[(source, reason)] = REJECTED.labels(source, reason)
+    child.inc()
+
+
+def ingress_decision(source: str, event_type: Union[str, None], action: str):
+    """
+    Counts a decision of the ingress filter
+    """
+    event_type = event_type or "unknown"
+    child = _ingress_decisions.get((source, event_type, action))
+    if child is None:
+        with _lock:
+            event_types = _event_types.setdefault(source, set())
+            if event_type not in event_types and len(event_types) >= MAX_EVENT_TYPES:
+                event_type = "other"
+            event_types.add(event_type)
+            child = _ingress_decisions.get((source, event_type, action))
+            if child is None:
+                child = _ingress_decisions[(source, event_type, action)] = (
+                    INGRESS_DECISIONS.labels(source, event_type, action)
+                )
+    child.inc()
+
+
+def circuit_breaker_transition(breaker: str, previous: str, state: str):
+    """
+    Records a circuit breaker state change
+    """
+    CIRCUIT_BREAKER_STATE.labels(breaker).set(CIRCUIT_BREAKER_STATES[state])
+    CIRCUIT_BREAKER_TRANSITIONS.labels(breaker, state).inc()
+
+
+def circuit_breaker_rejected(breaker: str):
+    """
+    Counts a call failed immediately by an open circuit breaker
+    """
+    CIRCUIT_BREAKER_REJECTED.labels(breaker).inc()
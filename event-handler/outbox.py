@@ -0,0 +1,391 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Durable local outbox for messages that could not be published to Pub/Sub.
+
+Messages are appended to segment files in the outbox directory. Each record
+is a fixed header (payload length, CRC32 and enqueue time) followed by the
+payload, so a torn write at the end of a segment is detected and discarded on
+recovery. The read position of the drainer is kept in a small index file
+that is replaced atomically after every replayed batch.
+
+Several gunicorn workers can share one outbox root: each process locks its
+own `worker-N` slot, and a restarted worker takes over the slot (and the
+backlog) of the process it replaces.
+"""
+
+import fcntl
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Tuple
+
+import fast_json
+
+SEGMENT_MAX_BYTES = int(os.environ.get("OUTBOX_SEGMENT_MAX_BYTES", 64 * 1024 * 1024))
+FSYNC_BATCH = int(os.environ.get("OUTBOX_FSYNC_BATCH", 32))
+FSYNC_INTERVAL = float(os.environ.get("OUTBOX_FSYNC_INTERVAL", 0.05))
+DRAIN_BATCH_SIZE = int(os.environ.get("OUTBOX_DRAIN_BATCH_SIZE", 100))
+BACKOFF_INITIAL = float(os.environ.get("OUTBOX_BACKOFF_INITIAL", 1))
+BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", 300))
+STATS_INTERVAL = float(os.environ.get("OUTBOX_STATS_INTERVAL", 60))
+
+# payload length, crc32 of the payload, enqueue time
+_HEADER = struct.Struct(">IId")
+# segment number, offset in the segment
+_INDEX = struct.Struct(">QQ")
+
+_SEGMENT_PREFIX = "segment-"
+_SEGMENT_SUFFIX = ".log"
+
+
+class OutboxRecord(object):
+    __slots__ = ("source", "data", "attributes", "enqueued_at", "position")
+
+    def __init__(
+        self,
+        source: str,
+        data: bytes,
+        attributes: Dict[str, str],
+        enqueued_at: float,
+        position: Tuple[int, int],
+    ):
+        self.source = source
+        self.data = data
+        self.attributes = attributes
+        self.enqueued_at = enqueued_at
+        # Read position right after this record
+        self.position = position
+
+
+def _encode(source: str, data: bytes, attributes: Dict[str, str]) -> bytes:
+    meta = fast_json.dumps({"source": source, "attributes": attributes}).encode("utf-8")
+    return struct.pack(">I", len(meta)) + meta + data
+
+
+def _decode(payload: bytes):
+    (meta_len,) = struct.unpack_from(">I", payload)
+    meta = fast_json.loads(payload[4:4 + meta_len])
+    return meta["source"], payload[4 + meta_len:], meta["attributes"]
+
+
+class Outbox(object):
+    """
+    Append-only, segmented on-disk queue of Pub/Sub messages
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_max_bytes: int = SEGMENT_MAX_BYTES,
+        fsync_batch: int = FSYNC_BATCH,
+        fsync_interval: float = FSYNC_INTERVAL,
+    ):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Condition()
+        self._index_path = os.path.join(directory, "outbox.index")
+        self._read_segment, self._read_offset = self._load_index()
+        self._depth = 0
+        self._recover()
+
+        self._write_segment = max(self._segments() or [self._read_segment])
+        self._writer = open(self._segment_path(self._write_segment), "ab")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        # Held by open_outbox for the lifetime of the process
+        self._lock_file = None
+
+    def append(self, source: str, data: bytes, attributes: Dict[str, str]):
+        """
+        Appends a message to the outbox
+        """
+        payload = _encode(source, data, attributes)
+        header = _HEADER.pack(len(payload), zlib.crc32(payload), time.time())
+        with self._lock:
+            if self._writer.tell() >= self.segment_max_bytes:
+                self._rotate()
+            self._writer.write(header + payload)
+            self._writer.flush()
+            self._unsynced += 1
+            self._depth += 1
+            if (
+                self._unsynced >= self.fsync_batch
+                or time.monotonic() - self._last_sync >= self.fsync_interval
+            ):
+                self._sync()
+            self._lock.notify_all()
+
+    def sync(self):
+        """
+        Forces appended records to disk
+        """
+        with self._lock:
+            if self._unsynced:
+                self._sync()
+
+    def read_batch(self, max_records: int, timeout: float = None) -> List[OutboxRecord]:
+        """
+        Returns up to max_records records from the head of the outbox,
+        waiting up to timeout seconds for one to arrive
+        """
+        with self._lock:
+            if not self._depth and timeout:
+                self._lock.wait(timeout)
+            if not self._depth:
+                return []
+            segment, offset = self._read_segment, self._read_offset
+            last_segment = self._write_segment
+            count = min(max_records, self._depth)
+
+        records = []
+        while len(records) < count and segment <= last_segment:
+            with open(self._segment_path(segment), "rb") as f:
+                f.seek(offset)
+                while len(records) < count:
+                    header = f.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        break
+                    length, _, enqueued_at = _HEADER.unpack(header)
+                    source, data, attributes = _decode(f.read(length))
+                    offset = f.tell()
+                    records.append(
+                        OutboxRecord(
+                            source, data, attributes, enqueued_at, (segment, offset)
+                        )
+                    )
+            if len(records) < count:
+                segment, offset = segment + 1, 0
+        return records
+
+    def commit(self, record: OutboxRecord, count: int):
+        """
+        Marks every record up to and including `record` as published
+        """
+        segment, offset = record.position
+        with self._lock:
+            self._read_segment, self._read_offset = segment, offset
+            self._depth -= count
+            self._store_index()
+            for old in self._segments():
+                if old < segment:
+                    os.remove(self._segment_path(old))
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._depth
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the number of queued messages and the age of the oldest one
+        """
+        with self._lock:
+            depth = self._depth
+        oldest_age = 0.0
+        if depth:
+            try:
+                head = self.read_batch(1)
+            except FileNotFoundError:
+                # The drainer removed the segment while we were reading it
+                head = []
+            if head:
+                oldest_age = max(0.0, time.time() - head[0].enqueued_at)
+        return {"depth": depth, "oldest_age_seconds": oldest_age}
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._writer.close()
+
+    def _sync(self):
+        os.fsync(self._writer.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _rotate(self):
+        self._sync()
+        self._writer.close()
+        self._write_segment += 1
+        self._writer = open(self._segment_path(self._write_segment), "ab")
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(
+            self.directory, f"{_SEGMENT_PREFIX}{segment:012d}{_SEGMENT_SUFFIX}"
+        )
+
+    def _segments(self) -> List[int]:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX):
+                segments.append(int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def _load_index(self) -> Tuple[int, int]:
+        try:
+            with open(self._index_path, "rb") as f:
+                return _INDEX.unpack(f.read(_INDEX.size))
+        except (FileNotFoundError, struct.error):
+            return 0, 0
+
+    def _store_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_INDEX.pack(self._read_segment, self._read_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._index_path)
+
+    def _recover(self):
+        """
+        Counts the records left by a previous process and drops any record
+        that was only partially written
+        """
+        for segment in self._segments():
+            path = self._segment_path(segment)
+            if segment < self._read_segment:
+                os.remove(path)
+                continue
+            offset = self._read_offset if segment == self._read_segment else 0
+            with open(path, "r+b") as f:
+                f.seek(offset)
+                while True:
+                    header = f.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        break
+                    length, crc, _ = _HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        break
+                    offset = f.tell()
+                    self._depth += 1
+                f.truncate(offset)
+
+
+class OutboxDrainer(threading.Thread):
+    """
+    Background thread that replays the outbox to Pub/Sub in batches, backing
+    off exponentially while publishing keeps failing
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        publish: Callable,
+        batch_size: int = DRAIN_BATCH_SIZE,
+        publish_timeout: float = 60,
+        backoff_initial: float = BACKOFF_INITIAL,
+        backoff_max: float = BACKOFF_MAX,
+        poll_interval: float = 1,
+        stats_interval: float = STATS_INTERVAL,
+    ):
+        super().__init__(name="outbox-drainer", daemon=True)
+        self.outbox = outbox
+        self.publish = publish
+        self.batch_size = batch_size
+        self.publish_timeout = publish_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        backoff = self.backoff_initial
+        last_stats = time.monotonic()
+        while not self._stopped.is_set():
+            self.outbox.sync()
+            if time.monotonic() - last_stats >= self.stats_interval:
+                self.log_stats()
+                last_stats = time.monotonic()
+            batch = self.outbox.read_batch(self.batch_size, timeout=self.poll_interval)
+            if not batch:
+                continue
+
+            published = self.drain_batch(batch)
+            if published == len(batch):
+                backoff = self.backoff_initial
+                continue
+
+            # Full jitter, so that several workers do not retry in lockstep
+            self._stopped.wait(random.uniform(0, backoff))
+            backoff = min(backoff * 2, self.backoff_max)
+
+    def log_stats(self):
+        """
+        Logs the outbox backlog so that it can be alerted on
+        """
+        stats = self.outbox.stats()
+        if stats["depth"]:
+            entry = {"severity": "WARNING", "msg": "Outbox backlog", **stats}
+            print(fast_json.dumps(entry))
+
+    def drain_batch(self, batch: List[OutboxRecord]) -> int:
+        """
+        Publishes a batch and commits the longest published prefix of it.
+        Returns the number of records committed.
+        """
+        published = 0
+        try:
+            futures = [
+                self.publish(record.source, record.data, **record.attributes)
+                for record in batch
+            ]
+            for future in futures:
+                future.result(timeout=self.publish_timeout)
+                published += 1
+        except Exception as e:
+            entry = {
+                "severity": "WARNING",
+                "msg": "Outbox replay failed",
+                "errors": str(e),
+                "published": published,
+                "depth": self.outbox.depth(),
+            }
+            print(fast_json.dumps(entry))
+
+        if published:
+            self.outbox.commit(batch[published - 1], published)
+        return published
+
+
+def open_outbox(root: str, **kwargs) -> Outbox:
+    """
+    Opens the first outbox slot under root that no other process holds
+    """
+    os.makedirs(root, exist_ok=True)
+    slot = 0
+    while True:
+        directory = os.path.join(root, f"worker-{slot}")
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, "outbox.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            slot += 1
+            continue
+        outbox = Outbox(directory, **kwargs)
+        outbox._lock_file = lock_file
+        return outbox
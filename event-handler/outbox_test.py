@@ -0,0 +1,126 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import outbox
+
+import mock
+import pytest
+
+
+def test_records_are_read_in_order(tmp_path):
+    box = outbox.Outbox(str(tmp_path))
+    box.append("github", b"one", {"headers": "{}"})
+    box.append("gitlab", b"two", {"headers": "{}"})
+
+    batch = box.read_batch(10)
+    assert [(r.source, r.data, r.attributes) for r in batch] == [
+        ("github", b"one", {"headers": "{}"}),
+        ("gitlab", b"two", {"headers": "{}"}),
+    ]
+    assert box.depth() == 2
+
+    box.commit(batch[0], 1)
+    assert [r.data for r in box.read_batch(10)] == [b"two"]
+    assert box.depth() == 1
+
+
+def test_outbox_survives_restart(tmp_path):
+    box = outbox.Outbox(str(tmp_path))
+    for data in (b"one", b"two", b"three"):
+        box.append("github", data, {})
+    box.commit(box.read_batch(1)[0], 1)
+    box.close()
+
+    reopened = outbox.Outbox(str(tmp_path))
+    assert reopened.depth() == 2
+    assert [r.data for r in reopened.read_batch(10)] == [b"two", b"three"]
+
+
+def test_torn_write_is_discarded_on_recovery(tmp_path):
+    box = outbox.Outbox(str(tmp_path))
+    box.append("github", b"one", {})
+    box.append("github", b"two", {})
+    box.close()
+
+    segment = os.path.join(str(tmp_path), "segment-000000000000.log")
+    size = os.path.getsize(segment)
+    with open(segment, "r+b") as f:
+        f.truncate(size - 2)
+
+    reopened = outbox.Outbox(str(tmp_path))
+    assert [r.data for r in reopened.read_batch(10)] == [b"one"]
+
+    reopened.append("github", b"three", {})
+    assert [r.data for r in reopened.read_batch(10)] == [b"one", b"three"]
+
+
+def test_segments_rotate_and_are_removed_once_drained(tmp_path):
+    box = outbox.Outbox(str(tmp_path), segment_max_bytes=1)
+    for data in (b"one", b"two", b"three"):
+        box.append("github", data, {})
+    assert len(box._segments()) == 3
+
+    batch = box.read_batch(10)
+    assert [r.data for r in batch] == [b"one", b"two", b"three"]
+    box.commit(batch[-1], 3)
+    assert box._segments() == [2]
+    assert box.depth() == 0
+
+
+def test_stats_report_depth_and_age(tmp_path):
+    box = outbox.Outbox(str(tmp_path))
+    assert box.stats() == {"depth": 0, "oldest_age_seconds": 0.0}
+
+    with mock.patch("outbox.time.time", return_value=100.0):
+        box.append("github", b"one", {})
+    with mock.patch("outbox.time.time", return_value=130.0):
+        assert box.stats() == {"depth": 1, "oldest_age_seconds": 30.0}
+
+
+def test_drainer_commits_published_prefix(tmp_path):
+    box = outbox.Outbox(str(tmp_path))
+    for data in (b"one", b"two", b"three"):
+        box.append("github", data, {"headers": "{}"})
+
+    ok = mock.MagicMock()
+    failed = mock.MagicMock()
+    failed.result.side_effect = Exception("unavailable")
+    publish = mock.MagicMock(side_effect=[ok, failed, ok])
+
+    drainer = outbox.OutboxDrainer(box, publish)
+    assert drainer.drain_batch(box.read_batch(10)) == 1
+
+    publish.assert_any_call("github", b"one", headers="{}")
+    assert [r.data for r in box.read_batch(10)] == [b"two", b"three"]
+
+
+def test_open_outbox_uses_a_free_slot(tmp_path):
+    first = outbox.open_outbox(str(tmp_path))
+    second = outbox.open_outbox(str(tmp_path))
+
+    assert first.directory.endswith("worker-0")
+    assert second.directory.endswith("worker-1")
+
+
+@pytest.mark.parametrize("segment_max_bytes", [1, 1024])
+def test_read_batch_spans_segments(tmp_path, segment_max_bytes):
+    box = outbox.Outbox(str(tmp_path), segment_max_bytes=segment_max_bytes)
+    for i in range(5):
+        box.append("github", str(i).encode(), {})
+
+    first = box.read_batch(2)
+    box.commit(first[-1], 2)
+    assert [r.data for r in box.read_batch(10)] == [b"2", b"3", b"4"]
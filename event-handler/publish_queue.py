@@ -0,0 +1,155 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import threading
+import time
+from typing import Callable, Dict
+
+import fast_json
+
+MAX_MESSAGES = int(os.environ.get("PUBLISH_QUEUE_MAX_MESSAGES", 1000))
+MAX_BYTES = int(os.environ.get("PUBLISH_QUEUE_MAX_BYTES", 256 * 1024 * 1024))
+WORKERS = int(os.environ.get("PUBLISH_QUEUE_WORKERS", 4))
+RETRY_AFTER = int(os.environ.get("PUBLISH_QUEUE_RETRY_AFTER", 5))
+
+# Outcomes of a queued message
+PUBLISHED = "published"
+OUTBOX = "outbox"
+LOST = "lost"
+
+
+class PublishQueue(object):
+    """
+    Bounded in-process queue of verified webhooks, drained into Pub/Sub by a
+    pool of worker threads.
+
+    Workers do not wait for Pub/Sub: `publish(source, body, headers, done)`
+    hands the message to the publisher and calls `done` with its outcome
+    (PUBLISHED, OUTBOX or LOST) once it is known, so the messages in flight
+    are bounded by the flow control of the publisher rather than by the
+    number of workers.
+    """
+
+    def __init__(
+        self,
+        publish: Callable[[str, bytes, Dict[str, str], Callable[[str], None]], None],
+        max_messages: int = MAX_MESSAGES,
+        max_bytes: int = MAX_BYTES,
+        workers: int = WORKERS,
+    ):
+        self._publish = publish
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+        self._items = collections.deque()
+        self._bytes = 0
+        self._in_progress = 0
+        self._lock = threading.Condition()
+        self._closed = False
+
+        self.accepted = 0
+        self.rejected = 0
+        self.outcomes = collections.Counter()
+
+        self._workers = [
+            threading.Thread(target=self._work, name=f"publish-queue-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def put(self, source: str, body: bytes, headers: Dict[str, str]) -> bool:
+        """
+        Queues a message, or returns False when the queue is full
+        """
+        with self._lock:
+            # A message is always accepted into an empty queue, so a payload
+            # larger than max_bytes is not rejected forever.
+            if self._closed or (
+                self._items
+                and (
+                    len(self._items) >= self.max_messages
+                    or self._bytes + len(body) > self.max_bytes
+                )
+            ):
+                self.rejected += 1
+                return False
+            self._items.append((source, body, headers))
+            self._bytes += len(body)
+            self.accepted += 1
+            self._lock.notify_all()
+            return True
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        Waits until every queued message has been published. Returns False
+        if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._items or self._in_progress:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def close(self, timeout: float = None) -> bool:
+        """
+        Stops accepting messages and drains the queue
+        """
+        with self._lock:
+            self._closed = True
+        return self.drain(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "depth": len(self._items),
+                "bytes": self._bytes,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "in_flight": self._in_progress,
+                "published": self.outcomes[PUBLISHED],
+                "outbox": self.outcomes[OUTBOX],
+                "lost": self.outcomes[LOST],
+            }
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._items:
+                    self._lock.wait()
+                source, body, headers = self._items.popleft()
+                self._bytes -= len(body)
+                self._in_progress += 1
+
+            try:
+                self._publish(source, body, headers, self._done)
+            except Exception as e:
+                entry = {
+                    "severity": "WARNING",
+                    "msg": "Queued message not published",
+                    "errors": str(e),
+                }
+                print(fast_json.dumps(entry))
+                self._done(LOST)
+
+    def _done(self, outcome: str):
+        with self._lock:
+            self._in_progress -= 1
+            self.outcomes[outcome] += 1
+            self._lock.notify_all()
@@ -0,0 +1,128 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from publish_queue import LOST, OUTBOX, PUBLISHED, PublishQueue
+
+import mock
+
+
+def publish_with(outcome):
+    """
+    Returns a mock publish function that completes each message with an
+    outcome
+    """
+    return mock.MagicMock(side_effect=lambda source, body, headers, done: done(outcome))
+
+
+def test_queued_messages_are_published():
+    publish = publish_with(PUBLISHED)
+    queue = PublishQueue(publish, workers=2)
+
+    assert queue.put("github", b"one", {"X-Team": "default"})
+    assert queue.put("gitlab", b"two", {"X-Team": "team1"})
+    assert queue.drain(timeout=5)
+
+    calls = [c.args[:3] for c in publish.call_args_list]
+    assert ("github", b"one", {"X-Team": "default"}) in calls
+    assert ("gitlab", b"two", {"X-Team": "team1"}) in calls
+    assert queue.stats()["published"] == 2
+
+
+def test_full_queue_rejects_messages():
+    release = threading.Event()
+    queue = PublishQueue(lambda *args: release.wait(5), max_messages=1, workers=1)
+
+    assert queue.put("github", b"in progress", {})
+    # Wait for the worker to take the first message off the queue
+    for _ in range(500):
+        if not queue.stats()["depth"]:
+            break
+        time.sleep(0.01)
+
+    assert queue.put("github", b"queued", {})
+    assert not queue.put("github", b"rejected", {})
+    assert queue.stats()["rejected"] == 1
+
+    release.set()
+
+
+def test_queue_is_bounded_by_bytes():
+    release = threading.Event()
+    queue = PublishQueue(lambda *args: release.wait(5), max_bytes=10, workers=0)
+
+    assert queue.put("github", b"x" * 8, {})
+    assert not queue.put("github", b"x" * 8, {})
+    # An oversized message is accepted into an empty queue
+    empty = PublishQueue(mock.MagicMock(), max_bytes=10, workers=0)
+    assert empty.put("github", b"x" * 20, {})
+
+
+def test_publish_errors_do_not_stop_workers():
+    def publish(source, body, headers, done):
+        if body == b"one":
+            raise Exception("unavailable")
+        done(PUBLISHED)
+
+    queue = PublishQueue(publish, workers=1)
+
+    queue.put("github", b"one", {})
+    queue.put("github", b"two", {})
+    assert queue.drain(timeout=5)
+    assert queue.stats()["published"] == 1
+    assert queue.stats()["lost"] == 1
+
+
+def test_outcomes_are_counted():
+    outcomes = iter([PUBLISHED, OUTBOX, LOST])
+    queue = PublishQueue(
+        lambda source, body, headers, done: done(next(outcomes)), workers=1
+    )
+
+    for body in (b"one", b"two", b"three"):
+        queue.put("github", body, {})
+    assert queue.drain(timeout=5)
+
+    stats = queue.stats()
+    assert (stats["published"], stats["outbox"], stats["lost"]) == (1, 1, 1)
+
+
+def test_workers_do_not_wait_for_pubsub():
+    pending = []
+    queue = PublishQueue(
+        lambda source, body, headers, done: pending.append(done), workers=1
+    )
+
+    for number in range(10):
+        queue.put("github", b"%d" % number, {})
+    for _ in range(500):
+        if len(pending) == 10:
+            break
+        time.sleep(0.01)
+
+    # One worker has handed every message to the publisher
+    assert queue.stats()["in_flight"] == 10
+    assert not queue.drain(timeout=0.01)
+    for done in pending:
+        done(PUBLISHED)
+    assert queue.drain(timeout=5)
+    assert queue.stats()["published"] == 10
+
+
+def test_closed_queue_rejects_messages():
+    queue = PublishQueue(mock.MagicMock(), workers=1)
+    assert queue.close(timeout=5)
+    assert not queue.put("github", b"one", {})
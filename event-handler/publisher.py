@@ -0,0 +1,84 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+from typing import Dict
+
+PROJECT_NAME = os.environ.get("PROJECT_NAME")
+
+# Messages published by concurrent requests are grouped into one Publish RPC
+# until one of these limits is reached.
+BATCH_MAX_MESSAGES = int(os.environ.get("PUBSUB_BATCH_MAX_MESSAGES", 100))
+BATCH_MAX_BYTES = int(os.environ.get("PUBSUB_BATCH_MAX_BYTES", 1024 * 1024))
+BATCH_MAX_LATENCY = float(os.environ.get("PUBSUB_BATCH_MAX_LATENCY", 0.01))
+
+# Publishing blocks once this many messages or bytes are waiting for Pub/Sub.
+FLOW_CONTROL_MAX_MESSAGES = int(
+    os.environ.get("PUBSUB_FLOW_CONTROL_MAX_MESSAGES", 1000)
+)
+FLOW_CONTROL_MAX_BYTES = int(
+    os.environ.get("PUBSUB_FLOW_CONTROL_MAX_BYTES", 100 * 1024 * 1024)
+)
+
+_publisher = None
+_publisher_lock = threading.Lock()
+_topic_paths: Dict[str, str] = {}
+
+
+def get_publisher():
+    """
+    Returns the Pub/Sub publisher shared by every request in the process
+    """
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                # Imported on first use to keep it out of the cold start
+                from google.cloud import pubsub_v1
+                from google.cloud.pubsub_v1 import types
+
+                _publisher = pubsub_v1.PublisherClient(
+                    batch_settings=types.BatchSettings(
+                        max_messages=BATCH_MAX_MESSAGES,
+                        max_bytes=BATCH_MAX_BYTES,
+                        max_latency=BATCH_MAX_LATENCY,
+                    ),
+                    publisher_options=types.PublisherOptions(
+                        flow_control=types.PublishFlowControl(
+                            message_limit=FLOW_CONTROL_MAX_MESSAGES,
+                            byte_limit=FLOW_CONTROL_MAX_BYTES,
+                            limit_exceeded_behavior=types.LimitExceededBehavior.BLOCK,
+                        )
+                    ),
+                )
+    return _publisher
+
+
+def topic_path(source: str) -> str:
+    """
+    Returns the topic path for a source, building it once per process
+    """
+    path = _topic_paths.get(source)
+    if path is None:
+        path = get_publisher().topic_path(PROJECT_NAME, source)
+        _topic_paths[source] = path
+    return path
+
+
+def publish(source: str, data: bytes, **attributes: str):
+    """
+    Queues a message for the source topic and returns its publish future
+    """
+    return get_publisher().publish(topic_path(source), data=data, **attributes)
@@ -0,0 +1,59 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import publisher
+
+import mock
+import pytest
+
+
+@pytest.fixture
+def client_class():
+    publisher._publisher = None
+    publisher._topic_paths.clear()
+    with mock.patch("google.cloud.pubsub_v1.PublisherClient") as client_class:
+        client_class.return_value.topic_path.side_effect = (
+            lambda project, topic: f"projects/{project}/topics/{topic}"
+        )
+        yield client_class
+    publisher._publisher = None
+    publisher._topic_paths.clear()
+
+
+def test_publisher_is_created_once(client_class):
+    publisher.publish("github", b"foo", headers="{}")
+    publisher.publish("gitlab", b"bar", headers="{}")
+
+    client_class.assert_called_once()
+    settings = client_class.call_args.kwargs["batch_settings"]
+    assert settings.max_messages == publisher.BATCH_MAX_MESSAGES
+    options = client_class.call_args.kwargs["publisher_options"]
+    assert options.flow_control.message_limit == publisher.FLOW_CONTROL_MAX_MESSAGES
+
+
+def test_topic_path_is_cached(client_class):
+    publisher.PROJECT_NAME = "project"
+    assert publisher.topic_path("github") == "projects/project/topics/github"
+    assert publisher.topic_path("github") == "projects/project/topics/github"
+
+    client_class.return_value.topic_path.assert_called_once_with("project", "github")
+
+
+def test_publish_sends_attributes(client_class):
+    publisher.PROJECT_NAME = "project"
+    publisher.publish("github", b"foo", headers="{}")
+
+    client_class.return_value.publish.assert_called_once_with(
+        "projects/project/topics/github", data=b"foo", headers="{}"
+    )
@@ -0,0 +1,228 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Token-bucket admission control per team and per source.
+
+Limits are a JSON object, given in RATE_LIMITS or in the file named by
+RATE_LIMITS_FILE, which is re-read when it changes:
+
+    {
+      "team": {"rate": 5, "burst": 100},
+      "teams": {"release-bot": {"rate": 1, "burst": 20}},
+      "source": {"rate": 200, "burst": 2000},
+      "sources": {"github": {"rate": 500, "burst": 5000}}
+    }
+
+"rate" is in webhooks per second and "burst" is the size of the bucket.
+"team" and "source" apply to every team and source without a limit of its
+own. A webhook is admitted when both its team and its source have a token.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Tuple, Union
+
+import fast_json
+
+LIMITS = os.environ.get("RATE_LIMITS")
+LIMITS_FILE = os.environ.get("RATE_LIMITS_FILE")
+# Seconds between checks of RATE_LIMITS_FILE for changes
+RELOAD_INTERVAL = float(os.environ.get("RATE_LIMITS_RELOAD_INTERVAL", 10))
+# Buckets kept per scope; the least recently used are dropped first
+MAX_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_BUCKETS", 10000))
+
+TEAM = "team"
+SOURCE = "source"
+
+
+class Limit(object):
+    """
+    Refill rate, in tokens per second, and capacity of a bucket
+    """
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0 or burst < 1:
+            raise ValueError("Rate limits need a positive rate and a burst of at least 1")
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+
+class Limits(object):
+    """
+    Parsed limits of teams and sources
+    """
+
+    def __init__(self, config: dict):
+        def limit(options):
+            return Limit(options["rate"], options["burst"]) if options else None
+
+        self.team = limit(config.get("team"))
+        self.teams = {k: limit(v) for k, v in config.get("teams", {}).items()}
+        self.source = limit(config.get("source"))
+        self.sources = {k: limit(v) for k, v in config.get("sources", {}).items()}
+
+    def get(self, scope: str, key: str) -> Union[Limit, None]:
+        if scope == TEAM:
+            return self.teams.get(key, self.team)
+        return self.sources.get(key, self.source)
+
+
+class RateLimiter(object):
+    """
+    Token buckets shared by the request threads of the process
+    """
+
+    def __init__(
+        self,
+        limits: Limits,
+        limits_file: str = None,
+        reload_interval: float = RELOAD_INTERVAL,
+        max_buckets: int = MAX_BUCKETS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limits = limits
+        self.limits_file = limits_file
+        self.reload_interval = reload_interval
+        self.max_buckets = max_buckets
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        # (scope, key) -> [tokens, updated_at]
+        self._buckets = collections.OrderedDict()
+        self._file_mtime = None
+        self._checked_at = None
+
+        self.admitted = 0
+        self.throttled = collections.Counter()
+
+        if limits_file:
+            self.maybe_reload()
+
+    def acquire(self, source: str, team: str) -> Tuple[float, Union[str, None]]:
+        """
+        Takes a token for the team and the source. Returns 0 and None if the
+        webhook is admitted, or the seconds until it would be and the scope
+        that throttled it.
+        """
+        if self.limits_file:
+            self.maybe_reload()
+
+        team = team or "default"
+        with self._lock:
+            now = self._clock()
+            wait, scope = 0.0, None
+            buckets = []
+            for bucket_scope, key in ((TEAM, team), (SOURCE, source)):
+                limit = self.limits.get(bucket_scope, key)
+                if limit is None:
+                    continue
+                bucket = self._refill((bucket_scope, key), limit, now)
+                if bucket[0] < 1:
+                    needed = (1 - bucket[0]) / limit.rate
+                    if needed > wait:
+                        wait, scope = needed, bucket_scope
+                buckets.append(bucket)
+
+            if scope is not None:
+                self.throttled[scope] += 1
+                return wait, scope
+
+            for bucket in buckets:
+                bucket[0] -= 1
+            self.admitted += 1
+            return 0.0, None
+
+    def configure(self, limits: Limits):
+        """
+        Replaces the limits. Buckets keep their tokens up to the new burst.
+        """
+        with self._lock:
+            self.limits = limits
+            for (scope, key), bucket in self._buckets.items():
+                limit = limits.get(scope, key)
+                if limit is not None:
+                    bucket[0] = min(bucket[0], limit.burst)
+
+    def maybe_reload(self):
+        """
+        Re-reads the limits file if it changed since it was last read
+        """
+        now = self._clock()
+        if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+            return
+        # Only one thread checks the file, the others go on with the old limits
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            self._reload()
+        finally:
+            self._reload_lock.release()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.limits_file).st_mtime_ns
+            if mtime == self._file_mtime:
+                return
+            with open(self.limits_file) as f:
+                limits = Limits(json.load(f))
+        except Exception as e:
+            # Keep the current limits until the file is fixed
+            entry = {
+                "severity": "WARNING",
+                "msg": "Rate limits not reloaded",
+                "errors": str(e),
+            }
+            print(fast_json.dumps(entry))
+            return
+
+        self._file_mtime = mtime
+        self.configure(limits)
+        print(fast_json.dumps({"severity": "INFO", "msg": "Rate limits reloaded"}))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "admitted": self.admitted,
+                "throttled_team": self.throttled[TEAM],
+                "throttled_source": self.throttled[SOURCE],
+                "buckets": len(self._buckets),
+            }
+
+    def _refill(self, key, limit: Limit, now: float) -> list:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [limit.burst, now]
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        return bucket
+
+
+def from_environment() -> Union[RateLimiter, None]:
+    """
+    Returns a rate limiter configured from the environment, or None if no
+    limits are configured
+    """
+    if not LIMITS and not LIMITS_FILE:
+        return None
+    return RateLimiter(Limits(fast_json.loads(LIMITS or "{}")), limits_file=LIMITS_FILE)
@@ -0,0 +1,116 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+from rate_limit import Limits, RateLimiter, SOURCE, TEAM
+
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_then_refill():
+    clock = FakeClock()
+    limiter = RateLimiter(Limits({"team": {"rate": 2, "burst": 3}}), clock=clock)
+
+    assert [limiter.acquire("github", "team1")[1] for _ in range(4)] == [
+        None, None, None, TEAM
+    ]
+    assert limiter.acquire("github", "team1")[0] == pytest.approx(0.5)
+
+    clock.now = 0.5
+    assert limiter.acquire("github", "team1") == (0.0, None)
+    assert limiter.acquire("github", "team1")[1] == TEAM
+
+
+def test_teams_have_their_own_buckets():
+    limiter = RateLimiter(Limits({
+        "team": {"rate": 1, "burst": 1},
+        "teams": {"bots": {"rate": 1, "burst": 2}},
+    }), clock=FakeClock())
+
+    assert limiter.acquire("github", "team1")[1] is None
+    assert limiter.acquire("github", "team1")[1] == TEAM
+    assert limiter.acquire("github", "team2")[1] is None
+    assert limiter.acquire("github", "bots")[1] is None
+    assert limiter.acquire("github", "bots")[1] is None
+    assert limiter.acquire("github", "bots")[1] == TEAM
+
+
+def test_source_limit_applies_to_all_teams():
+    limiter = RateLimiter(Limits({
+        "team": {"rate": 1, "burst": 10},
+        "sources": {"github": {"rate": 1, "burst": 2}},
+    }), clock=FakeClock())
+
+    assert limiter.acquire("github", "team1")[1] is None
+    assert limiter.acquire("github", "team2")[1] is None
+    assert limiter.acquire("github", "team3")[1] == SOURCE
+    assert limiter.acquire("gitlab", "team3")[1] is None
+    assert limiter.stats() == {
+        "admitted": 3, "throttled_team": 0, "throttled_source": 1, "buckets": 4
+    }
+
+
+def test_throttled_webhooks_do_not_take_tokens():
+    limiter = RateLimiter(Limits({
+        "team": {"rate": 1, "burst": 1},
+        "source": {"rate": 1, "burst": 2},
+    }), clock=FakeClock())
+
+    limiter.acquire("github", "team1")
+    limiter.acquire("github", "team1")
+
+    # The source bucket still holds the token the throttled webhook did not take
+    assert limiter.acquire("github", "team2")[1] is None
+
+
+def test_limits_file_is_reloaded(tmp_path):
+    clock = FakeClock()
+    path = tmp_path / "limits.json"
+    path.write_text(json.dumps({"team": {"rate": 1, "burst": 1}}))
+    limiter = RateLimiter(Limits({}), limits_file=str(path), reload_interval=10, clock=clock)
+
+    assert limiter.acquire("github", "team1")[1] is None
+    assert limiter.acquire("github", "team1")[1] == TEAM
+
+    path.write_text(json.dumps({"team": {"rate": 1, "burst": 5}}))
+    os.utime(path, ns=(1, 1))
+    clock.now = 1
+    # Not checked again before the reload interval
+    assert limiter.limits.team.burst == 1
+
+    clock.now = 10
+    limiter.acquire("github", "team2")
+    assert limiter.limits.team.burst == 5
+
+    # Invalid files keep the current limits
+    path.write_text("{")
+    os.utime(path, ns=(2, 2))
+    clock.now = 20
+    limiter.acquire("github", "team2")
+    assert limiter.limits.team.burst == 5
+
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        Limits({"team": {"rate": 0, "burst": 10}})
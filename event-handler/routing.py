@@ -0,0 +1,165 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Routing of the events of a topic to per-team shard topics, so that each
+shard has its own subscription and parser service.
+
+Shards are configured per topic in TOPIC_SHARDS, a JSON object:
+
+    {
+      "github": {"shards": 4, "teams": {"big-team": "big-team"}},
+      "gitlab": {"teams": {"big-team": "big-team"}}
+    }
+
+A team listed in "teams" is published to "<topic>-<shard>", here
+"github-big-team". Other teams are spread over "<topic>-shard-0" to
+"<topic>-shard-<shards - 1>" by a stable hash of the team, or stay on the
+topic itself when "shards" is not set. Topics without shards, like the
+diverted "<source>-ignored" topics, are not routed.
+
+When a shard topic does not exist, its events are published to the topic
+itself for FALLBACK_TTL seconds before the shard is tried again.
+"""
+
+import os
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Tuple, Type, Union
+
+import fast_json
+
+SHARDS = os.environ.get("TOPIC_SHARDS")
+# Seconds events of a missing shard topic go to the topic itself
+FALLBACK_TTL = float(os.environ.get("TOPIC_SHARDS_FALLBACK_TTL", 60))
+
+_not_found_errors = None
+
+
+class TopicShards(object):
+    """
+    Shards of one topic
+    """
+
+    def __init__(self, topic: str, shards: int = 0, teams: Dict[str, str] = None):
+        if not isinstance(shards, int) or shards < 0:
+            raise ValueError(f"Shards of {topic} must be a non-negative integer")
+        if not all(isinstance(shard, str) and shard for shard in (teams or {}).values()):
+            raise ValueError(f"Team shards of {topic} must be non-empty strings")
+        self.topic = topic
+        self.shards = shards
+        self.teams = {
+            team: f"{topic}-{shard}" for team, shard in (teams or {}).items()
+        }
+        self.hashed = tuple(f"{topic}-shard-{n}" for n in range(shards))
+
+    def route(self, team: str) -> str:
+        topic = self.teams.get(team)
+        if topic is not None:
+            return topic
+        if self.hashed:
+            # crc32 rather than hash(), which differs between processes
+            return self.hashed[zlib.crc32(team.encode("utf-8")) % len(self.hashed)]
+        return self.topic
+
+    def topics(self) -> Tuple[str, ...]:
+        return tuple(sorted(set(self.teams.values()))) + self.hashed
+
+
+def load_shards(config: Union[str, None]) -> Dict[str, TopicShards]:
+    """
+    Parses TOPIC_SHARDS. Raises ValueError if it is not valid.
+    """
+    if not config:
+        return {}
+    shards = {}
+    for topic, options in fast_json.loads(config).items():
+        if not isinstance(options, dict):
+            raise ValueError(f"Shards of {topic} must be an object")
+        shards[topic] = TopicShards(
+            topic, options.get("shards", 0), options.get("teams")
+        )
+    return shards
+
+
+class TopicRouter(object):
+    """
+    Maps the topic of an event and its team to the topic it is published to
+    """
+
+    def __init__(
+        self,
+        shards: Dict[str, TopicShards],
+        fallback_ttl: float = FALLBACK_TTL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.shards = shards
+        self.fallback_ttl = fallback_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Shard topic -> time until which its events go to the topic itself
+        self._missing: Dict[str, float] = {}
+
+    def route(self, topic: str, team: Union[str, None]) -> str:
+        """
+        Returns the topic to publish an event of the team to
+        """
+        shards = self.shards.get(topic)
+        if shards is None:
+            return topic
+        routed = shards.route(team or "default")
+        if self._missing and routed in self._missing:
+            if self._clock() < self._missing[routed]:
+                return topic
+            with self._lock:
+                self._missing.pop(routed, None)
+        return routed
+
+    def missing(self, routed: str):
+        """
+        Sends the events of a shard topic that does not exist to its topic
+        for the next fallback_ttl seconds
+        """
+        with self._lock:
+            self._missing[routed] = self._clock() + self.fallback_ttl
+        entry = {
+            "severity": "WARNING",
+            "msg": "Shard topic not found, publishing to its topic instead",
+            "topic": routed,
+        }
+        print(fast_json.dumps(entry))
+
+    def topics(self) -> Tuple[str, ...]:
+        """
+        Returns every shard topic
+        """
+        return tuple(t for shards in self.shards.values() for t in shards.topics())
+
+
+def is_missing_topic(error: Exception) -> bool:
+    """
+    Returns True if publishing failed because the topic does not exist
+    """
+    return isinstance(error, _not_found())
+
+
+def _not_found() -> Tuple[Type[Exception], ...]:
+    # google.api_core is only imported once a publish fails
+    global _not_found_errors
+    if _not_found_errors is None:
+        from google.api_core.exceptions import NotFound
+
+        _not_found_errors = (NotFound,)
+    return _not_found_errors
@@ -0,0 +1,83 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+from google.api_core.exceptions import NotFound
+
+from routing import is_missing_topic, load_shards, TopicRouter
+
+import pytest
+
+SHARDS = '{"github": {"shards": 4, "teams": {"big": "big"}}, "gitlab": {"teams": {"big": "big"}}}'
+
+
+def test_listed_teams_have_their_own_topic():
+    router = TopicRouter(load_shards(SHARDS))
+
+    assert router.route("github", "big") == "github-big"
+    assert router.route("gitlab", "big") == "gitlab-big"
+
+
+def test_other_teams_are_hashed():
+    router = TopicRouter(load_shards(SHARDS))
+
+    topics = collections.Counter(router.route("github", f"team{n}") for n in range(1000))
+
+    assert set(topics) == {f"github-shard-{n}" for n in range(4)}
+    assert min(topics.values()) > 200
+    assert router.route("github", "team1") == router.route("github", "team1")
+    assert router.route("github", None) == router.route("github", "default")
+
+
+def test_unsharded_topics_are_not_routed():
+    router = TopicRouter(load_shards(SHARDS))
+
+    assert router.route("gitlab", "small") == "gitlab"
+    assert router.route("github-ignored", "big") == "github-ignored"
+    assert TopicRouter({}).route("github", "big") == "github"
+
+
+def test_missing_shard_falls_back_to_topic():
+    now = [0.0]
+    router = TopicRouter(load_shards(SHARDS), fallback_ttl=60, clock=lambda: now[0])
+
+    router.missing("github-big")
+    assert router.route("github", "big") == "github"
+
+    now[0] = 61
+    assert router.route("github", "big") == "github-big"
+
+
+def test_topics():
+    router = TopicRouter(load_shards(SHARDS))
+
+    assert set(router.topics()) == {
+        "github-big", "gitlab-big", *(f"github-shard-{n}" for n in range(4))
+    }
+
+
+@pytest.mark.parametrize("config", [
+    '{"github": 4}',
+    '{"github": {"shards": -1}}',
+    '{"github": {"teams": {"big": ""}}}',
+])
+def test_invalid_config(config):
+    with pytest.raises(ValueError):
+        load_shards(config)
+
+
+def test_is_missing_topic():
+    assert is_missing_topic(NotFound("topic"))
+    assert not is_missing_topic(Exception("unavailable"))
@@ -0,0 +1,259 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Tuple, Type
+
+import fast_json
+
+
+class SecretNotFoundError(Exception):
+    """
+    Raised when a secret is known to be missing from a previous lookup
+    """
+
+
+class _Entry(object):
+    __slots__ = ("value", "fetched_at", "missing")
+
+    def __init__(self, value: bytes, fetched_at: float, missing: bool = False):
+        self.value = value
+        self.fetched_at = fetched_at
+        self.missing = missing
+
+
+class SecretCache(object):
+    """
+    Process-wide cache of secret payloads keyed by secret name.
+
+    Entries younger than `ttl` are served directly. Entries older than `ttl`
+    but within `stale_ttl` after it are still served, while a single
+    background thread refreshes them. Secrets that do not exist are
+    remembered for `negative_ttl` seconds so that requests for unknown teams
+    do not reach Secret Manager every time. When Secret Manager fails, the
+    last known payload is served however old it is.
+
+    Secret names come from the unauthenticated "team" query parameter, so at
+    most `max_entries` secrets are kept; the least recently used is dropped
+    first.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], bytes],
+        ttl: float = 300,
+        stale_ttl: float = 600,
+        negative_ttl: float = 60,
+        max_entries: int = 10000,
+        not_found_errors: Tuple[Type[Exception], ...] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._not_found_errors = not_found_errors
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _Entry] = collections.OrderedDict()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._refreshing = set()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.refresh_errors = 0
+        self.fallback_hits = 0
+        self.evictions = 0
+
+    def _not_found(self) -> Tuple[Type[Exception], ...]:
+        # google.api_core is only imported once a secret is fetched
+        if self._not_found_errors is None:
+            from google.api_core.exceptions import NotFound
+
+            self._not_found_errors = (NotFound,)
+        return self._not_found_errors
+
+    def get(self, secret_name: str) -> bytes:
+        """
+        Returns the secret payload, fetching it on a miss
+        """
+        found, value = self._lookup(secret_name)
+        if found:
+            return value
+        if self.ttl <= 0:
+            return self._fetch(secret_name)
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(secret_name, threading.Lock())
+
+        # Only one thread per secret goes to Secret Manager on a miss, the
+        # others wait and pick up its result.
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(secret_name)
+                if entry is not None and not entry.missing:
+                    if self._clock() - entry.fetched_at < self.ttl:
+                        return entry.value
+            try:
+                return self._load(secret_name)
+            except self._not_found():
+                raise
+            except Exception as e:
+                return self._last_known(secret_name, e)
+            finally:
+                with self._lock:
+                    # Secrets that could not be fetched are not stored, and
+                    # neither is their lock
+                    if secret_name not in self._entries:
+                        self._key_locks.pop(secret_name, None)
+
+    async def get_async(
+        self, secret_name: str, fetch: Callable[[str], Awaitable[bytes]]
+    ) -> bytes:
+        """
+        Returns the secret payload, awaiting `fetch` on a miss
+        """
+        found, value = self._lookup(secret_name)
+        if found:
+            return value
+
+        try:
+            value = await fetch(secret_name)
+        except self._not_found():
+            self._store(secret_name, _Entry(b"", self._clock(), missing=True))
+            raise
+        except Exception as e:
+            return self._last_known(secret_name, e)
+        self._store(secret_name, _Entry(value, self._clock()))
+        return value
+
+    def invalidate(self, secret_name: str = None):
+        """
+        Drops one secret, or every secret when no name is given
+        """
+        with self._lock:
+            if secret_name is None:
+                self._entries.clear()
+                self._key_locks.clear()
+            else:
+                self._entries.pop(secret_name, None)
+                self._key_locks.pop(secret_name, None)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the cache counters
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "refresh_errors": self.refresh_errors,
+                "fallback_hits": self.fallback_hits,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+    def _lookup(self, secret_name: str) -> Tuple[bool, bytes]:
+        """
+        Returns (True, value) when the secret can be served from memory and
+        (False, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(secret_name) if self.ttl > 0 else None
+            if entry is not None:
+                age = self._clock() - entry.fetched_at
+                if entry.missing:
+                    if age < self.negative_ttl:
+                        self.negative_hits += 1
+                        raise SecretNotFoundError(
+                            f"Secret not found: {secret_name}"
+                        )
+                elif age < self.ttl:
+                    self.hits += 1
+                    self._entries.move_to_end(secret_name)
+                    return True, entry.value
+                elif age < self.ttl + self.stale_ttl:
+                    self.stale_hits += 1
+                    self._entries.move_to_end(secret_name)
+                    self._schedule_refresh(secret_name)
+                    return True, entry.value
+            self.misses += 1
+        return False, None
+
+    def _last_known(self, secret_name: str, error: Exception) -> bytes:
+        """
+        Returns the last payload fetched for a secret after fetching it
+        failed, or raises the error if it was never fetched
+        """
+        with self._lock:
+            entry = self._entries.get(secret_name)
+            if entry is None or entry.missing:
+                raise error
+            self.fallback_hits += 1
+            return entry.value
+
+    def _store(self, secret_name: str, entry: _Entry):
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[secret_name] = entry
+                self._entries.move_to_end(secret_name)
+                while len(self._entries) > self.max_entries:
+                    evicted, _ = self._entries.popitem(last=False)
+                    self._key_locks.pop(evicted, None)
+                    self.evictions += 1
+
+    def _load(self, secret_name: str) -> bytes:
+        try:
+            value = self._fetch(secret_name)
+        except self._not_found():
+            self._store(secret_name, _Entry(b"", self._clock(), missing=True))
+            raise
+
+        self._store(secret_name, _Entry(value, self._clock()))
+        return value
+
+    def _schedule_refresh(self, secret_name: str):
+        # Called with self._lock held
+        if secret_name in self._refreshing:
+            return
+        self._refreshing.add(secret_name)
+        thread = threading.Thread(
+            target=self._refresh, args=(secret_name,), daemon=True
+        )
+        thread.start()
+
+    def _refresh(self, secret_name: str):
+        try:
+            self._load(secret_name)
+        except Exception as e:
+            with self._lock:
+                self.refresh_errors += 1
+            entry = {
+                "severity": "WARNING",
+                "msg": "Secret refresh failed",
+                "secret": secret_name,
+                "errors": str(e),
+            }
+            print(fast_json.dumps(entry))
+        finally:
+            with self._lock:
+                self._refreshing.discard(secret_name)
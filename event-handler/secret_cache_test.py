@@ -0,0 +1,167 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from google.api_core.exceptions import NotFound
+
+import mock
+import pytest
+
+from circuit_breaker import CircuitOpenError
+from secret_cache import SecretCache, SecretNotFoundError
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_fresh_entries_are_served_from_cache():
+    fetch = mock.MagicMock(return_value=b"foo")
+    cache = SecretCache(fetch, ttl=10, clock=FakeClock())
+
+    assert cache.get("event-handler") == b"foo"
+    assert cache.get("event-handler") == b"foo"
+
+    fetch.assert_called_once_with("event-handler")
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+
+
+def test_secrets_are_keyed_by_name():
+    fetch = mock.MagicMock(side_effect=lambda name: name.encode())
+    cache = SecretCache(fetch, ttl=10, clock=FakeClock())
+
+    assert cache.get("event-handler") == b"event-handler"
+    assert cache.get("event-handler-team1") == b"event-handler-team1"
+    assert fetch.call_count == 2
+
+
+def test_stale_entries_are_served_while_refreshing():
+    clock = FakeClock()
+    refreshed = threading.Event()
+    values = iter([b"old", b"new"])
+
+    def fetch(name):
+        value = next(values)
+        if value == b"new":
+            refreshed.set()
+        return value
+
+    cache = SecretCache(fetch, ttl=10, stale_ttl=60, clock=clock)
+    assert cache.get("event-handler") == b"old"
+
+    clock.now = 15
+    assert cache.get("event-handler") == b"old"
+    assert refreshed.wait(5)
+
+    # Wait for the refresh thread to store its result
+    for _ in range(100):
+        if not cache._refreshing:
+            break
+        time.sleep(0.01)
+
+    assert cache.get("event-handler") == b"new"
+    assert cache.stats()["stale_hits"] == 1
+
+
+def test_expired_entries_are_fetched_synchronously():
+    clock = FakeClock()
+    fetch = mock.MagicMock(side_effect=[b"old", b"new"])
+    cache = SecretCache(fetch, ttl=10, stale_ttl=5, clock=clock)
+
+    assert cache.get("event-handler") == b"old"
+    clock.now = 20
+    assert cache.get("event-handler") == b"new"
+    assert cache.stats()["misses"] == 2
+
+
+def test_unknown_secrets_are_negatively_cached():
+    clock = FakeClock()
+    fetch = mock.MagicMock(side_effect=NotFound("missing"))
+    cache = SecretCache(fetch, ttl=10, negative_ttl=30, clock=clock)
+
+    with pytest.raises(NotFound):
+        cache.get("event-handler-unknown")
+    with pytest.raises(SecretNotFoundError):
+        cache.get("event-handler-unknown")
+    assert fetch.call_count == 1
+    assert cache.stats()["negative_hits"] == 1
+
+    clock.now = 31
+    with pytest.raises(NotFound):
+        cache.get("event-handler-unknown")
+    assert fetch.call_count == 2
+
+
+def test_other_errors_are_not_cached():
+    fetch = mock.MagicMock(side_effect=[Exception("unavailable"), b"foo"])
+    cache = SecretCache(fetch, ttl=10, clock=FakeClock())
+
+    with pytest.raises(Exception):
+        cache.get("event-handler")
+    assert cache.get("event-handler") == b"foo"
+
+
+def test_last_known_secret_is_served_when_fetching_fails():
+    clock = FakeClock()
+    fetch = mock.MagicMock(side_effect=[b"old", CircuitOpenError("open"), b"new"])
+    cache = SecretCache(fetch, ttl=10, stale_ttl=5, clock=clock)
+
+    assert cache.get("event-handler") == b"old"
+    clock.now = 100
+    assert cache.get("event-handler") == b"old"
+    assert cache.stats()["fallback_hits"] == 1
+    assert cache.get("event-handler") == b"new"
+
+
+def test_zero_ttl_disables_cache():
+    fetch = mock.MagicMock(return_value=b"foo")
+    cache = SecretCache(fetch, ttl=0, clock=FakeClock())
+
+    cache.get("event-handler")
+    cache.get("event-handler")
+    assert fetch.call_count == 2
+
+
+def test_least_recently_used_secrets_are_evicted():
+    fetch = mock.MagicMock(side_effect=lambda name: name.encode())
+    cache = SecretCache(fetch, ttl=10, max_entries=2, clock=FakeClock())
+
+    cache.get("event-handler-team1")
+    cache.get("event-handler-team2")
+    cache.get("event-handler-team1")
+    cache.get("event-handler-team3")
+
+    assert set(cache._entries) == {"event-handler-team1", "event-handler-team3"}
+    assert set(cache._key_locks) <= set(cache._entries)
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size"] == 2
+
+
+def test_locks_of_failed_fetches_are_dropped():
+    fetch = mock.MagicMock(side_effect=Exception("unavailable"))
+    cache = SecretCache(fetch, ttl=10, clock=FakeClock())
+
+    for team in range(10):
+        with pytest.raises(Exception):
+            cache.get(f"event-handler-team{team}")
+
+    assert cache._key_locks == {}
@@ -15,14 +15,21 @@
 import hmac
 from hashlib import sha1, sha256
 import os
-from typing import Callable,Union
+import threading
+from typing import Callable, Iterable, Union
 
-from google.cloud import secretmanager
 from werkzeug.datastructures import Headers
 
+from circuit_breaker import CircuitBreaker
+import metrics
+from secret_cache import SecretCache
+
 PROJECT_NAME = os.environ.get("PROJECT_NAME")
 
-VerificationFunction = Callable[[str, Union[str, None], bytes], bool]
+VerificationFunction = Callable[..., bool]
+
+# Headers published for every source: the team and the data generator flag
+FORWARDED_HEADERS = ("X-Team", "Mock")
 
 
 class EventSource(object):
@@ -30,22 +37,57 @@ class EventSource(object):
     A source of event data being delivered to the webhook
     """
 
-    def __init__(self, signature_header: str, verification_func: VerificationFunction):
+    def __init__(self, signature_header: str, verification_func: VerificationFunction,
+                 digestmod=None, delivery_header: str = None,
+                 forwarded_headers: Iterable[str] = None):
         self.signature = signature_header
         self.verification = verification_func
+        # Hash of the HMAC signature, for sources that sign the request body
+        self.digestmod = digestmod
+        # Header identifying a delivery, repeated when it is retried
+        self.delivery_header = delivery_header
+        # Headers the parser reads, published as Pub/Sub attributes. Names
+        # ending with "*" are prefixes. None forwards every header.
+        self.forwarded_headers = None
+        self.forwarded_prefixes = ()
+        if forwarded_headers is not None:
+            names = set(FORWARDED_HEADERS)
+            names.update(h for h in forwarded_headers if not h.endswith("*"))
+            self.forwarded_headers = frozenset(names)
+            self.forwarded_prefixes = tuple(
+                h[:-1] for h in forwarded_headers if h.endswith("*")
+            )
+
+    def forwards(self, header: str) -> bool:
+        """
+        Returns True if the header is published along with the event
+        """
+        return (
+            self.forwarded_headers is None
+            or header in self.forwarded_headers
+            or header.startswith(self.forwarded_prefixes)
+        )
+
+
+def new_hmac(team: Union[str, None], digestmod) -> hmac.HMAC:
+    """
+    Returns an HMAC keyed with the team secret, to be fed the request body
+    as it is read
+    """
+    return hmac.new(read_secret(team), digestmod=digestmod)
 
 
-def github_verification(signature: str, team: Union[str, None], body: bytes) -> bool:
+def github_verification(signature: str, team: Union[str, None], body: bytes,
+                        mac: hmac.HMAC = None) -> bool:
     """
-    Verifies that the signature received from the github event is accurate
+    Verifies that the signature received from the github event is accurate.
+    `mac` is an HMAC from new_hmac that was already fed the body.
     """
 
     expected_signature = "sha1="
     try:
-        # Get secret from Cloud Secret Manager
-        secret = read_secret(team)
-        # Compute the hashed signature
-        hashed = hmac.new(secret, body, sha1)
+        # Compute the hashed signature with the secret from Secret Manager
+        hashed = mac or hmac.new(read_secret(team), body, sha1)
         expected_signature += hashed.hexdigest()
 
     except Exception as e:
@@ -54,17 +96,16 @@ def github_verification(signature: str, team: Union[str, None], body: bytes) ->
     return hmac.compare_digest(signature, expected_signature)
 
 
-def circleci_verification(signature: str, team: Union[str, None], body: bytes) -> bool:
+def circleci_verification(signature: str, team: Union[str, None], body: bytes,
+                          mac: hmac.HMAC = None) -> bool:
     """
     Verifies that the signature received from the circleci event is accurate
     """
 
     expected_signature = "v1="
     try:
-        # Get secret from Cloud Secret Manager
-        secret = read_secret(team)
-        # Compute the hashed signature
-        hashed = hmac.new(secret, body, 'sha256')
+        # Compute the hashed signature with the secret from Secret Manager
+        hashed = mac or hmac.new(read_secret(team), body, 'sha256')
         expected_signature += hashed.hexdigest()
 
     except Exception as e:
@@ -74,7 +115,8 @@ def circleci_verification(signature: str, team: Union[str, None], body: bytes) -
     return hmac.compare_digest(signature, expected_signature)
 
 
-def pagerduty_verification(signatures: str, team: Union[str, None], body: bytes):
+def pagerduty_verification(signatures: str, team: Union[str, None], body: bytes,
+                           mac: hmac.HMAC = None):
     """
     Verifies that the signature received from the pagerduty event is accurate
     """
@@ -89,11 +131,8 @@ def pagerduty_verification(signatures: str, team: Union[str, None], body: bytes)
 
     expected_signature = "v1="
     try:
-        # Get secret from Cloud Secret Manager
-        secret = read_secret(team)
-
-        # Compute the hashed signature
-        hashed = hmac.new(secret, body, sha256)
+        # Compute the hashed signature with the secret from Secret Manager
+        hashed = mac or hmac.new(read_secret(team), body, sha256)
         expected_signature += hashed.hexdigest()
 
     except Exception as e:
@@ -106,7 +145,8 @@ def pagerduty_verification(signatures: str, team: Union[str, None], body: bytes)
         return False
 
 
-def simple_token_verification(token: str, team: Union[str, None], body: bytes) -> bool:
+def simple_token_verification(token: str, team: Union[str, None], body: bytes,
+                              mac: hmac.HMAC = None) -> bool:
     """
     Verifies that the token received from the event is accurate
     """
@@ -121,25 +161,128 @@ def simple_token_verification(token: str, team: Union[str, None], body: bytes) -
     return secret.decode() == token
 
 
-def read_secret(team: Union[str, None] = None) -> bytes:
+def secret_name(team: Union[str, None] = None) -> str:
     if team is None:
-        return get_secret(PROJECT_NAME, "event-handler", "latest")
+        return "event-handler"
     else:
-        return get_secret(PROJECT_NAME, f"event-handler-{team}", "latest")
+        return f"event-handler-{team}"
+
+
+def read_secret(team: Union[str, None] = None) -> bytes:
+    return SECRET_CACHE.get(secret_name(team))
+
+
+async def read_secret_async(team: Union[str, None] = None) -> bytes:
+    return await SECRET_CACHE.get_async(
+        secret_name(team), _fetch_latest_secret_async
+    )
+
+
+def _fetch_latest_secret(secret_name: str) -> bytes:
+    return get_secret(PROJECT_NAME, secret_name, "latest")
+
+
+async def _fetch_latest_secret_async(secret_name: str) -> bytes:
+    return await get_secret_async(PROJECT_NAME, secret_name, "latest")
+
+
+SECRET_CACHE = SecretCache(
+    _fetch_latest_secret,
+    ttl=float(os.environ.get("SECRET_CACHE_TTL", 300)),
+    stale_ttl=float(os.environ.get("SECRET_CACHE_STALE_TTL", 600)),
+    negative_ttl=float(os.environ.get("SECRET_CACHE_NEGATIVE_TTL", 60)),
+    max_entries=int(os.environ.get("SECRET_CACHE_MAX_ENTRIES", 10000)),
+)
+metrics.register_secret_cache(SECRET_CACHE.stats)
+
+
+def _secret_manager_failure(error: Exception) -> bool:
+    # Unknown teams have no secret, which is not a Secret Manager failure
+    from google.api_core.exceptions import NotFound
+
+    return not isinstance(error, NotFound)
+
+
+# Secret Manager calls fail fast while it is failing, and the secret cache
+# serves the last known secrets meanwhile
+SECRET_BREAKER = CircuitBreaker(
+    metrics.SECRET_MANAGER,
+    is_failure=_secret_manager_failure,
+    on_transition=metrics.circuit_breaker_transition,
+    on_reject=metrics.circuit_breaker_rejected,
+)
+
+_secret_client = None
+_secret_client_lock = threading.Lock()
+_secret_async_client = None
+
+
+def get_secret_client():
+    """
+    Returns the Secret Manager client shared by every request in the process
+    """
+    global _secret_client
+    if _secret_client is None:
+        with _secret_client_lock:
+            if _secret_client is None:
+                # Imported on first use to keep it out of the cold start
+                from google.cloud import secretmanager
+
+                _secret_client = secretmanager.SecretManagerServiceClient()
+    return _secret_client
 
 
 def get_secret(project_name, secret_name, version_num) -> bytes:
     """
     Returns secret payload from Cloud Secret Manager
     """
-    client = secretmanager.SecretManagerServiceClient()
+    client = get_secret_client()
+    name = client.secret_version_path(
+        project_name, secret_name, version_num
+    )
+    with SECRET_BREAKER.guard():
+        secret = client.access_secret_version(request={"name": name})
+    return secret.payload.data
+
+
+async def get_secret_async(project_name, secret_name, version_num) -> bytes:
+    """
+    Returns secret payload from Cloud Secret Manager without blocking the
+    event loop
+    """
+    global _secret_async_client
+    # The async client binds to the running event loop, so it is created on
+    # first use rather than at import time.
+    if _secret_async_client is None:
+        from google.cloud import secretmanager
+
+        _secret_async_client = secretmanager.SecretManagerServiceAsyncClient()
+    client = _secret_async_client
     name = client.secret_version_path(
         project_name, secret_name, version_num
     )
-    secret = client.access_secret_version(name)
+    with SECRET_BREAKER.guard():
+        secret = await client.access_secret_version(request={"name": name})
     return secret.payload.data
 
 
+def delivery_key(source: str, headers: Headers, signature: str, body: bytes) -> str:
+    """
+    Returns a key that is the same for every retry of a delivery
+    """
+    auth_source = AUTHORIZED_SOURCES[source]
+    if auth_source.delivery_header:
+        delivery = headers.get(auth_source.delivery_header)
+        if delivery:
+            return f"{source}:{delivery}"
+
+    # HMAC signatures are a digest of the body, tokens are not. Events of
+    # a batch have no signature of their own.
+    if auth_source.digestmod and signature:
+        return f"{source}:{signature}"
+    return f"{source}:{sha1(body).hexdigest()}"
+
+
 def get_source(headers: Headers) -> str:
     """
     Gets the source from the User-Agent header
@@ -167,21 +310,31 @@ def get_source(headers: Headers) -> str:
 
 AUTHORIZED_SOURCES = {
     "github": EventSource(
-        "X-Hub-Signature", github_verification
+        "X-Hub-Signature", github_verification, sha1,
+        delivery_header="X-GitHub-Delivery",
+        forwarded_headers=("X-Github-Event", "X-Hub-Signature")
         ),
     "gitlab": EventSource(
-        "X-Gitlab-Token", simple_token_verification
+        "X-Gitlab-Token", simple_token_verification,
+        delivery_header="X-Gitlab-Event-UUID",
+        forwarded_headers=("X-Gitlab-Event",)
         ),
     "jira": EventSource(
-        "token", simple_token_verification
+        "token", simple_token_verification,
+        forwarded_headers=("User-Agent",)
         ),
     "tekton": EventSource(
-        "tekton-secret", simple_token_verification
+        "tekton-secret", simple_token_verification,
+        delivery_header="Ce-Id",
+        # CloudEvents binary mode attributes, read by cloudevents.from_http
+        forwarded_headers=("Content-Type", "Ce-*")
         ),
     "circleci": EventSource(
-        "Circleci-Signature", circleci_verification
+        "Circleci-Signature", circleci_verification, sha256,
+        forwarded_headers=("Circleci-Event-Type", "Circleci-Signature")
         ),
     "pagerduty": EventSource(
-        "X-Pagerduty-Signature", pagerduty_verification
+        "X-Pagerduty-Signature", pagerduty_verification, sha256,
+        forwarded_headers=()
         ),
 }
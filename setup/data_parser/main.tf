@@ -54,3 +54,64 @@ resource "google_pubsub_subscription" "parser" {
   labels = { "created_by" : "fourkeys" }
 
 }
+
+resource "google_cloud_run_service" "shard" {
+  for_each = toset(var.topic_shards)
+  name     = "${var.parser_service_name}-parser-${each.key}"
+  location = var.google_region
+
+  template {
+    spec {
+      containers {
+        image = "gcr.io/${var.google_project_id}/${var.parser_service_name}-parser"
+        env {
+          name  = "PROJECT_NAME"
+          value = var.google_project_id
+        }
+      }
+      service_account_name = var.fourkeys_service_account_email
+    }
+  }
+
+  traffic {
+    percent         = 100
+    latest_revision = true
+  }
+
+  autogenerate_revision_name = true
+
+  metadata {
+    labels = { "created_by" : "fourkeys" }
+  }
+
+}
+
+resource "google_pubsub_topic" "shard" {
+  for_each = toset(var.topic_shards)
+  name     = "${var.parser_service_name}-${each.key}"
+  labels   = { "created_by" : "fourkeys" }
+}
+
+resource "google_pubsub_topic_iam_member" "event_handler_shard" {
+  for_each = toset(var.topic_shards)
+  topic    = google_pubsub_topic.shard[each.key].id
+  role     = "roles/editor"
+  member   = "serviceAccount:${var.fourkeys_service_account_email}"
+}
+
+resource "google_pubsub_subscription" "shard" {
+  for_each = toset(var.topic_shards)
+  name     = "${var.parser_service_name}-${each.key}-subscription"
+  topic    = google_pubsub_topic.shard[each.key].id
+
+  push_config {
+    push_endpoint = google_cloud_run_service.shard[each.key].status[0]["url"]
+
+    oidc_token {
+      service_account_email = var.fourkeys_service_account_email
+    }
+
+  }
+  labels = { "created_by" : "fourkeys" }
+
+}
@@ -1,3 +1,6 @@
 output "cloud_run_endpoint" {
   value = google_cloud_run_service.parser.status[0]["url"]
-}
\ No newline at end of file
+}
+output "shard_cloud_run_endpoints" {
+  value = { for shard, service in google_cloud_run_service.shard : shard => service.status[0]["url"] }
+}
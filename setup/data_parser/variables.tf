@@ -12,4 +12,9 @@ variable "google_region" {
 
 variable "fourkeys_service_account_email" {
   type = string
-}
\ No newline at end of file
+}
+variable "topic_shards" {
+  type        = list(string)
+  default     = []
+  description = "Shards of the parser topic, e.g. [\"shard-0\", \"shard-1\", \"big-team\"], matching TOPIC_SHARDS of the event handler. Each shard gets a topic, a subscription and a parser service."
+}
@@ -0,0 +1,862 @@
+# Copyright 2020 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import hashlib
+import json
+import os
+import queue
+import signal
+import threading
+
+from google.cloud import pubsub_v1
+from google.protobuf import timestamp_pb2
+import mock
+import pytest
+
+import shared
+
+
+def table(columns):
+    return mock.MagicMock(schema=[mock.MagicMock() for _ in range(columns)])
+
+
+@pytest.fixture
+def client():
+    client = mock.MagicMock()
+    client.insert_rows.return_value = []
+    with mock.patch("shared._client", client), mock.patch.dict(shared._tables, clear=True), \
+            mock.patch("shared.BATCHING", False):
+        yield client
+
+
+def test_client_is_created_once():
+    with mock.patch("shared._client", None), mock.patch("google.cloud.bigquery.Client") as Client:
+        assert shared.get_bigquery_client() is shared.get_bigquery_client()
+    Client.assert_called_once_with()
+
+
+def test_schema_is_cached(client):
+    client.get_table.return_value = table(2)
+
+    shared.insert_rows("events_enriched", [("a", "b")])
+    shared.insert_rows("events_enriched", [("c", "d")])
+
+    client.get_table.assert_called_once_with("four_keys.events_enriched")
+    assert client.insert_rows.call_count == 2
+
+
+def test_schema_expires(client):
+    client.get_table.return_value = table(2)
+
+    with mock.patch("time.monotonic", return_value=0):
+        shared.insert_rows("events_enriched", [("a", "b")])
+    with mock.patch("time.monotonic", return_value=shared.SCHEMA_CACHE_TTL + 1):
+        shared.insert_rows("events_enriched", [("a", "b")])
+
+    assert client.get_table.call_count == 2
+
+
+def test_new_column_refreshes_schema(client):
+    old, new = table(2), table(3)
+    client.get_table.side_effect = [old, new]
+
+    shared.insert_rows("events_raw", [("a", "b")])
+    shared.insert_rows("events_raw", [("a", "b", "c")])
+
+    assert client.get_table.call_count == 2
+    assert client.insert_rows.call_args.args[0] is new
+
+
+def test_unknown_field_error_refreshes_schema(client):
+    old, new = table(2), table(2)
+    client.get_table.side_effect = [old, new]
+    client.insert_rows.side_effect = [
+        [{"index": 0, "errors": [{"reason": "invalid", "message": "no such field: team."}]}],
+        [],
+    ]
+
+    assert shared.insert_rows("events_raw", [("a", "b")]) == []
+    assert client.insert_rows.call_args.args[0] is new
+
+
+def test_only_rows_of_the_old_schema_are_inserted_again(client):
+    old, new = table(2), table(2)
+    client.get_table.side_effect = [old, new]
+    client.insert_rows.side_effect = [
+        [{"index": 1, "errors": [{"message": "no such field: team."}]}],
+        [{"index": 0, "errors": [{"message": "bad value"}]}],
+    ]
+
+    errors = shared.insert_rows("events_raw", [("a", "b"), ("c", "d")])
+
+    assert client.insert_rows.call_args.args[1] == [("c", "d")]
+    assert errors == [{"index": 1, "errors": [{"message": "bad value"}]}]
+
+
+def test_other_errors_are_returned(client):
+    client.get_table.return_value = table(1)
+    errors = [{"index": 0, "errors": [{"reason": "invalid", "message": "bad value"}]}]
+    client.insert_rows.return_value = errors
+
+    assert shared.insert_rows("events_raw", [("a",)]) == errors
+    client.get_table.assert_called_once()
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def scan_iter(self, match, count):
+        prefix = match.rstrip("*")
+        return (key.encode() for key in self.data if key.startswith(prefix))
+
+
+@pytest.fixture
+def deduplicator(tmp_path):
+    deduplicator = shared.Deduplicator(shared.SQLiteStore(str(tmp_path / "dedup.sqlite3")))
+    with mock.patch("shared._deduplicator", deduplicator):
+        yield deduplicator
+
+
+def event(signature):
+    return {
+        "event_type": "push",
+        "id": "1",
+        "metadata": "{}",
+        "time_created": "2021-06-15 11:12:14",
+        "signature": signature,
+        "msg_id": "1",
+        "source": "github",
+    }
+
+
+def test_sqlite_store_persists_signatures(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    shared.SQLiteStore(path).add_many(["a", "b", "a"])
+
+    store = shared.SQLiteStore(path)
+    assert store.contains("a") and store.contains("b")
+    assert not store.contains("c")
+    assert store.contains_many(["a", "c", "b"]) == {"a", "b"}
+    assert sorted(store) == ["a", "b"]
+
+
+def test_sqlite_store_looks_up_more_signatures_than_parameters(tmp_path):
+    store = shared.SQLiteStore(str(tmp_path / "dedup.sqlite3"))
+    store.add_many(["a", "b"])
+
+    with mock.patch("shared.SQLITE_MAX_PARAMETERS", 2):
+        assert store.contains_many(["c", "a", "d", "e", "b"]) == {"a", "b"}
+
+
+def test_warm_up_loads_signatures_once(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    signatures = mock.MagicMock(return_value=iter(["a", "b"]))
+
+    shared.Deduplicator(shared.SQLiteStore(path)).warm_up(signatures)
+    deduplicator = shared.Deduplicator(shared.SQLiteStore(path))
+    deduplicator.warm_up(signatures)
+
+    signatures.assert_called_once_with()
+    assert deduplicator.contains("a")
+
+
+def test_bloom_filter_answers_new_signatures():
+    store = mock.MagicMock()
+    store.__iter__.return_value = iter(["a"])
+    deduplicator = shared.Deduplicator(store, shared.BloomFilter(1000, 0.001))
+    deduplicator.warm_up()
+
+    assert not deduplicator.contains("new")
+    store.contains.assert_not_called()
+    deduplicator.contains_many(["new", "a"])
+    store.contains_many.assert_called_once_with(["a"])
+
+    store.contains.return_value = True
+    assert deduplicator.contains("a")
+    deduplicator.add("b")
+    store.add_many.assert_called_once_with(["b"])
+    assert deduplicator.contains("b")
+
+
+def test_redis_store():
+    store = shared.RedisStore(None, prefix="sig:", client=FakeRedis())
+    assert store.needs_warm_up()
+
+    store.add_many(["a", "b"])
+    store.mark_warmed_up()
+
+    assert store.contains("a")
+    assert not store.contains("c")
+    assert store.contains_many(["a", "c"]) == {"a"}
+    assert not store.needs_warm_up()
+    assert sorted(store) == ["a", "b"]
+
+
+def test_bigquery_store_uses_query_parameters(client):
+    client.query.return_value.result.return_value.total_rows = 1
+
+    assert shared.BigQueryStore().contains("x' OR '1'='1")
+
+    sql = client.query.call_args.args[0]
+    parameter = client.query.call_args.kwargs["job_config"].query_parameters[0]
+    assert "@signature" in sql and "x'" not in sql
+    assert parameter.value == "x' OR '1'='1"
+
+
+def test_bigquery_store_looks_up_signatures_in_one_query(client):
+    client.query.return_value.result.return_value = [{"signature": "a"}]
+
+    assert shared.BigQueryStore().contains_many(["a", "b"]) == {"a"}
+    assert shared.BigQueryStore().contains_many([]) == set()
+
+    client.query.assert_called_once()
+    sql = client.query.call_args.args[0]
+    parameter = client.query.call_args.kwargs["job_config"].query_parameters[0]
+    assert "IN UNNEST(@signatures)" in sql
+    assert parameter.values == ["a", "b"]
+
+
+def test_get_deduplicator_warms_up_from_bigquery(client, tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    client.query.return_value.result.return_value = [{"signature": "a"}]
+
+    with mock.patch("shared._deduplicator", None), mock.patch("shared.DEDUP_STORE", "sqlite"), \
+            mock.patch("shared.DEDUP_SQLITE_PATH", path):
+        deduplicator = shared.get_deduplicator()
+        assert shared.get_deduplicator() is deduplicator
+
+    client.query.assert_called_once()
+    sql = client.query.call_args.args[0]
+    assert "DISTINCT signature" in sql
+    assert "INTERVAL 7 DAY" in sql and sql.endswith("LIMIT 1000000")
+    assert deduplicator.contains("a")
+
+
+def test_bigquery_store_is_not_warmed_up(client):
+    with mock.patch("shared._deduplicator", None), mock.patch("shared.DEDUP_STORE", "bigquery"):
+        deduplicator = shared.get_deduplicator()
+
+    client.query.assert_not_called()
+    assert isinstance(deduplicator.store, shared.BigQueryStore)
+
+
+def test_inserted_signatures_are_not_queried(client, deduplicator):
+    client.get_table.return_value = table(8)
+
+    shared.insert_row_into_bigquery(event("a"))
+    shared.insert_row_into_bigquery(event("a"))
+
+    client.query.assert_not_called()
+    assert client.insert_rows.call_count == 1
+    assert deduplicator.contains("a")
+
+
+def test_failed_insert_is_not_recorded(client, deduplicator):
+    client.get_table.return_value = table(8)
+    client.insert_rows.return_value = [{"index": 0, "errors": [{"message": "bad value"}]}]
+
+    shared.insert_row_into_bigquery(event("a"))
+
+    assert not deduplicator.contains("a")
+
+
+def insert_concurrently(writer, rows):
+    results = [None] * len(rows)
+
+    def insert(index):
+        results[index] = writer.insert("events_raw", rows[index]).result(timeout=5)
+
+    threads = [threading.Thread(target=insert, args=(i,)) for i in range(len(rows))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_writer_batches_concurrent_rows():
+    insert = mock.MagicMock(return_value=[])
+    writer = shared.BatchWriter(insert, max_rows=3, max_latency=60)
+
+    assert insert_concurrently(writer, [("a",), ("b",), ("c",)]) == [[], [], []]
+
+    insert.assert_called_once()
+    assert sorted(insert.call_args.args[1]) == [("a",), ("b",), ("c",)]
+    assert writer.stats() == {"buffered": 0, "batches": 1, "rows": 3}
+
+
+def test_writer_maps_errors_to_rows():
+    def insert(table_id, rows):
+        return [{"index": rows.index(("b",)), "errors": [{"reason": "invalid"}]}]
+
+    writer = shared.BatchWriter(insert, max_rows=3, max_latency=60)
+    results = insert_concurrently(writer, [("a",), ("b",), ("c",)])
+
+    assert results == [[], [{"index": 0, "errors": [{"reason": "invalid"}]}], []]
+
+
+def test_writer_flushes_after_max_latency():
+    insert = mock.MagicMock(return_value=[])
+    writer = shared.BatchWriter(insert, max_latency=0.01)
+
+    assert writer.insert("events_raw", ("a",)).result(timeout=5) == []
+
+
+def test_writer_flushes_on_max_bytes():
+    insert = mock.MagicMock(return_value=[])
+    writer = shared.BatchWriter(insert, max_bytes=10, max_latency=60)
+
+    assert writer.insert("events_raw", ("a" * 10,)).result(timeout=5) == []
+
+
+def test_flush_sends_buffered_rows():
+    insert = mock.MagicMock(return_value=[])
+    writer = shared.BatchWriter(insert, max_latency=60)
+    future = writer.insert("events_raw", ("a",))
+    writer.insert("events_enriched", ("b",))
+
+    assert writer.flush(timeout=5)
+    assert future.done()
+    assert insert.call_count == 2
+
+
+def test_closed_writer_sends_rows_at_once():
+    insert = mock.MagicMock(return_value=[])
+    writer = shared.BatchWriter(insert, max_latency=60)
+    writer.close(timeout=5)
+
+    assert writer.insert("events_raw", ("a",)).done()
+
+
+def test_writer_failure_fails_every_row():
+    writer = shared.BatchWriter(mock.MagicMock(side_effect=ConnectionError()), max_rows=2)
+
+    futures = [writer.insert("events_raw", (row,)) for row in "ab"]
+
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=5)
+
+
+@pytest.mark.parametrize("reason", ["backendError", "stopped"])
+def test_write_row_raises_retryable_errors(reason):
+    writer = shared.BatchWriter(
+        mock.MagicMock(return_value=[{"index": 0, "errors": [{"reason": reason}]}]),
+        max_latency=0,
+    )
+
+    with mock.patch("shared._writer", writer), pytest.raises(shared.RetryableInsertError):
+        shared.write_row("events_raw", ("a",))
+
+
+def test_write_row_raises_transient_failures():
+    writer = shared.BatchWriter(mock.MagicMock(side_effect=ConnectionError()), max_latency=0)
+
+    with mock.patch("shared._writer", writer), pytest.raises(shared.RetryableInsertError):
+        shared.write_row("events_raw", ("a",))
+
+
+def test_write_row_returns_invalid_row_errors():
+    errors = [{"index": 0, "errors": [{"reason": "invalid"}]}]
+    writer = shared.BatchWriter(mock.MagicMock(return_value=errors), max_latency=0)
+
+    with mock.patch("shared._writer", writer):
+        assert shared.write_row("events_raw", ("a",)) == errors
+
+
+def test_sigterm_flushes_writer():
+    calls = []
+
+    def previous(signum, frame):
+        calls.append(signum)
+
+    original = signal.signal(signal.SIGTERM, previous)
+    writer = mock.MagicMock()
+    try:
+        with mock.patch("atexit.register") as register, mock.patch("shared._writer", writer), \
+                mock.patch("shared._flush_on_shutdown", False):
+            shared.flush_on_shutdown(timeout=3)
+            # Installed once, however many parsers call it
+            shared.flush_on_shutdown(timeout=3)
+            signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+    finally:
+        signal.signal(signal.SIGTERM, original)
+
+    writer.flush.assert_called_once_with(3)
+    assert calls == [signal.SIGTERM]
+    register.assert_called_once_with(shared.close_writer, 3)
+
+
+class FakeWriteClient(object):
+    """
+    In-process stand-in for the BigQuery Storage Write API client that checks
+    append offsets. Rows containing b"invalid" are rejected.
+    """
+
+    def __init__(self):
+        self.streams = {}
+        self.committed = []
+        self.appends = 0
+        self.lost_responses = 0
+
+    def create_write_stream(self, parent, write_stream):
+        from google.cloud.bigquery_storage_v1 import types
+
+        name = f"{parent}/streams/{len(self.streams)}"
+        self.streams[name] = {"type": write_stream.type_, "rows": []}
+        return types.WriteStream(name=name, type_=write_stream.type_)
+
+    def append_rows(self, requests, metadata=()):
+        from google.api_core.exceptions import NotFound, ServiceUnavailable
+        from google.cloud.bigquery_storage_v1 import types
+
+        request = next(requests)
+        self.appends += 1
+        stream = self.streams.get(request.write_stream)
+        if stream is None:
+            raise NotFound("stream not found")
+        rows = list(request.proto_rows.rows.serialized_rows)
+        invalid = [index for index, row in enumerate(rows) if b"invalid" in row]
+        if invalid:
+            return iter([types.AppendRowsResponse(
+                error={"code": 3, "message": "Rows are invalid"},
+                row_errors=[types.RowError(index=i, message="Bad row") for i in invalid],
+            )])
+        if request.offset < len(stream["rows"]):
+            return iter([types.AppendRowsResponse(error={"code": 6, "message": "Exists"})])
+        stream["rows"].extend(rows)
+        if stream["type"] == types.WriteStream.Type.COMMITTED:
+            self.committed.extend(rows)
+        if self.lost_responses:
+            self.lost_responses -= 1
+            raise ServiceUnavailable("Response lost")
+        return iter([types.AppendRowsResponse(
+            append_result={"offset": request.offset}
+        )])
+
+    def finalize_write_stream(self, name):
+        pass
+
+    def batch_commit_write_streams(self, request):
+        from google.cloud.bigquery_storage_v1 import types
+
+        for name in request["write_streams"]:
+            self.committed.extend(self.streams.pop(name)["rows"])
+        return types.BatchCommitWriteStreamsResponse()
+
+
+def events_raw_table():
+    from google.cloud.bigquery import SchemaField
+
+    schema = [
+        SchemaField(name, "TIMESTAMP" if name == "time_created" else "STRING")
+        for name in ("event_type", "id", "metadata", "time_created", "signature",
+                     "msg_id", "source", "team")
+    ]
+    return mock.MagicMock(
+        schema=schema, project="project", dataset_id="four_keys", table_id="events_raw"
+    )
+
+
+def raw_row(signature, time_created="2021-06-15 11:12:14"):
+    return ("push", "1", "{}", time_created, signature, "1", "github", None)
+
+
+@pytest.fixture
+def write_client(client):
+    client.get_table.return_value = events_raw_table()
+    return FakeWriteClient()
+
+
+def decoded(writer, rows):
+    message_class = writer._tables["events_raw"].message_class
+    return [message_class.FromString(row) for row in rows]
+
+
+def test_storage_writer_appends_at_offsets(write_client):
+    writer = shared.StorageWriter(write_client, "committed")
+
+    assert writer.insert("events_raw", [raw_row("a"), raw_row("b")]) == []
+    assert writer.insert("events_raw", [raw_row("c")]) == []
+
+    rows = decoded(writer, write_client.committed)
+    assert [row.signature for row in rows] == ["a", "b", "c"]
+    assert rows[0].time_created == 1623755534000000
+    assert not rows[0].HasField("team")
+    assert len(write_client.streams) == 1
+    assert writer._tables["events_raw"].acquire().offset == 3
+
+
+def test_storage_writer_retried_append_is_written_once(write_client):
+    writer = shared.StorageWriter(write_client, "committed")
+    write_client.lost_responses = 1
+
+    with mock.patch("time.sleep"):
+        assert writer.insert("events_raw", [raw_row("a")]) == []
+    writer.insert("events_raw", [raw_row("b")])
+
+    assert write_client.appends == 3
+    assert [row.signature for row in decoded(writer, write_client.committed)] == ["a", "b"]
+
+
+def test_storage_writer_maps_row_errors(write_client):
+    writer = shared.StorageWriter(write_client, "committed")
+
+    errors = writer.insert(
+        "events_raw",
+        [raw_row("a"), raw_row("invalid"), raw_row("c", time_created="yesterday")],
+    )
+
+    assert [error["index"] for error in errors] == [1, 2]
+    assert errors[0]["errors"] == [{"reason": "invalid", "message": "Bad row"}]
+    assert [row.signature for row in decoded(writer, write_client.committed)] == ["a"]
+
+
+def test_storage_writer_replaces_missing_stream(write_client):
+    writer = shared.StorageWriter(write_client, "committed")
+    writer.insert("events_raw", [raw_row("a")])
+    write_client.streams.clear()
+
+    assert writer.insert("events_raw", [raw_row("b")]) == []
+    assert writer._tables["events_raw"].acquire().offset == 1
+
+
+def test_storage_writer_commits_pending_streams(write_client):
+    writer = shared.StorageWriter(write_client, "pending")
+
+    assert writer.insert("events_raw", [raw_row("a")]) == []
+    assert writer.insert("events_raw", [raw_row("b")]) == []
+
+    assert [row.signature for row in decoded(writer, write_client.committed)] == ["a", "b"]
+    assert write_client.streams == {}
+
+
+@pytest.mark.parametrize("value,expected", [
+    (0, 0),
+    (1623755534.5, 1623755534500000),
+    ("2021-06-15 11:12:14", 1623755534000000),
+    ("2021-06-15T11:12:14Z", 1623755534000000),
+    ("2021-06-15T13:12:14+02:00", 1623755534000000),
+    ("2021-06-15 11:12:14 UTC", 1623755534000000),
+])
+def test_timestamp_micros(value, expected):
+    assert shared.timestamp_micros(value) == expected
+
+
+def test_sink_is_selected_by_environment():
+    assert shared.get_sink() is shared.insert_rows
+    writer = shared.StorageWriter(FakeWriteClient())
+    with mock.patch("shared.SINK", "storage_write"), mock.patch("shared._storage_writer", writer):
+        assert shared.get_sink() == writer.insert
+
+
+class FakeMessage(object):
+    def __init__(self, signature, data=b'{"id": 1}'):
+        self.data = data
+        self.attributes = {"X-Hub-Signature": signature}
+        self.message_id = signature
+        self.publish_time = datetime.datetime(2021, 6, 15, 11, 12, 14, tzinfo=datetime.timezone.utc)
+        self.ack = mock.MagicMock()
+        self.nack = mock.MagicMock()
+
+
+def parse(msg):
+    if msg["data"] == b"not json":
+        raise Exception("Not a webhook")
+    assert msg["publishTime"] == "2021-06-15T11:12:14Z"
+    return event(msg["attributes"]["X-Hub-Signature"])
+
+
+def test_consumer_inserts_batch_with_one_request(client, deduplicator):
+    client.get_table.return_value = table(8)
+    messages = [FakeMessage("a"), FakeMessage("b"), FakeMessage("c")]
+
+    shared.PullConsumer("subscription", parse).process_batch(messages)
+
+    assert client.insert_rows.call_count == 1
+    assert [row[4] for row in client.insert_rows.call_args.args[1]] == ["a", "b", "c"]
+    assert all(m.ack.called and not m.nack.called for m in messages)
+    assert deduplicator.contains("a") and deduplicator.contains("c")
+
+
+def test_consumer_acks_duplicates(client, deduplicator):
+    client.get_table.return_value = table(8)
+    deduplicator.add("a")
+    messages = [FakeMessage("a"), FakeMessage("b"), FakeMessage("b")]
+
+    shared.PullConsumer("subscription", parse).process_batch(messages)
+
+    assert [row[4] for row in client.insert_rows.call_args.args[1]] == ["b"]
+    assert all(m.ack.called for m in messages)
+
+
+def test_consumer_queries_bigquery_once_per_batch(client):
+    client.get_table.return_value = table(8)
+    client.query.return_value.result.return_value = [{"signature": "b"}]
+    messages = [FakeMessage("a"), FakeMessage("b"), FakeMessage("c")]
+
+    with mock.patch("shared._deduplicator", shared.Deduplicator(shared.BigQueryStore())):
+        shared.PullConsumer("subscription", parse).process_batch(messages)
+
+    client.query.assert_called_once()
+    assert [row[4] for row in client.insert_rows.call_args.args[1]] == ["a", "c"]
+    assert all(m.ack.called for m in messages)
+
+
+def test_consumer_nacks_batch_when_duplicate_check_fails(client):
+    client.query.side_effect = ConnectionError("reset")
+    messages = [FakeMessage("a"), FakeMessage("b")]
+
+    with mock.patch("shared._deduplicator", shared.Deduplicator(shared.BigQueryStore())):
+        shared.PullConsumer("subscription", parse).process_batch(messages)
+
+    client.insert_rows.assert_not_called()
+    assert all(m.nack.called and not m.ack.called for m in messages)
+
+
+def test_consumer_acks_unparsable_messages(client, deduplicator):
+    client.get_table.return_value = table(8)
+    messages = [FakeMessage("a"), FakeMessage("b", b"not json")]
+
+    consumer = shared.PullConsumer("subscription", parse)
+    consumer.process_batch(messages)
+
+    assert messages[0].ack.called
+    assert messages[1].ack.called and not messages[1].nack.called
+    assert consumer.stats() == {"batches": 1, "acked": 2, "nacked": 0}
+
+
+def test_consumer_nacks_messages_failing_for_a_transient_reason(client, deduplicator):
+    client.get_table.return_value = table(8)
+    messages = [FakeMessage("a"), FakeMessage("b")]
+
+    def process(msg):
+        if msg["messageId"] == "b":
+            raise ConnectionError("reset")
+        return parse(msg)
+
+    consumer = shared.PullConsumer("subscription", process)
+    consumer.process_batch(messages)
+
+    assert messages[0].ack.called
+    assert messages[1].nack.called and not messages[1].ack.called
+    assert consumer.stats() == {"batches": 1, "acked": 1, "nacked": 1}
+
+
+def test_consumer_nacks_rows_that_may_be_inserted_later(client, deduplicator):
+    client.get_table.return_value = table(8)
+    client.insert_rows.return_value = [
+        {"index": 0, "errors": [{"reason": "backendError"}]},
+        {"index": 1, "errors": [{"reason": "invalid"}]},
+    ]
+    messages = [FakeMessage("a"), FakeMessage("b"), FakeMessage("c")]
+
+    consumer = shared.PullConsumer("subscription", parse)
+    consumer.process_batch(messages)
+
+    assert messages[0].nack.called and not messages[0].ack.called
+    assert messages[1].ack.called and messages[2].ack.called
+    assert not deduplicator.contains("a") and not deduplicator.contains("b")
+    assert deduplicator.contains("c")
+    assert consumer.stats() == {"batches": 1, "acked": 2, "nacked": 1}
+
+
+def test_consumer_nacks_batch_on_transient_failure(client, deduplicator):
+    client.get_table.return_value = table(8)
+    client.insert_rows.side_effect = ConnectionError("reset")
+    messages = [FakeMessage("a"), FakeMessage("b")]
+
+    shared.PullConsumer("subscription", parse).process_batch(messages)
+
+    assert all(m.nack.called and not m.ack.called for m in messages)
+
+
+def test_consumer_stop_inserts_received_messages(client, deduplicator):
+    client.get_table.return_value = table(8)
+    consumer = shared.PullConsumer("subscription", parse, batch_size=2, batch_latency=5)
+    received = [FakeMessage(signature) for signature in "abc"]
+    for message in received:
+        consumer._receive(message)
+    consumer._thread.start()
+
+    consumer.stop()
+    late = FakeMessage("d")
+    consumer._receive(late)
+
+    assert [len(c.args[1]) for c in client.insert_rows.call_args_list] == [2, 1]
+    assert all(m.ack.called for m in received)
+    assert late.nack.called
+
+
+def test_decode_data_of_pulled_message():
+    message = FakeMessage("a", b'{"id": 1}')
+
+    assert shared.decode_data(shared.pulled_message(message)) == b'{"id": 1}'
+
+
+def test_pulled_message_is_signed_as_if_pushed():
+    received = pubsub_v1.types.PubsubMessage(
+        data=b'{"id": 1}',
+        attributes={"X-Github-Event": "push", "X-Team": "team1"},
+        message_id="2070443601311540",
+        publish_time=timestamp_pb2.Timestamp(seconds=1623755534, nanos=123456789),
+    )._pb
+    message = pubsub_v1.subscriber.message.Message(received, "ack", 1, queue.Queue())
+    # The body of a push request for the same message
+    envelope = json.loads(
+        '{"message":{"attributes":{"X-Github-Event":"push","X-Team":"team1"},'
+        '"data":"eyJpZCI6IDF9","messageId":"2070443601311540",'
+        '"message_id":"2070443601311540",'
+        '"publishTime":"2021-06-15T11:12:14.123456789Z",'
+        '"publish_time":"2021-06-15T11:12:14.123456789Z"},'
+        '"subscription":"projects/project/subscriptions/github"}'
+    )
+
+    msg = shared.pulled_message(message)
+
+    assert list(msg) == list(envelope["message"])
+    assert shared.create_unique_id(msg) == shared.create_unique_id(envelope["message"])
+
+
+def test_json_view_reads_values():
+    document = (
+        '{"skipped": {"a": [1, "]}", {"b": null}]}, "head_commit": '
+        '{"id": "c\\u00e9", "timestamp": 0, "added": [true, false, -1.5e3]}}'
+    )
+    view = shared.JsonView(document)
+
+    assert view["head_commit"]["id"] == "cé"
+    assert view["head_commit"]["timestamp"] == 0
+    assert list(view["head_commit"]["added"]) == [True, False, -1500.0]
+    assert view["skipped"]["a"][2]["b"] is None
+    assert view.get("missing") is None
+    assert "skipped" in view
+    assert list(view) == ["skipped", "head_commit"]
+    assert len(view["skipped"]["a"]) == 3
+
+
+def test_json_view_missing_keys_raise():
+    view = shared.JsonView('{"commits": [{"id": "a"}]}')
+
+    with pytest.raises(KeyError):
+        view["head_commit"]
+    with pytest.raises(IndexError):
+        view["commits"][1]
+
+
+@pytest.mark.parametrize("document", [
+    '"not an object"',
+    '{"a": "unterminated}',
+    '{"a" 1}',
+    '{"a": 1 "b": 2}',
+])
+def test_json_view_invalid_json_raises(document):
+    with pytest.raises(json.JSONDecodeError):
+        shared.JsonView(document)["b"]
+
+
+@pytest.mark.parametrize("backend", ["orjson", "json"])
+def test_json_backends_encode_identically(backend):
+    if backend == "orjson":
+        pytest.importorskip("orjson")
+    entry = {"severity": "WARNING", "errors": None, "team": "café", "ids": [1, 2 ** 70]}
+
+    with mock.patch.object(shared, "_orjson", shared.load_orjson(backend)):
+        encoded = shared.json_dumps(entry)
+
+        assert shared.json_loads(encoded) == entry
+        assert shared.json_loads('{"n": NaN}')["n"] != 0
+    assert encoded == '{"severity":"WARNING","errors":null,"team":"café","ids":[1,1180591620717411303424]}'
+
+
+def test_signature_does_not_depend_on_json_backend():
+    pytest.importorskip("orjson")
+    msg = {
+        "data": "eyJpZCI6ICJjYWZcdTAwZTkifQ==",
+        "attributes": {"headers": '{"X-Gitlab-Event": "Push Hook"}', "X-Team": "café"},
+        "message_id": "1",
+    }
+    expected = hashlib.sha1(json.dumps(msg).encode("utf-8")).hexdigest()
+
+    for backend in ("orjson", "json"):
+        with mock.patch.object(shared, "_orjson", shared.load_orjson(backend)):
+            assert shared.create_unique_id(msg) == expected
+
+
+def test_compile_extractor():
+    def first_label(payload):
+        return payload["labels"][0] if payload["labels"] else None
+
+    extract = shared.compile_extractor({
+        "id": ("repository.name", "number"),
+        "time_created": ["closed_at", "updated_at"],
+        "state": "state",
+        "label": first_label,
+    }, "Test event", optional=("label",))
+    payload = {"repository": {"name": "r"}, "number": 7, "closed_at": "",
+               "updated_at": "t", "state": "open", "labels": []}
+
+    assert extract(payload) == {"id": "r/7", "time_created": "t", "state": "open", "label": None}
+    assert extract(shared.JsonView(json.dumps(payload)))["id"] == "r/7"
+    with pytest.raises(shared.MissingFieldError, match="Test event has no id: "
+                       "missing repository.name and number"):
+        extract({**payload, "repository": None})
+    with pytest.raises(shared.MissingFieldError, match="no state: missing state"):
+        extract({**payload, "state": None})
+
+
+def test_parser_copies_are_in_sync():
+    # Each parser is built from its own directory, so it ships a copy of
+    # shared.py instead of installing this one
+    here = os.path.dirname(os.path.abspath(__file__))
+    workers = os.path.join(here, "..", "bq-workers")
+    with open(os.path.join(here, "shared.py"), "rb") as f:
+        source = f.read()
+
+    stale = []
+    for parser in sorted(os.listdir(workers)):
+        if not os.path.exists(os.path.join(workers, parser, "main.py")):
+            continue
+        copy = os.path.join(workers, parser, "shared.py")
+        if not os.path.exists(copy):
+            stale.append(parser)
+            continue
+        with open(copy, "rb") as f:
+            if f.read() != source:
+                stale.append(parser)
+
+    assert not stale, (
+        f"shared.py differs from shared/shared.py in {', '.join(stale)}. Run: "
+        "for d in bq-workers/*/; do [ -f $d/main.py ] && cp shared/shared.py $d; done"
+    )
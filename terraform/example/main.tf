@@ -7,4 +7,5 @@ module "fourkeys" {
   parsers             = var.parsers
   teams               = var.teams
   enable_dashboard    = var.enable_dashboard
+  consolidate_parsers = var.consolidate_parsers
 }
\ No newline at end of file
@@ -9,6 +9,12 @@ variable "enable_apis" {
   default     = true
 }
 
+variable "consolidate_parsers" {
+  type        = bool
+  description = "Toggle to run every parser in one Cloud Run service."
+  default     = false
+}
+
 variable "enable_dashboard" {
   type        = bool
   description = "Toggle to enable cloud run service creation."
@@ -13,6 +13,7 @@ locals {
   tekton_parser_url = var.tekton_parser_url == "" ? format("gcr.io/%s/tekton-parser", var.project_id) : var.tekton_parser_url
   circleci_parser_url = var.circleci_parser_url == "" ? format("gcr.io/%s/circleci-parser", var.project_id) : var.circleci_parser_url
   pagerduty_parser_url = var.pagerduty_parser_url == "" ? format("gcr.io/%s/pagerduty-parser", var.project_id) : var.pagerduty_parser_url
+  multi_parser_url = var.multi_parser_url == "" ? format("gcr.io/%s/multi-parser", var.project_id) : var.multi_parser_url
   services = var.enable_apis ? [
     "bigquery.googleapis.com",
     "cloudbuild.googleapis.com",
@@ -1,6 +1,6 @@
 module "circleci_parser" {
   source                         = "../fourkeys-circleci-parser"
-  count                          = contains(var.parsers, "circleci") ? 1 : 0
+  count                          = contains(var.parsers, "circleci") && !var.consolidate_parsers ? 1 : 0
   project_id                     = var.project_id
   parser_container_url           = local.circleci_parser_url
   region                         = var.region
@@ -13,7 +13,7 @@ module "circleci_parser" {
 
 module "github_parser" {
   source                         = "../fourkeys-github-parser"
-  count                          = contains(var.parsers, "github") ? 1 : 0
+  count                          = contains(var.parsers, "github") && !var.consolidate_parsers ? 1 : 0
   project_id                     = var.project_id
   parser_container_url           = local.github_parser_url
   region                         = var.region
@@ -26,7 +26,7 @@ module "github_parser" {
 
 module "jira_parser" {
   source                         = "../fourkeys-jira-parser"
-  count                          = contains(var.parsers, "jira") ? 1 : 0
+  count                          = contains(var.parsers, "jira") && !var.consolidate_parsers ? 1 : 0
   project_id                     = var.project_id
   parser_container_url           = local.jira_parser_url
   region                         = var.region
@@ -39,7 +39,7 @@ module "jira_parser" {
 
 module "gitlab_parser" {
   source                         = "../fourkeys-gitlab-parser"
-  count                          = contains(var.parsers, "gitlab") ? 1 : 0
+  count                          = contains(var.parsers, "gitlab") && !var.consolidate_parsers ? 1 : 0
   project_id                     = var.project_id
   parser_container_url           = local.gitlab_parser_url
   region                         = var.region
@@ -52,7 +52,7 @@ module "gitlab_parser" {
 
 module "pagerduty_parser" {
   source                         = "../fourkeys-pagerduty-parser"
-  count                          = contains(var.parsers, "pagerduty") ? 1 : 0
+  count                          = contains(var.parsers, "pagerduty") && !var.consolidate_parsers ? 1 : 0
   project_id                     = var.project_id
   parser_container_url           = local.pagerduty_parser_url
   region                         = var.region
@@ -65,7 +65,7 @@ module "pagerduty_parser" {
 
 module "tekton_parser" {
   source                         = "../fourkeys-tekton-parser"
-  count                          = contains(var.parsers, "tekton") ? 1 : 0
+  count                          = contains(var.parsers, "tekton") && !var.consolidate_parsers ? 1 : 0
   project_id                     = var.project_id
   parser_container_url           = local.tekton_parser_url
   region                         = var.region
@@ -78,7 +78,7 @@ module "tekton_parser" {
 
 module "cloud_build_parser" {
   source                         = "../fourkeys-cloud-build-parser"
-  count                          = contains(var.parsers, "cloud-build") ? 1 : 0
+  count                          = contains(var.parsers, "cloud-build") && !var.consolidate_parsers ? 1 : 0
   project_id                     = var.project_id
   parser_container_url           = local.cloud_build_parser_url
   region                         = var.region
@@ -87,4 +87,18 @@ module "cloud_build_parser" {
   depends_on = [
     time_sleep.wait_for_services
   ]
-}
\ No newline at end of file
+}
+
+module "multi_parser" {
+  source                         = "../fourkeys-multi-parser"
+  count                          = var.consolidate_parsers ? 1 : 0
+  project_id                     = var.project_id
+  parser_container_url           = local.multi_parser_url
+  parsers                        = var.parsers
+  region                         = var.region
+  fourkeys_service_account_email = google_service_account.fourkeys.email
+  enable_apis                    = var.enable_apis
+  depends_on = [
+    time_sleep.wait_for_services
+  ]
+}
@@ -24,6 +24,12 @@ variable "parsers" {
   description = "List of data parsers to configure. Acceptable values are: 'github', 'gitlab', 'cloud-build', 'tekton', 'circleci', 'pagerduty'"
 }
 
+variable "consolidate_parsers" {
+  type        = bool
+  description = "Toggle to run every parser in one Cloud Run service, fed by all of their subscriptions, instead of a service per parser."
+  default     = false
+}
+
 variable "teams" {
   type        = list(string)
   description = "List of teams that work in your company."
@@ -94,3 +100,9 @@ variable "pagerduty_parser_url" {
   description = "The URL for the Pager Duty parser container image. A default value pointing to the project's container registry is defined in under local values of this module."
   default     = ""
 }
+
+variable "multi_parser_url" {
+  type        = string
+  description = "The URL for the multi-parser container image, used when consolidate_parsers is set. A default value pointing to the project's container registry is defined in under local values of this module."
+  default     = ""
+}